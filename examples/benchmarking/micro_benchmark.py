@@ -0,0 +1,350 @@
+"""
+Offline micro-benchmarks of the grammar machinery, without a model or a downloaded tokenizer.
+
+The recognizer runs against synthetic byte-level vocabularies (the 256 single bytes plus random words,
+numbers, punctuation, whitespace and non-ASCII pieces, and an EOS token) over the bundled grammars.
+For each grammar and vocabulary size, a random walk through the grammar measures the latency of the
+masks and of the state updates, first with cold caches, then replaying the same tokens with warm caches.
+
+    python examples/benchmarking/micro_benchmark.py --vocab-sizes 32000 128000 --output results.json
+
+Results are printed (or written to `--output`) as JSON, to compare releases.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+import transformers_cfg
+from transformers_cfg.parser import parse_ebnf
+from transformers_cfg.token_grammar_recognizer import IncrementalTokenRecognizer
+from transformers_cfg.tokenization.byte_trie import ByteTrie
+from transformers_cfg.tokenization.mapping.token2byte import (
+    Token2ByteMapping,
+    TokenBytesTable,
+)
+from transformers_cfg.tokenization.vocab_index import VocabularyIndex
+
+GRAMMAR_DIR = os.path.join(os.path.dirname(__file__), "..", "grammars")
+DEFAULT_GRAMMARS = [
+    "json.ebnf",
+    "c.ebnf",
+    "chess.ebnf",
+    "SMILES/generic.ebnf",
+    "PDDL/blocks.ebnf",
+    "calflow.ebnf",
+    "overnight.ebnf",
+    "unicode/emoji_escape.ebnf",
+    "japanese.ebnf",
+]
+DEFAULT_VOCAB_SIZES = [32000, 128000, 256000]
+
+#############################
+#
+# Synthetic vocabulary
+#
+#############################
+
+_PUNCTUATION = "{}[]():,;.\"'=+-*/<>#@%&|!?_\\"
+# CJK, Cyrillic, emoji
+_UNICODE_RANGES = [(0x4E00, 0x9FFF), (0x0410, 0x044F), (0x1F600, 0x1F64F)]
+
+
+def _random_piece(rng: random.Random) -> str:
+    kind = rng.random()
+    space = " " if rng.random() < 0.5 else ""
+    if kind < 0.55:
+        word = "".join(
+            rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(1, 10))
+        )
+        if rng.random() < 0.2:
+            word = word.capitalize()
+        return space + word
+    if kind < 0.65:
+        return space + str(rng.randint(0, 9999))
+    if kind < 0.8:
+        return "".join(rng.choice(_PUNCTUATION) for _ in range(rng.randint(1, 3)))
+    if kind < 0.85:
+        return "\n" + " " * rng.randint(0, 8)
+    lo, hi = rng.choice(_UNICODE_RANGES)
+    return space + "".join(chr(rng.randint(lo, hi)) for _ in range(rng.randint(1, 3)))
+
+
+def synthetic_token_bytes(vocab_size: int, seed: int = 0) -> List[bytes]:
+    """Bytes of `vocab_size - 1` distinct tokens, the 256 single bytes first. The last id is EOS."""
+    rng = random.Random(seed)
+    tokens = [bytes([byte]) for byte in range(256)]
+    seen = set(tokens)
+    while len(tokens) < vocab_size - 1:
+        piece = _random_piece(rng).encode("utf-8")
+        if piece not in seen:
+            seen.add(piece)
+            tokens.append(piece)
+    return tokens
+
+
+class SyntheticTokenizer:
+    """The few attributes of a Hugging Face tokenizer used by the recognizer."""
+
+    def __init__(self, token_bytes: List[bytes]):
+        self.token_bytes = token_bytes
+        self.eos_token_id = len(token_bytes)
+        self.bos_token_id = None
+        self.all_special_ids = [self.eos_token_id]
+        self.name_or_path = f"synthetic-{len(self)}"
+
+    def __len__(self):
+        return len(self.token_bytes) + 1
+
+    def get_vocab(self) -> Dict[str, int]:
+        return {str(token_id): token_id for token_id in range(len(self))}
+
+
+class SyntheticToken2ByteMapping(Token2ByteMapping):
+    def __init__(self, tokenizer: SyntheticTokenizer):
+        super().__init__(tokenizer)
+        self.token_bytes_table = TokenBytesTable.from_token_bytes(
+            tokenizer.token_bytes + [b""]
+        )
+
+    def map(self, token_id: int, verbose=False) -> bytes:
+        return self.token_bytes(token_id)
+
+    def _token_bytes(self, token_id: int) -> bytes:
+        return self.token_bytes_table[token_id]
+
+
+def build_vocab_index(tokenizer: SyntheticTokenizer) -> VocabularyIndex:
+    trie = ByteTrie.from_token_bytes(
+        ((token, token_id) for token_id, token in enumerate(tokenizer.token_bytes)),
+        vocab_size=len(tokenizer),
+    )
+    return VocabularyIndex(tokenizer, trie, SyntheticToken2ByteMapping(tokenizer))
+
+
+#############################
+#
+# Benchmarks
+#
+#############################
+
+
+def _summary(seconds: List[float]) -> Dict[str, float]:
+    if not seconds:
+        return {}
+    ms = np.array(seconds) * 1e3
+    return {
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "max_ms": float(ms.max()),
+        "total_ms": float(ms.sum()),
+    }
+
+
+def _timed(fn, repeat: int) -> float:
+    """Median duration of `repeat` calls of `fn`."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def _quiet(fn, *args, **kwargs):
+    # parsing prints the grammar
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+
+def bench_parse(grammar_str: str, repeat: int) -> float:
+    return _timed(lambda: _quiet(parse_ebnf, grammar_str), repeat)
+
+
+def bench_trie(tokenizer: SyntheticTokenizer, repeat: int) -> float:
+    return _timed(lambda: build_vocab_index(tokenizer), repeat)
+
+
+def _walk(
+    recognizer, steps: int, seed: int, token_ids: Optional[List[Optional[int]]] = None
+):
+    """
+    Random walk of `steps` tokens through the grammar, or replay of `token_ids`.
+    Once only EOS is accepted, the walk starts again from the initial state, which is recorded as a
+    `None` token, so that every walk computes `steps` masks.
+    Returns the tokens and the durations of the masks and of the state updates.
+    """
+    rng = np.random.default_rng(seed)
+    initial_state = recognizer.string_recognizer.get_initial_parsing_state()
+    state = initial_state
+    walked, mask_seconds, update_seconds = [], [], []
+    for step in range(steps if token_ids is None else len(token_ids)):
+        start = time.perf_counter()
+        mask = recognizer.filter_vocab_mask(state)
+        mask_seconds.append(time.perf_counter() - start)
+        if token_ids is None:
+            accepted = mask.token_ids()
+            candidates = accepted[accepted != recognizer.eos_token_id]
+            token_id = int(rng.choice(candidates)) if len(candidates) else None
+        else:
+            token_id = token_ids[step]
+        walked.append(token_id)
+        if token_id is None:
+            state = initial_state
+            continue
+        start = time.perf_counter()
+        state = recognizer._update_state_with_token_id(token_id, state)
+        update_seconds.append(time.perf_counter() - start)
+    return walked, mask_seconds, update_seconds
+
+
+def bench_decode(
+    grammar_str: str,
+    vocab_index: VocabularyIndex,
+    steps: int,
+    seed: int,
+    memory: bool,
+    optimize: bool = False,
+) -> dict:
+    start = time.perf_counter()
+    recognizer = _quiet(
+        IncrementalTokenRecognizer,
+        grammar_str,
+        "root",
+        vocab_index.tokenizer,
+        vocab_index=vocab_index,
+        optimize=optimize,
+    )
+    init_seconds = time.perf_counter() - start
+    token_ids, cold_masks, cold_updates = _walk(recognizer, steps, seed)
+    _, warm_masks, warm_updates = _walk(recognizer, steps, seed, token_ids)
+    result = {
+        "init_seconds": init_seconds,
+        "steps": len(cold_masks),
+        "restarts": token_ids.count(None),
+        "mask": {"cold": _summary(cold_masks), "warm": _summary(warm_masks)},
+        "state_update": {
+            "cold": _summary(cold_updates),
+            "warm": _summary(warm_updates),
+        },
+    }
+    if memory:
+        # separate run, tracing allocations slows everything down
+        tracemalloc.start()
+        recognizer = _quiet(
+            IncrementalTokenRecognizer,
+            grammar_str,
+            "root",
+            vocab_index.tokenizer,
+            vocab_index=vocab_index,
+            optimize=optimize,
+        )
+        _walk(recognizer, steps, seed, token_ids)
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def run(args) -> dict:
+    grammars = {}
+    for name in args.grammars:
+        with open(os.path.join(args.grammar_dir, name)) as file:
+            grammars[name] = file.read()
+
+    results = {
+        "meta": {
+            "transformers_cfg": transformers_cfg.__version__,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "steps": args.steps,
+            "seed": args.seed,
+            "optimize": args.optimize,
+        },
+        "parse_seconds": {},
+        "trie_seconds": {},
+        "decode": [],
+    }
+    for name, grammar_str in grammars.items():
+        results["parse_seconds"][name] = bench_parse(grammar_str, args.repeat)
+
+    for vocab_size in args.vocab_sizes:
+        tokenizer = SyntheticTokenizer(synthetic_token_bytes(vocab_size, args.seed))
+        results["trie_seconds"][str(vocab_size)] = bench_trie(tokenizer, args.repeat)
+        vocab_index = build_vocab_index(tokenizer)
+        for name, grammar_str in grammars.items():
+            result = bench_decode(
+                grammar_str,
+                vocab_index,
+                args.steps,
+                args.seed,
+                args.memory,
+                args.optimize,
+            )
+            results["decode"].append(
+                {"grammar": name, "vocab_size": vocab_size, **result}
+            )
+            print(
+                f"{name} @ {vocab_size}: mask {result['mask']['cold'].get('mean_ms', 0):.2f} ms cold, "
+                f"{result['mask']['warm'].get('mean_ms', 0):.3f} ms warm, "
+                f"update {result['state_update']['cold'].get('mean_ms', 0):.3f} ms",
+                file=sys.stderr,
+            )
+    return results
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--grammars", nargs="+", default=DEFAULT_GRAMMARS)
+    parser.add_argument("--grammar-dir", default=GRAMMAR_DIR)
+    parser.add_argument(
+        "--vocab-sizes", nargs="+", type=int, default=DEFAULT_VOCAB_SIZES
+    )
+    parser.add_argument("--steps", type=int, default=64, help="tokens per walk")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs of the parse and trie timings"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-memory",
+        dest="memory",
+        action="store_false",
+        help="skip the peak memory measurement",
+    )
+    parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="optimize the grammars, see `transformers_cfg.grammar_optimizer`",
+    )
+    parser.add_argument("--output", help="JSON file, printed if not given")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Parse time of `parse_ebnf` on generated grammars of growing size, to check that it scales linearly.
+
+The grammars look like the ones `json_schema_to_grammar.py` emits for large schemas: one object rule
+per property, with string, number, enum and array values, comments and nested groups.
+
+    python examples/benchmarking/parser_benchmark.py --sizes-kb 64 256 1024 4096
+
+For each size, the parse time and the throughput are printed as JSON. With a linear parser, the
+throughput (`kb_per_second`) stays about the same as the grammars grow.
+"""
+
+import argparse
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+from typing import List
+
+from transformers_cfg.parser import parse_ebnf
+
+DEFAULT_SIZES_KB = [64, 256, 1024, 4096]
+
+_VALUES = [
+    '"\\"" [^"\\\\]* "\\""',
+    '"-"? [0-9]+ ("." [0-9]+)?',
+    '("true" | "false")',
+    '"[" space (item ("," space item){0,15})? "]"',
+]
+
+
+def _property_rules(index: int, rng: random.Random) -> str:
+    name = f"prop-{index}"
+    value = rng.choice(_VALUES)
+    if rng.random() < 0.2:
+        value = " | ".join(
+            f'"\\"{rng.choice("abcdefgh")}{i}\\""' for i in range(rng.randint(2, 6))
+        )
+    return (
+        f"# property {index}\n"
+        f'{name}-kv ::= "\\"field_{index}\\"" space ":" space {name}\n'
+        f"{name} ::= ({value}) space\n"
+    )
+
+
+def generate_grammar(size: int, seed: int = 0) -> str:
+    """A grammar of about `size` characters."""
+    rng = random.Random(seed)
+    rules: List[str] = []
+    length, index = 0, 0
+    while length < size:
+        rule = _property_rules(index, rng)
+        rules.append(rule)
+        length += len(rule)
+        index += 1
+    properties = " | ".join(f"prop-{i}-kv" for i in range(index))
+    return (
+        f'root ::= "{{" space (member ("," space member)*)? "}}" space\n'
+        f"member ::= {properties}\n"
+        'item ::= [0-9]+ | "\\"" [a-z]* "\\""\n'
+        'space ::= " "?\n' + "".join(rules)
+    )
+
+
+def bench(sizes_kb: List[int], repeat: int, seed: int) -> dict:
+    results = []
+    for size_kb in sizes_kb:
+        grammar_str = generate_grammar(size_kb * 1024, seed)
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            state = parse_ebnf(grammar_str)
+            durations.append(time.perf_counter() - start)
+        if not state.grammar_rules:
+            raise RuntimeError(f"the generated grammar of {size_kb} KB didn't parse")
+        seconds = statistics.median(durations)
+        results.append(
+            {
+                "size_kb": len(grammar_str) / 1024,
+                "rules": len(state.grammar_rules),
+                "parse_seconds": seconds,
+                "kb_per_second": len(grammar_str) / 1024 / seconds,
+            }
+        )
+        print(
+            f"{size_kb} KB: {seconds:.3f} s, {results[-1]['kb_per_second']:.0f} KB/s",
+            file=sys.stderr,
+        )
+    return {"seed": seed, "repeat": repeat, "results": results}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes-kb", nargs="+", type=int, default=DEFAULT_SIZES_KB)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file, printed if not given")
+    args = parser.parse_args(args)
+
+    # parse errors are logged as warnings
+    logging.basicConfig(level=logging.WARNING)
+    results = bench(args.sizes_kb, args.repeat, args.seed)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
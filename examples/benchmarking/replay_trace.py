@@ -0,0 +1,64 @@
+"""
+Replay a recorded decoding trace without the model and print the per-step latencies as JSON.
+
+Record the trace where the slowdown happens:
+
+    from transformers_cfg.generation.trace import DecodingTrace
+    output = model.generate(input_ids, logits_processor=[processor], ...)
+    DecodingTrace.from_generation(processor, input_ids, output).save("trace.json.gz")
+
+then replay it anywhere, e.g. with another execution mode:
+
+    python examples/benchmarking/replay_trace.py trace.json.gz --execution-mode lazy
+"""
+
+import argparse
+import json
+import sys
+
+from transformers_cfg.generation.trace import DecodingTrace, replay
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("trace", help="trace saved with `DecodingTrace.save`")
+    parser.add_argument(
+        "--tokenizer", help="tokenizer name or path, the recorded one by default"
+    )
+    parser.add_argument(
+        "--execution-mode", help="execution mode, the recorded one by default"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--recorded-token-boost",
+        type=float,
+        default=0.0,
+        help="added to the logit of the recorded token, as a confident model would",
+    )
+    parser.add_argument("--output", help="JSON file, printed if not given")
+    args = parser.parse_args(args)
+
+    trace = DecodingTrace.load(args.trace)
+    tokenizer = None
+    if args.tokenizer is not None:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    report = replay(
+        trace,
+        tokenizer,
+        execution_mode=args.execution_mode,
+        seed=args.seed,
+        recorded_token_boost=args.recorded_token_boost,
+    )
+    summary = {"trace": args.trace, **trace.metadata, **report.summary()}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(summary, file, indent=2)
+    else:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import pytest
+import torch
+from transformers import AutoTokenizer, GPT2Config, GPT2LMHeadModel
+
+from transformers_cfg.generation.logits_process import (
+    GrammarConstrainedLogitsProcessor,
+    GrammarMaskPrefetcher,
+)
+from transformers_cfg.grammar_utils import IncrementalGrammarConstraint
+
+GRAMMAR = 'root ::= "[" [0-9]+ ("," [0-9]+)* "]"'
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+@pytest.fixture(scope="module")
+def model(tokenizer):
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer), n_embd=32, n_layer=1, n_head=2, n_positions=64
+    )
+    return GPT2LMHeadModel(config).eval()
+
+
+def _generate(model, tokenizer, async_masks):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(grammar, async_masks=async_masks)
+    input_ids = tokenizer(["a", "b"], return_tensors="pt").input_ids
+    output = model.generate(
+        input_ids,
+        do_sample=False,
+        max_new_tokens=8,
+        logits_processor=[processor],
+        stopping_criteria=[GrammarMaskPrefetcher(processor)],
+        pad_token_id=tokenizer.eos_token_id,
+    )
+    processor.close()
+    return output
+
+
+def test_async_masks_match_sync(model, tokenizer):
+    expected = _generate(model, tokenizer, async_masks=False)
+    output = _generate(model, tokenizer, async_masks=True)
+    assert torch.equal(output, expected)
+    for text in tokenizer.batch_decode(output[:, 1:], skip_special_tokens=True):
+        assert text.startswith("[")
+
+
+def test_prefetch_discarded_on_other_input_ids(tokenizer):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(grammar, async_masks=True)
+    input_ids = tokenizer(["a"], return_tensors="pt").input_ids
+    scores = torch.zeros(1, len(tokenizer))
+    processor(input_ids, scores)
+    bracket = tokenizer.convert_tokens_to_ids("[")
+    other = tokenizer.convert_tokens_to_ids("[[")
+
+    processor.prefetch(torch.tensor([[input_ids[0, 0], other]]))
+    # the prefetched step is rolled back and the states updated with the actual input ids
+    masked = processor(torch.tensor([[input_ids[0, 0], bracket]]), scores)
+    assert masked[0, tokenizer.convert_tokens_to_ids("1")] == 0
+    processor.close()
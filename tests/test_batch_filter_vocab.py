@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from transformers_cfg.token_grammar_recognizer import IncrementalTokenRecognizer
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def _states(recognizer, tokenizer, texts):
+    states = []
+    for text in texts:
+        state = recognizer.string_recognizer.get_initial_parsing_state()
+        for token_id in tokenizer.encode(text):
+            state = recognizer._update_state_with_token_id(token_id, state)
+        states.append(state)
+    return states
+
+
+@pytest.mark.parametrize(
+    "grammar_str", ['root ::= "a" [0-9]+ "b"', 'root ::= ("a" | "ab") [0-9]* "b"']
+)
+def test_parallel_masks_match_serial(tokenizer, grammar_str):
+    texts = ["a", "a1", "a", "a12", "a1", "a"]
+    recognizer = IncrementalTokenRecognizer(grammar_str, "root", tokenizer)
+    states = _states(recognizer, tokenizer, texts)
+    expected = torch.stack(
+        [
+            recognizer.filter_vocab_mask(state).to_tensor(torch.device("cpu"))
+            for state in states
+        ]
+    )
+
+    recognizer = IncrementalTokenRecognizer(grammar_str, "root", tokenizer)
+    states = _states(recognizer, tokenizer, texts)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        acceptance = recognizer.batch_filter_vocab(
+            states, torch.device("cpu"), executor
+        )
+        masks = recognizer.batch_filter_vocab_mask(states, executor)
+    assert torch.equal(acceptance, expected)
+    # identical rows share their mask
+    assert masks[0] is masks[2] is masks[5]
+    assert masks[1] is masks[4]
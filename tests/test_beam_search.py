@@ -0,0 +1,96 @@
+import pytest
+import torch
+from transformers import AutoTokenizer, GPT2Config, GPT2LMHeadModel
+
+from transformers_cfg.generation.logits_process import GrammarConstrainedLogitsProcessor
+from transformers_cfg.grammar_utils import IncrementalGrammarConstraint
+
+GRAMMAR = 'root ::= "[" [0-9]+ ("," [0-9]+)* "]"'
+# beams diverge into the two alternatives
+BRANCHING_GRAMMAR = (
+    'root ::= "[" [0-9]+ ("," [0-9]+)* "]" | "(" [a-z]+ ("-" [a-z]+)* ")"'
+)
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+@pytest.fixture(scope="module")
+def model(tokenizer):
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer), n_embd=32, n_layer=1, n_head=2, n_positions=64
+    )
+    return GPT2LMHeadModel(config).eval()
+
+
+def _accepted(tokenizer, processor, input_ids):
+    scores = torch.zeros(len(input_ids), len(tokenizer))
+    return torch.isfinite(processor(input_ids, scores))
+
+
+def test_reordered_rows_keep_their_state(tokenizer):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(grammar)
+    token = tokenizer.convert_tokens_to_ids
+    prompt = tokenizer(["a", "a", "a"], return_tensors="pt").input_ids
+    rows = [
+        [token("["), token("1"), token("1")],
+        [token("["), token("1"), token(",")],
+        [token("["), token("1"), token("2")],
+    ]
+    for length in range(4):
+        generated = torch.tensor([row[:length] for row in rows], dtype=torch.long)
+        input_ids = torch.cat([prompt, generated], dim=-1)
+        _accepted(tokenizer, processor, input_ids)
+
+    # the beams are swapped and the first one is duplicated, as beam search does
+    input_ids = torch.cat(
+        [
+            input_ids[[1, 0, 0]],
+            torch.tensor([[token("2")], [token(",")], [token(",")]]),
+        ],
+        dim=-1,
+    )
+    accepted = _accepted(tokenizer, processor, input_ids)
+
+    fresh = GrammarConstrainedLogitsProcessor(
+        IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer),
+        valid_token_start_idx=prompt.shape[-1],
+    )
+    expected = _accepted(tokenizer, fresh, input_ids)
+    assert torch.equal(accepted, expected)
+    # "[1,2" continues with a digit, a comma or a bracket, "[11," with a digit only
+    assert accepted[0, token("]")] and not accepted[0, tokenizer.eos_token_id]
+    assert accepted[1, token("3")] and not accepted[1, token("]")]
+    # duplicated rows share their state
+    states = processor.batch_parsing_states
+    assert states[1] is states[2] and states[0] is not states[1]
+
+
+@pytest.mark.parametrize("execution_mode", ["full_mask", "lazy"])
+def test_beam_search_outputs_are_grammatical(model, tokenizer, execution_mode):
+    grammar = IncrementalGrammarConstraint(BRANCHING_GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(
+        grammar, execution_mode=execution_mode
+    )
+    input_ids = tokenizer(["a", "b"], return_tensors="pt").input_ids
+    output = model.generate(
+        input_ids,
+        do_sample=False,
+        num_beams=4,
+        num_return_sequences=4,
+        max_new_tokens=12,
+        logits_processor=[processor],
+        pad_token_id=tokenizer.eos_token_id,
+    )
+    checker = IncrementalGrammarConstraint(BRANCHING_GRAMMAR, "root", tokenizer)
+    for sequence in output[:, input_ids.shape[-1] :].tolist():
+        if tokenizer.eos_token_id in sequence:
+            sequence = sequence[: sequence.index(tokenizer.eos_token_id)]
+        # every beam is a prefix of a valid string
+        assert checker.accept_token_ids(sequence, as_string=False)
@@ -0,0 +1,49 @@
+from transformers_cfg.tokenization.byte_trie import ByteTrie
+
+
+def _trie():
+    return ByteTrie.from_token_bytes(
+        [(b"ab", 0), (b"a", 1), (b"abc", 2), (b"b", 3), (b"ab", 4), (b"ba", 5)]
+    )
+
+
+def test_subtrees_are_contiguous():
+    trie = _trie()
+    assert trie.num_nodes == 6
+    assert len(trie) == 6
+
+    a = trie.root.children[ord("a")]
+    ab = a.children[ord("b")]
+    assert sorted(trie.subtree_token_ids(a.index).tolist()) == [0, 1, 2, 4]
+    assert sorted(trie.subtree_token_ids(ab.index).tolist()) == [0, 2, 4]
+    # tokens with the same bytes share a node
+    assert sorted(trie.node_token_ids(ab.index).tolist()) == [0, 4]
+    assert ab.token_id == 4
+    assert trie.subtree_token_ids(trie.root.index).tolist() == trie.token_order.tolist()
+
+
+def test_bfs():
+    trie = _trie()
+    accepted = trie.get_next_token_acceptance(
+        accept=lambda byte_seq: bytes(byte_seq) in (b"", b"a", b"ab")
+    )
+    assert accepted == [True, True, False, False, True, False]
+
+
+def test_from_arrays():
+    trie = _trie()
+    restored = ByteTrie.from_arrays(trie.to_arrays(), vocab_size=6)
+    assert restored.bfs() == trie.bfs()
+
+    restored.insert(b"bb", 6)
+    assert sorted(
+        restored.subtree_token_ids(restored.root.children[ord("b")].index).tolist()
+    ) == [3, 5, 6]
+
+
+def test_len_follows_inserts():
+    trie = ByteTrie()
+    trie.insert(b"a", 0)
+    assert len(trie) == 1
+    trie.insert(b"b", 5)
+    assert len(trie) == 6
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from transformers import AutoTokenizer
+
+from transformers_cfg.dfa import DEAD_STATE, RegularityAnalysis
+from transformers_cfg.parse_stack import EMPTY_STACK, push
+from transformers_cfg.parser import parse_ebnf
+from transformers_cfg.token_grammar_recognizer import IncrementalTokenRecognizer
+from transformers_cfg.tokenization.byte_trie import ROOT_NODE
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def _analysis(grammar_str):
+    parsed_grammar = parse_ebnf(grammar_str)
+    analysis = RegularityAnalysis(
+        parsed_grammar.grammar_encoding, parsed_grammar.rule_offsets
+    )
+    return analysis, parsed_grammar.symbol_table
+
+
+def test_regularity():
+    analysis, symbols = _analysis(
+        'root ::= "(" root ")" | number\n'
+        'number ::= [0-9]+ ("." [0-9]+)?\n'
+        "word ::= [a-zé]+\n"
+    )
+    # tail recursion (`+`) is regular, nesting is not
+    assert analysis.regular[symbols["number"]]
+    assert not analysis.regular[symbols["root"]]
+    assert analysis.ascii_only[symbols["number"]]
+    assert not analysis.ascii_only[symbols["word"]]
+
+
+def test_dfa_walk_matches_pushdown_walk(tokenizer):
+    with open("examples/grammars/json.ebnf", "r") as file:
+        grammar_str = file.read()
+    recognizer = IncrementalTokenRecognizer(grammar_str, "root", tokenizer)
+    engine = recognizer.token_acceptance_engine
+
+    num_regular = 0
+    for element_offset in engine.terminal_element_offsets():
+        state = engine.element_dfa_state(element_offset)
+        if state is None:
+            continue
+        num_regular += 1
+        dfa_escape_nodes, escape_nodes = [], []
+        token_ids = engine._walk_dfa(state, dfa_escape_nodes)
+        expected = engine._walk(
+            ROOT_NODE, {push(EMPTY_STACK, element_offset)}, None, escape_nodes
+        )
+        assert np.array_equal(np.sort(token_ids), np.sort(expected))
+        assert sorted(dfa_escape_nodes) == sorted(escape_nodes)
+    assert num_regular > 0
+
+
+def test_dfa_run(tokenizer):
+    recognizer = IncrementalTokenRecognizer(
+        'root ::= [0-9]+ "." [0-9]+', "root", tokenizer
+    )
+    engine = recognizer.token_acceptance_engine
+    dfa = engine.dfa
+    state = dfa.state(recognizer.string_recognizer.get_initial_parsing_state().stacks)
+    end_state = dfa.run(b"12.5", state)
+    assert end_state != DEAD_STATE and dfa.exits[end_state]
+    assert not dfa.exits[dfa.run(b"12.", state)]
+    assert dfa.run(b"1..", state) == DEAD_STATE
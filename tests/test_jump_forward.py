@@ -0,0 +1,60 @@
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from transformers_cfg.generation.logits_process import GrammarConstrainedLogitsProcessor
+from transformers_cfg.grammar_utils import IncrementalGrammarConstraint
+
+GRAMMAR = 'root ::= "{\\"name\\": \\"" name "\\", \\"age\\": " [0-9]+ "}"\nname ::= "Alice" | "Bob"\n'
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def test_forced_continuation(tokenizer):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    recognizer = grammar.string_recognizer
+    state = recognizer.get_initial_parsing_state()
+    assert recognizer.forced_continuation(state) == '{"name": "'
+    state = recognizer._update_state_with_string('{"name": "B', state)
+    assert recognizer.forced_continuation(state) == 'ob", "age": '
+    # a digit may be followed by another one or by the closing brace
+    state = recognizer._update_state_with_string('ob", "age": 4', state)
+    assert recognizer.forced_continuation(state) == ""
+
+
+def test_jump_forward_tokens(tokenizer):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    state = grammar.string_recognizer.get_initial_parsing_state()
+    token_ids, forced_state = grammar.jump_forward(state)
+    assert tokenizer.decode(token_ids) == '{"name": "'
+    expected = grammar.string_recognizer._update_state_with_string('{"name": "', state)
+    assert forced_state.key() == expected.key()
+
+
+def test_processor_jump_forward(tokenizer):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(grammar)
+    input_ids = tokenizer(["a", "b"], return_tensors="pt").input_ids
+
+    # nothing sampled yet, the whole prefix is forced
+    forced = processor.jump_forward(input_ids)
+    assert forced[0] == forced[1] and tokenizer.decode(forced[0]) == '{"name": "'
+    input_ids = torch.cat([input_ids, torch.tensor(forced)], dim=-1)
+
+    scores = torch.zeros(2, len(tokenizer))
+    # "Alice" or its first piece, depending on the vocabulary
+    alice = tokenizer.encode("Alice")[0]
+    scores[:, alice] = 1.0
+    next_tokens = processor(input_ids, scores).argmax(-1)
+    assert next_tokens.tolist() == [alice, alice]
+    input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+
+    forced = processor.jump_forward(input_ids)
+    assert tokenizer.decode([alice] + forced[0]) == 'Alice", "age": '
+    # appending none of the forced tokens is fine too
+    masked = processor(input_ids, torch.zeros(2, len(tokenizer)))
+    assert torch.isfinite(masked[:, forced[0][0]]).all()
+    assert not torch.isfinite(masked[:, alice]).any()
@@ -0,0 +1,118 @@
+import pytest
+import torch
+from transformers import AutoTokenizer, GPT2Config, GPT2LMHeadModel
+
+from transformers_cfg.generation.logits_process import (
+    AutoModeStats,
+    GrammarConstrainedLogitsProcessor,
+)
+from transformers_cfg.grammar_utils import IncrementalGrammarConstraint
+
+GRAMMAR = 'root ::= "[" [0-9]+ ("," [0-9]+)* "]"'
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+@pytest.fixture(scope="module")
+def model(tokenizer):
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer), n_embd=32, n_layer=1, n_head=2, n_positions=64
+    )
+    return GPT2LMHeadModel(config).eval()
+
+
+def _generate(model, tokenizer, execution_mode):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(
+        grammar, execution_mode=execution_mode
+    )
+    input_ids = tokenizer(["a", "b"], return_tensors="pt").input_ids
+    output = model.generate(
+        input_ids,
+        do_sample=False,
+        max_new_tokens=8,
+        logits_processor=[processor],
+        pad_token_id=tokenizer.eos_token_id,
+    )
+    return output, processor
+
+
+def test_lazy_greedy_matches_full_mask(model, tokenizer):
+    expected, _ = _generate(model, tokenizer, "full_mask")
+    for execution_mode in ["lazy", "speculation", "auto"]:
+        output, _ = _generate(model, tokenizer, execution_mode)
+        assert torch.equal(output, expected)
+
+
+def test_auto_stats(model, tokenizer):
+    _, processor = _generate(model, tokenizer, "auto")
+    stats = processor.auto_stats
+    assert len(stats.positions) > 0
+    assert sum(stats.lazy_rows) + sum(stats.full_mask_rows) == 2 * stats.steps
+    for position in stats.positions.values():
+        assert position.lazy + position.full_mask > 0
+
+
+def test_auto_switches_to_full_mask_where_candidates_fail():
+    stats = AutoModeStats(probe_interval=3)
+    position = (frozenset([0]), False)
+    assert stats.decide(0, position)
+    # candidates were rejected and the mask is cheap: full mask
+    stats.observe(position, check_seconds=1e-3, mask_seconds=1e-4)
+    assert not stats.decide(0, position)
+    stats.observe(position, check_seconds=None, mask_seconds=1e-4)
+    assert stats.switches == 1
+    assert stats.recent_switches[-1] == (0, position, False)
+    # the lazy path is probed again after `probe_interval` full masks
+    assert not stats.decide(0, position)
+    assert not stats.decide(0, position)
+    assert stats.decide(0, position)
+    assert stats.lazy_rows == [2] and stats.full_mask_rows == [3]
+
+
+def test_lazy_stats(tokenizer):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(
+        grammar, execution_mode="lazy", lazy_top_k=4
+    )
+    input_ids = tokenizer(["a", "b"], return_tensors="pt").input_ids
+    bracket = tokenizer.convert_tokens_to_ids("[")
+    scores = torch.zeros(2, len(tokenizer))
+    # row 0: "[" is the second candidate, row 1: no candidate is accepted
+    scores[0, tokenizer.convert_tokens_to_ids("a")] = 2.0
+    scores[0, bracket] = 1.0
+    masked = processor(input_ids, scores)
+
+    assert masked[0, bracket] == 1.0
+    assert torch.isinf(masked[0]).sum() == len(tokenizer) - 1
+    # the full mask of row 1 only accepts "[" and the tokens starting with it
+    assert masked[1, bracket] == 0
+    assert torch.isinf(masked[1, tokenizer.convert_tokens_to_ids("a")])
+    assert processor.lazy_stats.hits == [1, 0]
+    assert processor.lazy_stats.fallbacks == [0, 1]
+    assert processor.lazy_stats.fallback_rate == 0.5
+    # after a fallback, all the candidates are checked again
+    assert processor.lazy_stats.k == 4
+
+    processor.reset()
+    assert processor.lazy_stats.hits == []
+
+
+def test_sample_only_returns_accepted_tokens(tokenizer):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(grammar, execution_mode="lazy")
+    input_ids = tokenizer(["a", "b"], return_tensors="pt").input_ids
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(4):
+        scores = torch.randn(2, len(tokenizer), generator=generator)
+        next_tokens = processor.sample(input_ids, scores, generator=generator)
+        for state, token_id in zip(processor.batch_parsing_states, next_tokens):
+            assert grammar.try_accept_token_id(int(token_id), state)
+        input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+    assert sum(processor.lazy_stats.fallbacks) > 0
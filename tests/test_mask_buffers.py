@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from transformers_cfg.generation.logits_process import GrammarConstrainedLogitsProcessor
+from transformers_cfg.grammar_utils import IncrementalGrammarConstraint
+from transformers_cfg.mask_buffers import MaskBuffers
+from transformers_cfg.vocab_mask import VocabMask
+
+GRAMMAR = 'root ::= "[" [0-9]+ ("," [0-9]+)* "]"'
+
+
+@pytest.mark.parametrize("logits_vocab_size", [130, 140, 100])
+def test_rejected_tokens_are_aligned_to_the_logits(logits_vocab_size):
+    rng = np.random.default_rng(0)
+    masks = [VocabMask.from_bool(rng.random(130) < 0.3) for _ in range(3)]
+    acceptance = VocabMask.batch_to_tensor(masks)
+    expected = torch.ones((3, logits_vocab_size), dtype=torch.bool)
+    n = min(130, logits_vocab_size)
+    expected[:, :n] = ~acceptance[:, :n]
+
+    buffers = MaskBuffers(130, logits_vocab_size)
+    assert torch.equal(buffers.rejected_from_acceptance(acceptance), expected)
+    # packed masks, expanded on the device
+    assert torch.equal(buffers.rejected_from_masks(masks), expected)
+    # smaller batches reuse the same buffers
+    assert torch.equal(buffers.rejected_from_masks(masks[:2]), expected[:2])
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def test_inplace_masks(tokenizer):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    input_ids = tokenizer(["a"], return_tensors="pt").input_ids
+    # the model has a few more logits than the tokenizer has tokens
+    scores = torch.zeros(1, len(tokenizer) + 8)
+
+    processor = GrammarConstrainedLogitsProcessor(grammar)
+    masked = processor(input_ids, scores)
+    assert masked is not scores and torch.isfinite(scores).all()
+    assert torch.isinf(masked[0, len(tokenizer) :]).all()
+
+    processor = GrammarConstrainedLogitsProcessor(grammar, inplace_masks=True)
+    inplace_masked = processor(input_ids, scores)
+    assert inplace_masked is scores
+    assert torch.equal(inplace_masked, masked)
@@ -0,0 +1,50 @@
+import torch
+
+from transformers_cfg.mask_cache import MaskCache
+from transformers_cfg.vocab_mask import VocabMask
+
+
+def _mask(token_id, vocab_size=1000):
+    return VocabMask.from_token_ids(vocab_size, [token_id])
+
+
+def test_lru_eviction_by_bytes():
+    # each mask takes 16 words of 8 bytes
+    cache = MaskCache(max_bytes=3 * 128)
+    for token_id in range(3):
+        cache.put(token_id, _mask(token_id))
+    assert cache.get(0) == _mask(0)
+    cache.put(3, _mask(3))
+
+    # 1 was the least recently used
+    assert 1 not in cache and 0 in cache
+    assert cache.get(1) is None
+    info = cache.cache_info()
+    assert (info.hits, info.misses, info.evictions, info.currsize) == (1, 1, 1, 3)
+    assert info.nbytes == 3 * 128
+
+
+def test_device_tensors_count_towards_budget():
+    cache = MaskCache(max_bytes=2 * 128 + 999)
+    mask = _mask(7)
+    cache.put("a", mask)
+    cache.put("b", _mask(8))
+
+    tensor = cache.to_tensor("a", mask, torch.device("cpu"))
+    assert tensor.dtype == torch.bool and tensor.nonzero().flatten().tolist() == [7]
+    assert cache.to_tensor("a", mask, torch.device("cpu")) is tensor
+    # materializing the tensor of "a" evicted "b"
+    assert "b" not in cache and cache.nbytes == 128 + 1000
+
+
+def test_clear_and_close():
+    cache = MaskCache()
+    cache.put(0, _mask(0))
+    cache.get(0)
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
+    assert cache.cache_info().hits == 0
+
+    cache.close()
+    cache.put(0, _mask(0))
+    assert len(cache) == 0
@@ -0,0 +1,131 @@
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from transformers_cfg.grammar_utils import NonIncrementalGrammarConstraint
+from transformers_cfg.token_grammar_recognizer import DECODE_WINDOW_TOKENS
+
+GRAMMAR = 'root ::= "[" [0-9]+ ("," [0-9]+)* "]"'
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    """Lengths of the texts parsed by the string recognizers."""
+    lengths = []
+    from transformers_cfg.recognizer import StringRecognizer
+
+    update = StringRecognizer._update_state_with_string
+
+    def spy(self, string, parsing_state):
+        lengths.append(len(string))
+        return update(self, string, parsing_state)
+
+    monkeypatch.setattr(StringRecognizer, "_update_state_with_string", spy)
+    return lengths
+
+
+def _expected_key(grammar, text):
+    recognizer = grammar.string_recognizer
+    return recognizer._update_state_with_string(
+        text, recognizer.get_initial_parsing_state()
+    ).key()
+
+
+def _run(grammar, tokenizer, rows, parsed=None):
+    """
+    Update the states with `rows` appended to a prompt and check them against a full parse.
+    Returns the number of characters parsed by the update.
+    """
+    prompt = tokenizer(["a"] * len(rows), return_tensors="pt").input_ids
+    input_ids = torch.cat([prompt, torch.tensor(rows, dtype=torch.long)], dim=-1)
+    start = len(parsed) if parsed is not None else 0
+    states = grammar.update_state_with_batch_token_seqs(input_ids, [None] * len(rows))
+    num_parsed = sum(parsed[start:]) if parsed is not None else 0
+    for state, row in zip(states, rows):
+        assert state.key() == _expected_key(grammar, tokenizer.decode(row))
+    return num_parsed
+
+
+def test_generation_parses_each_token_once(tokenizer, parsed):
+    grammar = NonIncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    tokens = tokenizer.encode("[12,345,6,78,9")
+    _run(grammar, tokenizer, [[]])
+    num_parsed = sum(
+        _run(grammar, tokenizer, [tokens[:length]], parsed)
+        for length in range(1, len(tokens) + 1)
+    )
+    assert num_parsed == len(tokenizer.decode(tokens))
+
+
+def test_edited_sequences(tokenizer, parsed):
+    grammar = NonIncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    _run(grammar, tokenizer, [[], []])
+    tokens = tokenizer.encode("[12,345,6")
+    for length in range(1, len(tokens) + 1):
+        _run(grammar, tokenizer, [tokens[:length], tokens[:length]])
+
+    # rolled back and continued differently, retokenized one character per token
+    rows = [
+        tokenizer.encode("[12,3") + tokenizer.encode("4]"),
+        [tokenizer.convert_tokens_to_ids(c) for c in "[12,345,6"],
+    ]
+    length = min(map(len, rows))
+    rows = [row[:length] for row in rows]
+    num_parsed = _run(grammar, tokenizer, rows, parsed)
+    # both rows resume from checkpoints rather than from the start
+    assert num_parsed < sum(len(tokenizer.decode(row)) for row in rows) - 4
+
+
+def test_checkpoints_are_bounded(tokenizer):
+    grammar = NonIncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    grammar.max_checkpoints = 4
+    tokens = [tokenizer.convert_tokens_to_ids(c) for c in "[1,2,3,4,5,6,7"]
+    _run(grammar, tokenizer, [[]])
+    for length in range(1, len(tokens) + 1):
+        _run(grammar, tokenizer, [tokens[:length]])
+        assert len(grammar.checkpoints[0].offsets) <= 4
+    # a roll back to a thinned out checkpoint
+    _run(grammar, tokenizer, [tokens[:3] + tokenizer.encode("9,") + tokens[5:-2]])
+
+
+def test_generation_decodes_a_window_of_tokens(tokenizer, monkeypatch):
+    grammar = NonIncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    tokens = [
+        tokenizer.convert_tokens_to_ids(c) for c in "[1,2,3,4,5,6,7,8,9,10,11,12]"
+    ]
+    _run(grammar, tokenizer, [[]])
+    decoded = []
+    decode = tokenizer.decode
+
+    def spy(token_ids, *args, **kwargs):
+        decoded.append(len(token_ids))
+        return decode(token_ids, *args, **kwargs)
+
+    monkeypatch.setattr(tokenizer, "decode", spy)
+    prompt = tokenizer(["a"], return_tensors="pt").input_ids
+    for length in range(1, len(tokens) + 1):
+        input_ids = torch.cat([prompt, torch.tensor([tokens[:length]])], dim=-1)
+        (state,) = grammar.update_state_with_batch_token_seqs(input_ids, [None])
+        assert grammar.checkpoints[0].text == decode(tokens[:length])
+    # the tokens before the window aren't decoded again
+    assert max(decoded) <= DECODE_WINDOW_TOKENS + 1
+    assert state.key() == _expected_key(grammar, decode(tokens))
+
+
+def test_decode_window_across_characters(tokenizer):
+    grammar = NonIncrementalGrammarConstraint(
+        "root ::= [ a-zé一-鿿ぁ-ゟァ-ヿ\ufffd]*", "root", tokenizer
+    )
+    # characters split across tokens (partial ones decode to U+FFFD) and rolled back rows
+    tokens = tokenizer.encode("ab 日本語の テキスト " * 4)
+    rows = [tokens[:length] for length in range(len(tokens) + 1)]
+    rows += [tokens[:-5] + tokenizer.encode(" é"), tokens[:-20]]
+    _run(grammar, tokenizer, [[]])
+    for row in rows:
+        _run(grammar, tokenizer, [row])
+        assert grammar.checkpoints[0].text == tokenizer.decode(row)
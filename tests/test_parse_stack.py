@@ -0,0 +1,46 @@
+import copy
+import pickle
+
+from transformers_cfg.parse_stack import EMPTY_STACK, as_stack, push
+from transformers_cfg.parser import parse_ebnf
+from transformers_cfg.recognizer import StringRecognizer
+
+
+def test_push_shares_and_interns():
+    base = as_stack((3, 7))
+    a = push(base, 11)
+    b = push(base, 13)
+    assert a.parent is b.parent is base
+    assert push(base, 11) is a
+    assert as_stack([3, 7, 11]) is a
+    assert tuple(a) == (3, 7, 11) and len(a) == 3 and a[-1] == 11 and a[0] == 3
+    assert as_stack(()) == EMPTY_STACK == ()
+
+
+def test_copies_keep_identity():
+    stack = as_stack((5, 9))
+    assert copy.deepcopy({stack}) == {stack}
+    assert pickle.loads(pickle.dumps(stack)) is stack
+
+
+def test_deeply_nested_json():
+    with open("examples/grammars/json.ebnf", "r") as file:
+        parsed_grammar = parse_ebnf(file.read())
+    recognizer = StringRecognizer(
+        parsed_grammar.grammar_encoding, parsed_grammar.symbol_table["root"]
+    )
+    depth = 200
+    prefix = '{"a": ' + "[" * depth + "1"
+    state = recognizer._update_state_with_string(
+        prefix, recognizer.get_initial_parsing_state()
+    )
+    # the stacks of the state only differ near their heads and share the part below
+    bottoms = set()
+    for stack in state.stacks:
+        assert len(stack) > depth
+        while len(stack) > depth:
+            stack = stack.parent
+        bottoms.add(id(stack))
+    assert len(state.stacks) > 1 and len(bottoms) == 1
+    assert recognizer._accept_string(prefix + "]" * depth + "}")
+    assert not recognizer._accept_string(prefix + "]" * (depth - 1) + "}")
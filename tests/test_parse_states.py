@@ -0,0 +1,48 @@
+import pytest
+from transformers import AutoTokenizer
+
+from transformers_cfg.recognizer import AcceptState, ParseStateTable
+from transformers_cfg.token_grammar_recognizer import IncrementalTokenRecognizer
+from transformers_cfg.utf8_utils import PartialUTF8
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def test_equal_states_are_interned():
+    table = ParseStateTable()
+    first = table.intern(AcceptState({(), ()}, PartialUTF8()))
+    assert table.intern(AcceptState(frozenset([()]), PartialUTF8())) == first
+    assert table.intern(AcceptState({()}, PartialUTF8(1, 2))) != first
+    assert len(table) == 2
+
+
+def test_table_starts_over_when_full():
+    table = ParseStateTable(max_states=2)
+    states = [AcceptState(set(), PartialUTF8(value, 1)) for value in range(3)]
+    next_state = table.transition(states[0], b"a", lambda: states[1])
+    assert table.transition(states[0], b"a", lambda: None) is next_state
+    table.intern(states[2])
+    assert len(table) == 1
+    assert table.transition(states[0], b"a", lambda: states[1]).key() == states[1].key()
+
+
+def test_memoized_transitions(tokenizer):
+    with open("examples/grammars/json.ebnf", "r") as file:
+        grammar_str = file.read()
+    recognizer = IncrementalTokenRecognizer(grammar_str, "root", tokenizer)
+    token_ids = tokenizer.encode('{"a": [1, 1, 1, 1, 1], "b": [1, 1, 1, 1, 1]}')
+
+    state = recognizer.string_recognizer.get_initial_parsing_state()
+    reference = state
+    for token_id in token_ids:
+        state = recognizer._update_state_with_token_id(token_id, state)
+        reference = recognizer.string_recognizer._update_state_with_bytes(
+            recognizer.token2byte_mapping.map(token_id), reference
+        )
+        assert state.key() == reference.key()
+    # the items of the arrays repeat the same transitions
+    assert recognizer.parse_states.hits >= 10
+    assert recognizer.parse_states.misses < len(token_ids)
@@ -0,0 +1,58 @@
+import glob
+import io
+
+import pytest
+
+from transformers_cfg import compiled_grammar
+from transformers_cfg.compiled_grammar import (
+    load_compiled,
+    parse_ebnf_cached,
+    save_compiled,
+)
+from transformers_cfg.parser import parse_ebnf
+
+
+@pytest.mark.parametrize(
+    "grammar_file", sorted(glob.glob("examples/grammars/**/*.ebnf", recursive=True))
+)
+def test_save_and_load_compiled(grammar_file):
+    with open(grammar_file, "r") as file:
+        parsed_grammar = parse_ebnf(file.read())
+
+    buffer = io.BytesIO()
+    save_compiled(parsed_grammar, buffer)
+    buffer.seek(0)
+    loaded = load_compiled(buffer)
+
+    assert loaded.grammar_encoding == parsed_grammar.grammar_encoding
+    assert loaded.rule_offsets == parsed_grammar.rule_offsets
+    assert loaded.symbol_table == parsed_grammar.symbol_table
+    # the rules are rebuilt from the encoding
+    for rule_id, rule in parsed_grammar.grammar_rules.items():
+        assert loaded.get_rule_by_id(rule_id).name == rule.name
+        assert loaded.get_rule_by_id(rule_id).serialize() == rule.serialize()
+
+
+def test_load_compiled_rejects_bad_input():
+    with pytest.raises(ValueError):
+        load_compiled(io.BytesIO(b"not a grammar"))
+
+
+def test_parse_ebnf_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        compiled_grammar, "_parsed_grammars", type(compiled_grammar._parsed_grammars)()
+    )
+    grammar_str = 'root ::= "The animal is a " animal "."\nanimal ::= "cat" | "fish"\n'
+
+    parsed_grammar = parse_ebnf_cached(grammar_str, cache_dir=str(tmp_path))
+    assert parse_ebnf_cached(grammar_str, cache_dir=str(tmp_path)) is parsed_grammar
+    assert len(list((tmp_path / "grammars").iterdir())) == 1
+
+    # a new process loads the compiled grammar instead of parsing it
+    monkeypatch.setattr(
+        compiled_grammar, "_parsed_grammars", type(compiled_grammar._parsed_grammars)()
+    )
+    monkeypatch.setattr(compiled_grammar, "parse_ebnf", None)
+    loaded = parse_ebnf_cached(grammar_str, cache_dir=str(tmp_path))
+    assert loaded is not parsed_grammar
+    assert loaded.grammar_encoding == parsed_grammar.grammar_encoding
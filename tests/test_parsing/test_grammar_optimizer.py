@@ -0,0 +1,147 @@
+import glob
+import random
+
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from transformers_cfg.grammar_optimizer import OPTIMIZATION_PASSES, optimize_grammar
+from transformers_cfg.parser import parse_ebnf
+from transformers_cfg.recognizer import AcceptState, StringRecognizer
+from transformers_cfg.token_grammar_recognizer import IncrementalTokenRecognizer
+
+# printable ASCII, whitespace and a few non-ASCII chars
+ALPHABET = [9, 10, *range(32, 127), 0xE9, 0x4E2D, 0x1F600]
+
+
+def _recognizer(parsed_grammar, start_rule_name="root"):
+    return StringRecognizer(
+        parsed_grammar.grammar_encoding, parsed_grammar.symbol_table[start_rule_name]
+    )
+
+
+def _assert_equivalent(parsed_grammar, optimized, walks=5, steps=20, seed=0):
+    """Both grammars accept the same chars along random walks, and can stop at the same places."""
+    original, rewritten = _recognizer(parsed_grammar), _recognizer(optimized)
+    rng = random.Random(seed)
+    for _ in range(walks):
+        state = original.get_initial_parsing_state()
+        optimized_state = rewritten.get_initial_parsing_state()
+        for _ in range(steps):
+            assert state.can_stop() == optimized_state.can_stop()
+            accepted = []
+            for code_point in ALPHABET:
+                stacks = original._update_state_with_code_point_for_all_stacks(
+                    code_point, frozenset(state.stacks)
+                )
+                optimized_stacks = (
+                    rewritten._update_state_with_code_point_for_all_stacks(
+                        code_point, frozenset(optimized_state.stacks)
+                    )
+                )
+                assert bool(stacks) == bool(optimized_stacks), chr(code_point)
+                if stacks:
+                    accepted.append((stacks, optimized_stacks))
+            if not accepted:
+                break
+            stacks, optimized_stacks = rng.choice(accepted)
+            state = AcceptState(stacks, state.partial_utf8)
+            optimized_state = AcceptState(
+                optimized_stacks, optimized_state.partial_utf8
+            )
+
+
+@pytest.mark.parametrize(
+    "grammar_file", sorted(glob.glob("examples/grammars/**/*.ebnf", recursive=True))
+)
+def test_optimized_grammar_is_equivalent(grammar_file):
+    with open(grammar_file, "r") as file:
+        parsed_grammar = parse_ebnf(file.read())
+    if "root" not in parsed_grammar.symbol_table:
+        pytest.skip("no root rule")
+    encoding = list(parsed_grammar.grammar_encoding)
+
+    optimized = optimize_grammar(parsed_grammar, "root")
+
+    _assert_equivalent(parsed_grammar, optimized)
+    # the parsed grammar is shared through the grammar cache, it must not change
+    assert parsed_grammar.grammar_encoding == encoding
+
+
+def test_merge_ranges_and_inline():
+    parsed_grammar = parse_ebnf(
+        'root ::= [a-c] x | [b-f] x | "g" x\nx ::= "y"\nunused ::= "z"\n'
+    )
+    optimized = optimize_grammar(parsed_grammar, "root")
+
+    # root ::= [a-g] "y"
+    root = optimized.get_rule_by_id(optimized.symbol_table["root"])
+    assert root.serialize() == [
+        optimized.symbol_table["root"],
+        *[7, 2, ord("a"), ord("g"), 2, ord("y"), ord("y"), 0],
+        0,
+    ]
+    assert list(optimized.grammar_rules) == [optimized.symbol_table["root"]]
+    # the names of the rules that were removed keep their ids
+    assert optimized.symbol_table == parsed_grammar.symbol_table
+
+
+def _num_stacks(parsed_grammar, text):
+    recognizer = _recognizer(parsed_grammar)
+    state = recognizer.get_initial_parsing_state()
+    return len(recognizer._update_state_with_string(text, state).stacks)
+
+
+def test_left_factor_and_dedupe():
+    grammar_str = 'root ::= "abc" x "!" | "abd" y "?"\nx ::= [0-9]+\ny ::= [0-9]+\n'
+    parsed_grammar = parse_ebnf(grammar_str)
+    optimized = optimize_grammar(parsed_grammar, "root")
+    _assert_equivalent(parsed_grammar, optimized)
+
+    # the common "ab" is matched once
+    assert _num_stacks(parsed_grammar, "a") == 2
+    assert _num_stacks(optimized, "a") == 1
+    # x and y are the same rule
+    assert len(optimized.grammar_rules) < len(parsed_grammar.grammar_rules)
+
+
+@pytest.mark.parametrize("name", OPTIMIZATION_PASSES)
+def test_single_pass(name):
+    with open("examples/grammars/json.ebnf", "r") as file:
+        parsed_grammar = parse_ebnf(file.read())
+    _assert_equivalent(parsed_grammar, optimize_grammar(parsed_grammar, passes=[name]))
+
+
+def test_unknown_pass_and_start_rule():
+    parsed_grammar = parse_ebnf('root ::= "a"\n')
+    with pytest.raises(ValueError):
+        optimize_grammar(parsed_grammar, passes=["fold_constants"])
+    assert optimize_grammar(parsed_grammar, "missing") is parsed_grammar
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def test_optimized_recognizer(tokenizer):
+    with open("examples/grammars/json.ebnf", "r") as file:
+        grammar_str = file.read()
+    recognizer = IncrementalTokenRecognizer(grammar_str, "root", tokenizer)
+    optimized = IncrementalTokenRecognizer(
+        grammar_str, "root", tokenizer, optimize=True
+    )
+    assert optimized.optimize and not recognizer.optimize
+
+    state = recognizer.string_recognizer.get_initial_parsing_state()
+    optimized_state = optimized.string_recognizer.get_initial_parsing_state()
+    for token_id in tokenizer.encode('{"a": [1, true]}'):
+        assert torch.equal(
+            recognizer.filter_vocab(state, "cpu"),
+            optimized.filter_vocab(optimized_state, "cpu"),
+        )
+        state = recognizer._update_state_with_token_id(token_id, state)
+        optimized_state = optimized._update_state_with_token_id(
+            token_id, optimized_state
+        )
+    assert state.can_stop() and optimized_state.can_stop()
@@ -408,3 +408,23 @@ def test__parse_rhs_repetition_operator_plus():
     )
     logging.debug(f"outbuf: {rule.serialize()}")
     logging.debug(f"parse_simple_rhs: {state.grammar_encoding}")
+
+
+def test_parse_errors_have_line_and_column(caplog):
+    from transformers_cfg.parser import parse_ebnf
+
+    src = 'root ::= "a" item\nitem ::= [a-z\n'
+    with caplog.at_level(logging.WARNING, logger="transformers_cfg"):
+        state = parse_ebnf(src)
+    assert not state.grammar_rules
+    assert "at line 2, column 10" in caplog.text
+
+
+def test_crlf_line_endings():
+    from transformers_cfg.parser import parse_ebnf
+
+    src = 'root ::= "a" item # comment\nitem ::= [a-z]+ | "b"\n'
+    state = parse_ebnf(src)
+    crlf_state = parse_ebnf(src.replace("\n", "\r\n"))
+    assert crlf_state.grammar_encoding == state.grammar_encoding
+    assert crlf_state.symbol_table == state.symbol_table
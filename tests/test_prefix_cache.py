@@ -0,0 +1,54 @@
+import pytest
+from transformers import AutoTokenizer
+
+from transformers_cfg.grammar_utils import IncrementalGrammarConstraint
+from transformers_cfg.prefix_cache import PrefixStateCache, get_prefix_state_cache
+
+GRAMMAR = 'root ::= ("item: " [a-z]+ "\\n")* "answer: " [0-9]+'
+SHARED = "".join(f"item: {word}\n" for word in ["apple", "pear", "plum", "fig"] * 10)
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def _first_call(grammar, tokenizer, text):
+    """State after `text`, parsed as the prompt prefix of a request."""
+    input_ids = [tokenizer.encode(text)]
+    initial_state = grammar.string_recognizer.get_initial_parsing_state()
+    (state,) = grammar.update_state_with_batch_token_seqs(input_ids, [initial_state], 0)
+    return state
+
+
+def test_requests_share_their_prefix(tokenizer):
+    cache = PrefixStateCache()
+    texts = [SHARED + "item: kiwi\nanswer: 1", SHARED + "item: lime\nitem: date\n"]
+    for i, text in enumerate(texts):
+        # a recognizer per request, as separate processes of a server would
+        grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+        assert grammar.prefix_cache is get_prefix_state_cache()
+        grammar.prefix_cache = cache
+        state = _first_call(grammar, tokenizer, text)
+        assert state.stacks
+
+        uncached = IncrementalGrammarConstraint(
+            GRAMMAR, "root", tokenizer, use_prefix_cache=False
+        )
+        assert uncached.prefix_cache is None
+        assert state.key() == _first_call(uncached, tokenizer, text).key()
+
+    info = cache.info()
+    assert info.misses == 1 and info.hits == 1
+    # the second request only parsed its tail and the end of the last shared block
+    assert info.reused_chars > len(SHARED) - cache.block_chars
+    assert (
+        info.parsed_chars
+        < len(texts[0]) + len(texts[1]) - len(SHARED) + cache.block_chars
+    )
+
+    # other grammars don't see the states
+    grammar = IncrementalGrammarConstraint(GRAMMAR + ' " "?', "root", tokenizer)
+    grammar.prefix_cache = cache
+    _first_call(grammar, tokenizer, SHARED)
+    assert cache.info().misses == 2
@@ -0,0 +1,59 @@
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from transformers_cfg.generation.logits_process import GrammarConstrainedLogitsProcessor
+from transformers_cfg.generation.stats import StepStats
+from transformers_cfg.grammar_utils import IncrementalGrammarConstraint
+
+GRAMMAR = 'root ::= "[" [0-9]+ ("," [0-9]+)* "]"'
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def _run(processor, tokenizer, steps=3):
+    input_ids = tokenizer(["a", "b"], return_tensors="pt").input_ids
+    bracket = tokenizer.convert_tokens_to_ids("[")
+    digit = tokenizer.convert_tokens_to_ids("1")
+    scores = torch.zeros(2, len(tokenizer))
+    for token_id in [bracket, digit, digit][:steps]:
+        processor(input_ids, scores)
+        input_ids = torch.cat([input_ids, torch.full((2, 1), token_id)], dim=-1)
+
+
+def test_no_stats_by_default(tokenizer, capsys):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(grammar)
+    capsys.readouterr()
+    _run(processor, tokenizer)
+    assert processor.stats is None
+    # the hot path doesn't print anything
+    assert capsys.readouterr().out == ""
+
+
+def test_stats_and_callback(tokenizer):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    steps = []
+    processor = GrammarConstrainedLogitsProcessor(grammar, stats_callback=steps.append)
+    _run(processor, tokenizer)
+
+    stats = processor.stats
+    assert stats.steps == 3 and len(steps) == 3
+    assert all(isinstance(step, StepStats) for step in steps)
+    assert [step.step for step in steps] == [0, 1, 2]
+    assert stats.last is steps[-1]
+    for step in steps:
+        assert len(step.num_stacks) == 2 and min(step.num_stacks) > 0
+        assert step.state_update_seconds >= 0 and step.apply_seconds > 0
+    # both rows share their state, the mask is computed once and then found in the cache
+    assert stats.mask_cache_misses > 0
+    assert stats.trie_nodes_visited > 0
+    assert 0 <= stats.mask_cache_hit_rate <= 1
+    assert stats.total_seconds == pytest.approx(
+        sum(step.total_seconds for step in steps)
+    )
+    exported = stats.as_dict()
+    assert exported["steps"] == 3 and "last" not in exported
@@ -0,0 +1,106 @@
+import logging
+
+import numpy as np
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from transformers_cfg.generation.logits_process import GrammarConstrainedLogitsProcessor
+from transformers_cfg.grammar_utils import IncrementalGrammarConstraint
+from transformers_cfg.token_grammar_recognizer import IncrementalTokenRecognizer
+
+GRAMMAR = 'root ::= "[" [0-9]+ ("," [0-9]+)* "]"'
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+@pytest.fixture
+def updates(monkeypatch):
+    """Tokens the recognizers update a state with."""
+    token_ids = []
+    update = IncrementalTokenRecognizer._update_state_with_token_id
+
+    def spy(self, token_id, parsing_state):
+        token_ids.append(int(token_id))
+        return update(self, token_id, parsing_state)
+
+    monkeypatch.setattr(IncrementalTokenRecognizer, "_update_state_with_token_id", spy)
+    return token_ids
+
+
+def _tokens(tokenizer, text):
+    return [tokenizer.convert_tokens_to_ids(c) for c in text]
+
+
+def _masked(processor, tokenizer, prompt, generated):
+    input_ids = torch.tensor([prompt + generated])
+    return processor(input_ids, torch.zeros(1, len(tokenizer)))
+
+
+def _expected(tokenizer, prompt, generated):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(grammar, len(prompt))
+    return _masked(processor, tokenizer, prompt, generated)
+
+
+def test_rollback_and_jump(tokenizer, updates):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(grammar)
+    prompt = tokenizer.encode("numbers:")
+    tokens = _tokens(tokenizer, "[1,23,45,6")
+    for length in range(len(tokens) + 1):
+        _masked(processor, tokenizer, prompt, tokens[:length])
+
+    # rolled back by 4 tokens, nothing to parse
+    del updates[:]
+    masked = _masked(processor, tokenizer, prompt, tokens[:-4])
+    assert updates == []
+    assert torch.equal(masked, _expected(tokenizer, prompt, tokens[:-4]))
+
+    # jumps forward, only the new tokens are parsed
+    edited = tokens[:-4] + _tokens(tokenizer, "7,8,9")
+    del updates[:]
+    masked = _masked(processor, tokenizer, prompt, edited)
+    assert updates == edited[-5:]
+    assert torch.equal(masked, _expected(tokenizer, prompt, edited))
+
+    # and continues one token at a time
+    edited += _tokens(tokenizer, "]")
+    masked = _masked(processor, tokenizer, prompt, edited)
+    assert torch.equal(masked, _expected(tokenizer, prompt, edited))
+
+
+def test_other_prompt_requires_reset(tokenizer):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(grammar)
+    _masked(processor, tokenizer, tokenizer.encode("numbers:"), [])
+    with pytest.raises(ValueError):
+        _masked(processor, tokenizer, tokenizer.encode("digits:"), [])
+
+
+def test_llama_cpp_adapter_resumes(tokenizer, updates, caplog):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(grammar, adapter="llama-cpp-python")
+    prompt = tokenizer.encode("numbers:")
+    tokens = _tokens(tokenizer, "[1,23")
+    for length in range(len(tokens) + 1):
+        processor(np.array(prompt + tokens[:length]), np.zeros(len(tokenizer)))
+
+    # llama.cpp rolls back 2 tokens
+    del updates[:]
+    scores = processor(np.array(prompt + tokens[:-2]), np.zeros(len(tokenizer)))
+    assert updates == []
+    expected = _expected(tokenizer, prompt, tokens[:-2])[0]
+    assert np.array_equal(scores, expected.numpy())
+
+    # a new completion with another prompt starts over
+    with caplog.at_level(logging.INFO, logger="transformers_cfg"):
+        scores = processor(
+            np.array(tokenizer.encode("digits:")), np.zeros(len(tokenizer))
+        )
+    assert "Starting a new sequence" in caplog.text
+    expected = _expected(tokenizer, tokenizer.encode("digits:"), [])[0]
+    assert np.array_equal(scores, expected.numpy())
@@ -0,0 +1,106 @@
+import gc
+import weakref
+
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from transformers_cfg.token_grammar_recognizer import (
+    IncrementalTokenRecognizer,
+    check_token_acceptance_in_trie,
+)
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def _legacy_acceptance(recognizer, stack):
+    accepts = [False] * len(recognizer.token2byte_mapping)
+    check_token_acceptance_in_trie(
+        recognizer.byte_trie.root,
+        [stack],
+        recognizer.string_recognizer,
+        recognizer.eos_token_id,
+        accepts,
+    )
+    return torch.tensor(accepts, dtype=torch.bool)
+
+
+def test_compiled_acceptance_matches_trie_walk(tokenizer):
+    with open("examples/grammars/json.ebnf", "r") as file:
+        grammar_str = file.read()
+    recognizer = IncrementalTokenRecognizer(grammar_str, "root", tokenizer)
+
+    parsing_state = recognizer.string_recognizer.get_initial_parsing_state()
+    for token_id in tokenizer.encode('{"foo": [1, 2.5, "bar"], "baz": {"a": null}}'):
+        for stack in parsing_state.stacks:
+            compiled = recognizer.token_acceptance_engine.get_token_acceptance(
+                stack, parsing_state.partial_utf8
+            ).to_tensor()
+            assert torch.equal(compiled, _legacy_acceptance(recognizer, stack))
+        parsing_state = recognizer._update_state_with_token_id(token_id, parsing_state)
+
+
+def test_precompile(tokenizer):
+    grammar_str = 'root ::= "The animal is a " animal "."\nanimal ::= "cat" | "fish"\n'
+    recognizer = IncrementalTokenRecognizer(
+        grammar_str, "root", tokenizer, precompile=True
+    )
+    engine = recognizer.token_acceptance_engine
+    assert len(engine) == len(engine.terminal_element_offsets())
+
+    parsing_state = recognizer._update_state_with_single_token_seq(
+        tokenizer.encode("The animal is a"), as_string=False
+    )
+    acceptance = recognizer.filter_vocab(parsing_state, torch.device("cpu"))
+    assert acceptance[tokenizer.encode(" cat")[0]]
+    assert acceptance[tokenizer.encode(" fish")[0]]
+    assert not acceptance[tokenizer.encode(" dog")[0]]
+    assert not acceptance[tokenizer.eos_token_id]
+
+
+def test_engine_is_freed_with_its_recognizer(tokenizer):
+    with open("examples/grammars/json.ebnf", "r") as file:
+        grammar_str = file.read()
+    recognizer = IncrementalTokenRecognizer(grammar_str, "root", tokenizer)
+    engine = recognizer.token_acceptance_engine
+    parsing_state = recognizer._update_state_with_single_token_seq(
+        tokenizer.encode('{"foo": [1'), as_string=False
+    )
+    expected = recognizer.filter_vocab(parsing_state, torch.device("cpu"))
+    assert len(engine) > 0 and engine._byte_steps
+
+    engine.clear()
+    assert len(engine) == 0 and not engine._byte_steps
+    assert torch.equal(
+        recognizer.filter_vocab(parsing_state, torch.device("cpu")), expected
+    )
+
+    # no reference cycle either, the engine is freed without the garbage collector
+    engine_ref = weakref.ref(engine)
+    gc.disable()
+    try:
+        del recognizer, engine, parsing_state
+        assert engine_ref() is None
+    finally:
+        gc.enable()
+
+
+def test_close_releases_the_engine_caches(tokenizer):
+    recognizer = IncrementalTokenRecognizer('root ::= "a" [0-9]+', "root", tokenizer)
+    parsing_state = recognizer._update_state_with_single_token_seq(
+        tokenizer.encode("a1"), as_string=False
+    )
+    expected = recognizer.filter_vocab(parsing_state, torch.device("cpu"))
+    engine = recognizer.token_acceptance_engine
+    assert len(engine) > 0
+
+    recognizer.close()
+    assert len(engine) == 0 and not engine._byte_steps
+    assert recognizer.mask_cache.cache_info().currsize == 0
+    assert len(recognizer.parse_states) == 0
+    assert torch.equal(
+        recognizer.filter_vocab(parsing_state, torch.device("cpu")), expected
+    )
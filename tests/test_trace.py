@@ -0,0 +1,63 @@
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from transformers_cfg.generation.logits_process import GrammarConstrainedLogitsProcessor
+from transformers_cfg.generation.trace import DecodingTrace, replay
+from transformers_cfg.grammar_utils import IncrementalGrammarConstraint
+
+GRAMMAR = 'root ::= "[" [0-9]+ ("," [0-9]+)* "]"'
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def _generate(tokenizer, steps=6, prompts=("a", "b"), valid_token_start_idx=None):
+    grammar = IncrementalGrammarConstraint(GRAMMAR, "root", tokenizer)
+    processor = GrammarConstrainedLogitsProcessor(
+        grammar, valid_token_start_idx=valid_token_start_idx
+    )
+    input_ids = tokenizer(list(prompts), return_tensors="pt").input_ids
+    sequences = input_ids
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(steps):
+        scores = torch.randn((2, len(tokenizer)), generator=generator)
+        next_tokens = processor(sequences, scores).argmax(-1)
+        sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+    return processor, input_ids, sequences
+
+
+def test_trace_roundtrip(tokenizer, tmp_path):
+    processor, input_ids, sequences = _generate(tokenizer)
+    trace = DecodingTrace.from_generation(processor, input_ids, sequences, run="test")
+    path = str(tmp_path / "trace.json.gz")
+    trace.save(path)
+    loaded = DecodingTrace.load(path)
+    assert loaded == trace
+    assert loaded.grammar_str == GRAMMAR and loaded.num_steps == 6
+    assert loaded.metadata == {"run": "test"}
+
+
+def test_replay(tokenizer):
+    processor, input_ids, sequences = _generate(tokenizer)
+    trace = DecodingTrace.from_generation(processor, input_ids, sequences)
+    report = replay(trace, tokenizer, recorded_token_boost=10.0)
+    summary = report.summary()
+    assert summary["steps"] == 6
+    assert summary["step"]["p50_ms"] <= summary["step"]["max_ms"]
+    assert len(report.mask_seconds) == 6 and len(summary["slowest_steps"]) == 5
+    # the recorded tokens are accepted again with another execution mode
+    assert replay(trace, tokenizer, execution_mode="lazy").summary()["steps"] == 6
+
+
+def test_replay_parses_the_prompt(tokenizer):
+    # the prompts are the start of the list, the generated tokens only continue it
+    processor, input_ids, sequences = _generate(
+        tokenizer, prompts=("[1", "[2"), valid_token_start_idx=0
+    )
+    trace = DecodingTrace.from_generation(processor, input_ids, sequences)
+    assert trace.valid_token_start_idx == 0
+    report = replay(trace, tokenizer, recorded_token_boost=10.0)
+    assert report.summary()["steps"] == 6
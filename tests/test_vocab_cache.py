@@ -0,0 +1,71 @@
+import logging
+
+import numpy as np
+import pytest
+from transformers import AutoTokenizer
+
+from transformers_cfg.tokenization.byte_trie import ByteTrie
+from transformers_cfg.tokenization import vocab_cache
+from transformers_cfg.tokenization.mapping.token2byte import Token2ByteMapping
+from transformers_cfg.tokenization.vocab_cache import (
+    VocabArtifact,
+    load_vocab_artifact,
+    tokenizer_fingerprint,
+)
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def test_save_and_load(tokenizer, tmp_path):
+    artifact = VocabArtifact.build(tokenizer)
+    artifact.save(str(tmp_path / "artifact"))
+    loaded = VocabArtifact.load(str(tmp_path / "artifact"))
+
+    assert loaded.fingerprint == tokenizer_fingerprint(tokenizer)
+    mapping = Token2ByteMapping.from_hf_tokenizer(tokenizer, use_cache=False)
+    for token_id in [0, 1, 100, 1000, len(mapping) - 1]:
+        assert loaded.token_bytes[token_id] == mapping.map(token_id)
+
+    trie = ByteTrie.from_tokenizer(tokenizer, use_cache=False)
+    for name, array in trie.to_arrays().items():
+        assert np.array_equal(getattr(loaded.trie, name), array)
+    assert len(loaded.trie) == len(trie)
+
+
+def test_load_vocab_artifact(tokenizer, tmp_path, monkeypatch):
+    monkeypatch.setattr(vocab_cache, "_artifacts", {})
+    artifact = load_vocab_artifact(tokenizer, cache_dir=str(tmp_path))
+    assert (tmp_path / "vocab" / artifact.fingerprint / "meta.json").exists()
+    # loaded once per process
+    assert load_vocab_artifact(tokenizer, cache_dir=str(tmp_path)) is artifact
+
+    # a new process loads the saved artifact
+    monkeypatch.setattr(vocab_cache, "_artifacts", {})
+    loaded = load_vocab_artifact(tokenizer, cache_dir=str(tmp_path))
+    assert loaded is not artifact
+    assert np.array_equal(loaded.trie.token_order, artifact.trie.token_order)
+
+
+def test_corrupted_cache_is_repaired(tokenizer, tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(vocab_cache, "_artifacts", {})
+    artifact = load_vocab_artifact(tokenizer, cache_dir=str(tmp_path))
+    path = tmp_path / "vocab" / artifact.fingerprint / "trie_token_order.npy"
+    path.write_bytes(path.read_bytes()[: path.stat().st_size // 2])
+
+    monkeypatch.setattr(vocab_cache, "_artifacts", {})
+    with caplog.at_level(logging.WARNING, logger=vocab_cache.__name__):
+        rebuilt = load_vocab_artifact(tokenizer, cache_dir=str(tmp_path))
+    assert "corrupted" in caplog.text
+    assert np.array_equal(rebuilt.trie.token_order, artifact.trie.token_order)
+
+    # the broken copy was replaced, the next process loads it without a warning
+    caplog.clear()
+    monkeypatch.setattr(vocab_cache, "_artifacts", {})
+    with caplog.at_level(logging.WARNING, logger=vocab_cache.__name__):
+        loaded = load_vocab_artifact(tokenizer, cache_dir=str(tmp_path))
+    assert caplog.text == ""
+    assert np.array_equal(loaded.trie.token_order, artifact.trie.token_order)
+    assert [p.name for p in (tmp_path / "vocab").iterdir()] == [artifact.fingerprint]
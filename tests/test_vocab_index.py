@@ -0,0 +1,70 @@
+import gc
+import weakref
+
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from transformers_cfg.token_grammar_recognizer import IncrementalTokenRecognizer
+from transformers_cfg.tokenization.vocab_index import VocabularyIndex
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return AutoTokenizer.from_pretrained("gpt2")
+
+
+def test_index_shared_across_grammars(tokenizer):
+    index = VocabularyIndex.from_tokenizer(tokenizer)
+    assert VocabularyIndex.from_tokenizer(tokenizer) is index
+    assert index.eos_token_id == tokenizer.eos_token_id
+
+    digits = IncrementalTokenRecognizer(
+        "root ::= [0-9]+", "root", tokenizer, vocab_index=index
+    )
+    letters = IncrementalTokenRecognizer("root ::= [a-z]+", "root", tokenizer)
+    assert digits.vocab_index is index and letters.vocab_index is index
+    assert digits.byte_trie is letters.byte_trie is index.byte_trie
+    # mappings keep per-sequence state, only the token bytes are shared
+    assert digits.token2byte_mapping is not letters.token2byte_mapping
+    assert digits.token2byte_mapping.token_bytes_table is index.token_bytes
+
+
+def test_masks_unchanged(tokenizer):
+    index = VocabularyIndex.from_tokenizer(tokenizer)
+    shared = IncrementalTokenRecognizer(
+        'root ::= "foo" [0-9]*', "root", tokenizer, vocab_index=index
+    )
+    own = IncrementalTokenRecognizer(
+        'root ::= "foo" [0-9]*',
+        "root",
+        tokenizer,
+        trie=index.byte_trie,
+        homomorphism=index.new_token2byte_mapping(),
+    )
+    masks = []
+    for recognizer in (shared, own):
+        state = recognizer.string_recognizer.get_initial_parsing_state()
+        for token_id in tokenizer.encode("foo1"):
+            state = recognizer._update_state_with_token_id(token_id, state)
+        masks.append(recognizer.filter_vocab(state, torch.device("cpu")))
+    assert torch.equal(masks[0], masks[1])
+    assert masks[0].sum() > 0
+
+
+def test_index_does_not_keep_its_tokenizer_alive():
+    tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    index = VocabularyIndex.from_tokenizer(tokenizer)
+    recognizer = IncrementalTokenRecognizer(
+        "root ::= [0-9]+", "root", tokenizer, vocab_index=index
+    )
+    assert index.tokenizer is tokenizer
+    assert recognizer.token2byte_mapping.tokenizer is tokenizer
+
+    tokenizer_ref = weakref.ref(tokenizer)
+    del tokenizer, recognizer
+    gc.collect()
+    assert tokenizer_ref() is None
+    assert index.tokenizer is None
+    with pytest.raises(RuntimeError):
+        index.new_token2byte_mapping()
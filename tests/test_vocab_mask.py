@@ -0,0 +1,49 @@
+import numpy as np
+import torch
+
+from transformers_cfg.vocab_mask import VocabMask
+
+
+def test_round_trip():
+    acceptance = np.random.RandomState(0).rand(1000) > 0.7
+    mask = VocabMask.from_bool(acceptance)
+    assert len(mask.words) == 16
+    assert np.array_equal(mask.to_bool_array(), acceptance)
+    assert mask.count() == acceptance.sum()
+    assert np.array_equal(mask.token_ids(), np.flatnonzero(acceptance))
+
+
+def test_element_access():
+    mask = VocabMask.zeros(130)
+    mask[0] = True
+    mask[64] = True
+    mask[129] = True
+    assert mask[0] and mask[64] and mask[129]
+    assert not mask[1] and not mask[63] and not mask[128]
+    mask[64] = False
+    assert not mask[64]
+    assert mask == VocabMask.from_token_ids(130, [0, 129])
+
+
+def test_set_operations():
+    a = VocabMask.from_token_ids(200, [1, 2, 3, 150])
+    b = VocabMask.from_token_ids(200, [3, 4, 199])
+    assert (a | b).token_ids().tolist() == [1, 2, 3, 4, 150, 199]
+    assert (a & b).token_ids().tolist() == [3]
+    union = VocabMask.union([a, b, VocabMask.from_token_ids(200, [0])])
+    assert union.token_ids().tolist() == [0, 1, 2, 3, 4, 150, 199]
+    # union never aliases its inputs
+    assert VocabMask.union([a]) is not a
+    assert a.token_ids().tolist() == [1, 2, 3, 150]
+
+
+def test_batch_to_tensor():
+    masks = [
+        VocabMask.from_token_ids(70, [0, 69]),
+        VocabMask.zeros(70),
+        VocabMask.from_token_ids(70, [5]),
+    ]
+    acceptance = VocabMask.batch_to_tensor(masks)
+    assert acceptance.shape == (3, 70)
+    assert acceptance.dtype == torch.bool
+    assert acceptance.nonzero().tolist() == [[0, 0], [0, 69], [2, 5]]
@@ -29,6 +29,12 @@ def llama_cpp_python(processor):
             mask[eos_token] = 0
         return mask
     
+    def _as_output(processed_scores):
+        # Remove the batch dimension if present
+        if processed_scores.dim() == 2 and processed_scores.size(0) == 1:
+            processed_scores = processed_scores.squeeze(0)
+        return processed_scores.detach().cpu().numpy()
+
     def adapter_func(input_ids, scores):
         nonlocal reinit_attempts, accumulated_tokens
         
@@ -64,16 +70,29 @@ def llama_cpp_python(processor):
             except Exception:
                 logger.debug(f"Added token: {new_token} (cannot decode)")
                 
-        # Check for consistency: if the length of our input token sequence
-        # does not match what the grammar expects, then reinitialize
+        # The input usually continues the previous one by a single token. Otherwise (llama.cpp reusing
+        # its prompt cache, rolled back or skipped tokens), the processor resumes from the checkpoint of
+        # the longest prefix it has seen: a rollback of k tokens costs k, a jump only parses the new tokens
         current_length = len(input_ids[0])
-        if hasattr(processor.grammar_constraint, "last_size") and processor.grammar_constraint.last_size is not None:
-            expected_length = processor.grammar_constraint.last_size + 1
-            if current_length != expected_length:
-                logger.warning(f"Length mismatch: current={current_length}, expected={expected_length}. Reinitializing.")
+        # processor.last_size ignores a prefetch still running in the background
+        if (
+            processor.last_size is not None
+            and current_length != processor.last_size + 1
+        ):
+            logger.debug(
+                f"Length mismatch: current={current_length}, expected={processor.last_size + 1}. "
+                "Resuming from the longest known prefix."
+            )
+            try:
+                processed_scores = processor.process_logits(input_ids, scores)
+            except ValueError as e:
+                # not a continuation of the previous sequence (new prompt, next chat turn, ...)
+                logger.info(f"Starting a new sequence: {e}")
                 processor.reset()
+            else:
                 reinit_attempts = 0
-                
+                return _as_output(processed_scores)
+
         try:
             processed_scores = processor.process_logits(input_ids, scores)
             reinit_attempts = 0
@@ -99,9 +118,6 @@ def llama_cpp_python(processor):
                 logger.error(f"Unexpected error: {error_msg}")
                 raise e
                 
-        # Remove the batch dimension if present
-        if processed_scores.dim() == 2 and processed_scores.size(0) == 1:
-            processed_scores = processed_scores.squeeze(0)
-        return processed_scores.detach().cpu().numpy()
+        return _as_output(processed_scores)
     
     return adapter_func
@@ -0,0 +1,160 @@
+"""
+Binary format for parsed grammars and a content-addressed grammar cache.
+
+A compiled grammar is the little-endian header `TCFG | format version | #encoding | #rule offsets | #symbol table bytes`
+(five uint32 after the magic), followed by the grammar encoding and the rule offsets as int32 arrays
+and the symbol table and rule names as UTF-8 JSON.
+
+`parse_ebnf_cached` parses each distinct grammar text once per process, and once across processes
+through `$TCFG_CACHE_DIR/grammars` (see `transformers_cfg.utils.get_cache_dir`).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+from collections import OrderedDict
+from typing import BinaryIO, Optional, Union
+
+import numpy as np
+
+from transformers_cfg import __version__
+from transformers_cfg.parser import ParseState, parse_ebnf
+from transformers_cfg.utils import get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+COMPILED_GRAMMAR_MAGIC = b"TCFG"
+# bump when the layout of the format changes
+COMPILED_GRAMMAR_VERSION = 1
+
+_HEADER = struct.Struct("<4sIIII")
+_INT_DTYPE = np.dtype("<i4")
+
+# parsed grammars of this process, by grammar hash, least recently used first
+_parsed_grammars: "OrderedDict[str, ParseState]" = OrderedDict()
+_MAX_PARSED_GRAMMARS = 1024
+
+
+def save_compiled(parsed_grammar: ParseState, file: Union[str, BinaryIO]) -> None:
+    if isinstance(file, str):
+        with open(file, "wb") as f:
+            return save_compiled(parsed_grammar, f)
+    grammar_encoding = np.asarray(parsed_grammar.grammar_encoding, dtype=_INT_DTYPE)
+    rule_offsets = np.asarray(parsed_grammar.rule_offsets, dtype=_INT_DTYPE)
+    symbol_table = json.dumps(
+        {
+            "symbol_table": parsed_grammar.symbol_table,
+            "rule_names": {
+                rule_id: rule.name
+                for rule_id, rule in parsed_grammar.grammar_rules.items()
+            },
+        }
+    ).encode("utf-8")
+    file.write(
+        _HEADER.pack(
+            COMPILED_GRAMMAR_MAGIC,
+            COMPILED_GRAMMAR_VERSION,
+            len(grammar_encoding),
+            len(rule_offsets),
+            len(symbol_table),
+        )
+    )
+    file.write(grammar_encoding.tobytes())
+    file.write(rule_offsets.tobytes())
+    file.write(symbol_table)
+
+
+def load_compiled(file: Union[str, BinaryIO]) -> ParseState:
+    if isinstance(file, str):
+        with open(file, "rb") as f:
+            return load_compiled(f)
+    header = file.read(_HEADER.size)
+    if len(header) != _HEADER.size:
+        raise ValueError("truncated compiled grammar")
+    magic, version, n_encoding, n_rule_offsets, n_symbol_table = _HEADER.unpack(header)
+    if magic != COMPILED_GRAMMAR_MAGIC:
+        raise ValueError("not a compiled grammar")
+    if version != COMPILED_GRAMMAR_VERSION:
+        raise ValueError(f"unsupported compiled grammar version {version}")
+
+    def _read(size: int) -> bytes:
+        data = file.read(size)
+        if len(data) != size:
+            raise ValueError("truncated compiled grammar")
+        return data
+
+    grammar_encoding = np.frombuffer(
+        _read(n_encoding * _INT_DTYPE.itemsize), dtype=_INT_DTYPE
+    ).tolist()
+    rule_offsets = np.frombuffer(
+        _read(n_rule_offsets * _INT_DTYPE.itemsize), dtype=_INT_DTYPE
+    ).tolist()
+    symbols = json.loads(_read(n_symbol_table).decode("utf-8"))
+    rule_names = {int(rule_id): name for rule_id, name in symbols["rule_names"].items()}
+
+    parsed_grammar = ParseState.from_grammar_encoding(
+        grammar_encoding, symbols["symbol_table"], rule_names
+    )
+    parsed_grammar.__dict__["rule_offsets"] = rule_offsets
+    return parsed_grammar
+
+
+def grammar_hash(grammar_str: str) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(f"{COMPILED_GRAMMAR_VERSION}\n{__version__}\n".encode("utf-8"))
+    hasher.update(grammar_str.encode("utf-8", "surrogatepass"))
+    return hasher.hexdigest()[:32]
+
+
+def parse_ebnf_cached(grammar_str: str, cache_dir: Optional[str] = None) -> ParseState:
+    """
+    `parse_ebnf` with a cache keyed by the grammar text.
+    The returned state is shared by all callers with the same grammar and must not be modified.
+    """
+    key = grammar_hash(grammar_str)
+    parsed_grammar = _parsed_grammars.get(key)
+    if parsed_grammar is not None:
+        _parsed_grammars.move_to_end(key)
+        return parsed_grammar
+
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, "grammars", f"{key}.tcfg")
+        if os.path.exists(path):
+            try:
+                parsed_grammar = load_compiled(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"ignoring corrupted compiled grammar {path}: {e}")
+
+    if parsed_grammar is None:
+        parsed_grammar = parse_ebnf(grammar_str)
+        if not parsed_grammar.grammar_rules:
+            # parsing failed, `parse_ebnf` already logged it
+            return parsed_grammar
+        if path is not None:
+            try:
+                _save_compiled_atomically(parsed_grammar, path)
+            except OSError as e:
+                logger.warning(f"could not save compiled grammar to {path}: {e}")
+    _parsed_grammars[key] = parsed_grammar
+    if len(_parsed_grammars) > _MAX_PARSED_GRAMMARS:
+        _parsed_grammars.popitem(last=False)
+    return parsed_grammar
+
+
+def _save_compiled_atomically(parsed_grammar: ParseState, path: str) -> None:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            save_compiled(parsed_grammar, file)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
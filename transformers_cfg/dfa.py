@@ -0,0 +1,289 @@
+"""
+Byte-level DFAs for the regular regions of a grammar.
+
+Most grammars are only context-free in a few places (nesting in JSON, parentheses in arithmetic),
+while numbers, strings, enums or dates are regular. From a stack head inside such a region, the set of
+local stacks the pushdown automaton can be in is finite, so the region can be compiled into a
+deterministic automaton over bytes: each DFA state is a set of local stacks and the transitions are
+a dense `(n_states, 256)` table. Walking the vocabulary trie through the table replaces the stack
+manipulation of the recognizer (see `TokenAcceptanceEngine`).
+
+A region is regular when no rule reachable from it is recursive, except through references in tail
+position (which is how `+` and `*` are desugared): those do not grow the stack.
+"""
+
+import logging
+import threading
+from typing import Callable, Dict, FrozenSet, Iterable, List, Set, Tuple
+
+import numpy as np
+
+from transformers_cfg.parse_stack import Stack
+from transformers_cfg.parser import (
+    END_OF_ALTERNATE_MARKER,
+    END_OF_RULE_MARKER,
+    REF_RULE_MARKER,
+)
+
+logger = logging.getLogger(__name__)
+
+DEAD_STATE = -1
+# beyond this size, regions are left to the pushdown automaton
+MAX_DFA_STATES = 65536
+
+Stacks = FrozenSet[Stack]
+
+
+class ByteDFA:
+    """
+    Lazily built DFA over sets of local stacks, shared by all the regular regions of a grammar.
+
+    States are interned by their set of stacks, so the regions of different elements share the
+    states they have in common (e.g. the rest of a keyword once its first byte is matched).
+    - `transitions[state, byte]`: next state, or `DEAD_STATE` if the byte is rejected
+    - `exits[state]`: whether the local stack can be exhausted in this state, i.e. whether
+      what follows depends on the context below the region
+    - `state_stacks[state]`: the local stacks of the state
+    """
+
+    def __init__(
+        self,
+        step: Callable[[Stacks, int], Set[Stack]],
+        byte_table: Callable[[Stacks], np.ndarray],
+        max_states: int = MAX_DFA_STATES,
+    ):
+        # `byte_table(stacks)`: bytes accepted by the stacks, `step(stacks, byte)`: stacks after one of them
+        self._step = step
+        self._byte_table = byte_table
+        self.max_states = max_states
+        self._states: Dict[Stacks, int] = {}
+        self.state_stacks: List[Stacks] = []
+        # transitions are computed on demand (`expand`), the rows of the other states are DEAD_STATE
+        self._transitions = np.full((16, 256), DEAD_STATE, dtype=np.int32)
+        self._exits = np.zeros(16, dtype=bool)
+        self._expanded = np.zeros(16, dtype=bool)
+        # states are added by the threads computing masks concurrently
+        self._lock = threading.RLock()
+
+    @property
+    def num_states(self) -> int:
+        return len(self.state_stacks)
+
+    @property
+    def transitions(self) -> np.ndarray:
+        return self._transitions[: self.num_states]
+
+    @property
+    def exits(self) -> np.ndarray:
+        return self._exits[: self.num_states]
+
+    def _intern(self, stacks: Stacks) -> int:
+        state = self._states.get(stacks)
+        if state is None:
+            state = self._states[stacks] = len(self.state_stacks)
+            self.state_stacks.append(stacks)
+            if state == len(self._exits):
+                self._transitions = np.concatenate(
+                    [self._transitions, np.full_like(self._transitions, DEAD_STATE)]
+                )
+                self._exits = np.concatenate([self._exits, np.zeros_like(self._exits)])
+                self._expanded = np.concatenate(
+                    [self._expanded, np.zeros_like(self._expanded)]
+                )
+            self._exits[state] = () in stacks
+        return state
+
+    def state(self, stacks: Iterable[Stack]) -> int:
+        with self._lock:
+            return self._intern(frozenset(stacks))
+
+    def expand(self, states: np.ndarray) -> bool:
+        """
+        Compute the transitions of `states`, if not done yet.
+        Returns False if the automaton would exceed `max_states` states.
+        """
+        states = states[~self._expanded[states]]
+        if len(states) == 0:
+            return True
+        with self._lock:
+            for state in np.unique(states).tolist():
+                if self._expanded[state]:
+                    continue
+                stacks = self.state_stacks[state]
+                for byte in np.flatnonzero(self._byte_table(stacks)).tolist():
+                    next_stacks = frozenset(self._step(stacks, byte))
+                    if next_stacks:
+                        self._transitions[state, byte] = self._intern(next_stacks)
+                self._expanded[state] = True
+                if self.num_states > self.max_states:
+                    return False
+        return True
+
+    def run(self, byte_seq: bytes, state: int) -> int:
+        """The state after `byte_seq`, or `DEAD_STATE` if it is rejected."""
+        for byte in byte_seq:
+            if not self._expanded[state]:
+                self.expand(np.array([state]))
+            state = int(self._transitions[state, byte])
+            if state == DEAD_STATE:
+                break
+        return state
+
+
+#############################
+#
+# Regularity
+#
+#############################
+
+
+def _alternative_elements(grammar_encoding: List[int], pos: int):
+    """(offset, is_reference) of the elements from `pos` to the end of the alternative."""
+    while grammar_encoding[pos] != END_OF_ALTERNATE_MARKER:
+        if grammar_encoding[pos] == REF_RULE_MARKER:
+            yield pos, True
+            pos += 2
+        else:
+            yield pos, False
+            pos += grammar_encoding[pos] + 1
+
+
+def _rule_alternatives(grammar_encoding: List[int], rule_offset: int):
+    """Offsets of the first element of each alternative of the rule at `rule_offset`."""
+    pos = rule_offset + 1
+    while grammar_encoding[pos] != END_OF_RULE_MARKER:
+        yield pos + 1
+        pos += grammar_encoding[pos] + 1
+
+
+class RegularityAnalysis:
+    """
+    Which rules of a grammar only reach finitely many stacks, computed once per grammar.
+
+    A rule is regular if no rule reachable from it (itself included) lies on a cycle of references
+    that contains a non-tail reference. `ascii_only` rules and their reachable rules only have
+    terminals over code points below 0x80, whose UTF-8 encoding is a single byte.
+    """
+
+    def __init__(self, grammar_encoding: List[int], rule_offsets: List[int]):
+        self.grammar_encoding = grammar_encoding
+        # rule id -> [(referenced rule id, is tail)]
+        self.references: Dict[int, List[Tuple[int, bool]]] = {}
+        local_ascii: Dict[int, bool] = {}
+        for rule_id, rule_offset in enumerate(rule_offsets):
+            if rule_offset < 0:
+                continue
+            references = self.references[rule_id] = []
+            local_ascii[rule_id] = True
+            for pos in _rule_alternatives(grammar_encoding, rule_offset):
+                rule_references, is_ascii = self._scan_alternative(pos)
+                references.extend(rule_references)
+                local_ascii[rule_id] &= is_ascii
+
+        components = _strongly_connected_components(
+            {
+                rule_id: [ref for ref, _ in refs]
+                for rule_id, refs in self.references.items()
+            }
+        )
+        component_of = {
+            rule_id: i
+            for i, component in enumerate(components)
+            for rule_id in component
+        }
+        # components come in reverse topological order: referenced components first
+        self.regular: Dict[int, bool] = {}
+        self.ascii_only: Dict[int, bool] = {}
+        for i, component in enumerate(components):
+            regular = not any(
+                not is_tail and component_of.get(ref) == i
+                for rule_id in component
+                for ref, is_tail in self.references[rule_id]
+            )
+            ascii_only = all(local_ascii[rule_id] for rule_id in component)
+            for rule_id in component:
+                for ref, _ in self.references[rule_id]:
+                    if ref not in component_of:
+                        # undefined rule
+                        regular = False
+                    elif component_of[ref] != i:
+                        regular &= self.regular[ref]
+                        ascii_only &= self.ascii_only[ref]
+            for rule_id in component:
+                self.regular[rule_id] = regular
+                self.ascii_only[rule_id] = ascii_only
+
+    def _scan_alternative(self, pos: int) -> Tuple[List[Tuple[int, bool]], bool]:
+        """References (rule id, is tail) and whether the terminals are ASCII, from `pos` to the end of the alternative."""
+        grammar_encoding = self.grammar_encoding
+        references = []
+        is_ascii = True
+        for offset, is_reference in _alternative_elements(grammar_encoding, pos):
+            if is_reference:
+                is_tail = grammar_encoding[offset + 2] == END_OF_ALTERNATE_MARKER
+                references.append((grammar_encoding[offset + 1], is_tail))
+            else:
+                size = grammar_encoding[offset]
+                is_ascii &= all(
+                    grammar_encoding[offset + 2 + i] < 0x80 for i in range(0, size, 2)
+                )
+        return references, is_ascii
+
+    def is_regular_region(self, element_offset: int, ascii_only: bool = False) -> bool:
+        """
+        Whether the stacks reachable from the stack `(element_offset,)` are finitely many.
+        With `ascii_only`, the region must also only accept ASCII code points.
+        """
+        references, is_ascii = self._scan_alternative(element_offset)
+        if ascii_only and not is_ascii:
+            return False
+        return all(
+            self.regular.get(ref, False)
+            and (not ascii_only or self.ascii_only.get(ref, False))
+            for ref, _ in references
+        )
+
+
+def _strongly_connected_components(graph: Dict[int, List[int]]) -> List[List[int]]:
+    """Tarjan's algorithm, iterative. Components are returned in reverse topological order."""
+    index: Dict[int, int] = {}
+    lowlink: Dict[int, int] = {}
+    on_stack: Set[int] = set()
+    stack: List[int] = []
+    components: List[List[int]] = []
+    for root in graph:
+        if root in index:
+            continue
+        work = [(root, iter(graph.get(root, [])))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in graph:
+                    # reference to an undefined rule
+                    continue
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(graph.get(successor, []))))
+                    break
+                if successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
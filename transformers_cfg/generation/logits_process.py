@@ -1,40 +1,102 @@
-import copy
 import math
-import os
 import pprint
 import importlib
-from typing import Optional, Literal #, List, Callable
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    List,
+    NamedTuple,
+    Optional,
+    Literal,
+    Tuple,
+    Union,
+)
 
+import numpy as np
 import torch
 import logging
 from transformers.generation.logits_process import (
     LogitsProcessor,
     LOGITS_PROCESSOR_INPUTS_DOCSTRING,
 )
+from transformers.generation.stopping_criteria import StoppingCriteria
 from transformers.utils import add_start_docstrings
 
+from transformers_cfg.generation.stats import ProcessorStats, StepStats
 from transformers_cfg.grammar_utils import IncrementalGrammarConstraint
-from transformers_cfg.token_grammar_recognizer import BaseTokenRecognizer #, IncrementalTokenRecognizer
+from transformers_cfg.mask_buffers import MaskBuffers
+from transformers_cfg.token_grammar_recognizer import (
+    BaseTokenRecognizer,
+    TokenCheckpoint,
+)  # , IncrementalTokenRecognizer
+from transformers_cfg.vocab_mask import VocabMask
 
 logger = logging.getLogger(__name__)
 
+# execution modes checking candidate tokens before computing masks, they need the logits
+_LAZY_MODES = ("lazy", "speculation", "auto")
+
 
 class GrammarConstrainedLogitsProcessor(LogitsProcessor):
     def __init__(
         self,
         grammar_constraint: BaseTokenRecognizer,
         valid_token_start_idx: Optional[int] = None,
-        execution_mode: Literal["speculation", "full_mask"] = "full_mask",
+        execution_mode: Literal[
+            "speculation", "lazy", "auto", "full_mask"
+        ] = "full_mask",
         device: Optional[torch.device] = None,
         adapter: str = "transformers",
+        num_mask_workers: int = 1,
+        async_masks: bool = False,
+        lazy_top_k: int = 8,
+        inplace_masks: bool = False,
+        stats: bool = False,
+        stats_callback: Optional[Callable[[StepStats], None]] = None,
     ) -> None:
-        self.last_size = None
         self.grammar_constraint = grammar_constraint
         self.batch_parsing_states = None
+        # tokens of each row since the start of the parse and their checkpoints: rows are matched with the
+        # state of their prefix rather than their position, which beam search changes between steps
+        self._rows: Optional[_Rows] = None
+        self._parse_start: Optional[int] = None
         self.valid_token_start_idx = valid_token_start_idx
+        # "lazy" checks the top-k tokens of each row before falling back to its full mask, k adapting to
+        # the ranks of the accepted tokens, "speculation" is the same with only the top token, "auto"
+        # chooses between "lazy" and "full_mask" per row from the hit rates and costs at its grammar position
         self.execution_mode = execution_mode
+        self.lazy_top_k = 1 if execution_mode == "speculation" else lazy_top_k
+        self.lazy_stats = LazyMaskStats(k=self.lazy_top_k)
+        # kept across `reset`, what is learned about the grammar holds for the next sequences
+        self.auto_stats = AutoModeStats()
         self.device = device
         self._vocab_mismatch_logged = False  # Flag to log warning only once
+        # buffers of the rejected tokens, reused at every step
+        self._mask_buffers: Optional[MaskBuffers] = None
+        # with inplace_masks, the scores passed to the processor are masked in place instead of a copy,
+        # which is safe with `generate` (fresh scores at each step)
+        self.inplace_masks = inplace_masks
+        # per-step timings and counters (see `transformers_cfg.generation.stats`), off by default
+        self.stats: Optional[ProcessorStats] = None
+        self.stats_callback = stats_callback
+        self._step_stats: Optional[StepStats] = None
+        if stats or stats_callback is not None:
+            self.enable_stats()
+        # distinct masks of a batch are computed on a thread pool if num_mask_workers > 1
+        self.num_mask_workers = num_mask_workers
+        self._mask_executor: Optional[ThreadPoolExecutor] = None
+        # with async_masks, `prefetch` computes the next states and masks in the background
+        # while the model runs its forward pass (see `GrammarMaskPrefetcher`)
+        self.async_masks = async_masks
+        self._prefetch_executor: Optional[ThreadPoolExecutor] = None
+        self._prefetched: Optional[_Prefetched] = None
+        self._last_device: Optional[torch.device] = None
 
         # Create an alias for llama-cpp-python
         if adapter == "llama-cpp-python":
@@ -60,131 +122,443 @@ class GrammarConstrainedLogitsProcessor(LogitsProcessor):
                     f"Falling back to default transformers behavior."
                 )
 
-    def mask_logits(
-        self, logits: torch.FloatTensor, device: torch.device
-    ) -> torch.FloatTensor:
-        masked_logits = logits.clone()
+    def enable_stats(self) -> ProcessorStats:
+        """Start collecting statistics, also timing the lookups in the mask cache."""
+        if self.stats is None:
+            self.stats = ProcessorStats()
+        mask_cache = getattr(self.grammar_constraint, "mask_cache", None)
+        if mask_cache is not None:
+            mask_cache.timed = True
+        return self.stats
+
+    @property
+    def mask_executor(self) -> Optional[ThreadPoolExecutor]:
+        if self.num_mask_workers <= 1:
+            return None
+        if self._mask_executor is None:
+            self._mask_executor = ThreadPoolExecutor(
+                max_workers=self.num_mask_workers, thread_name_prefix="tcfg-mask"
+            )
+        return self._mask_executor
+
+    def close(self):
+        """Shut down the mask workers, if any."""
+        self._discard_prefetched()
+        if self._prefetch_executor is not None:
+            self._prefetch_executor.shutdown()
+            self._prefetch_executor = None
+        if self._mask_executor is not None:
+            self._mask_executor.shutdown()
+            self._mask_executor = None
+
+    def prefetch(self, input_ids) -> None:
+        """
+        Start updating the parsing states with `input_ids` and computing the masks of the next step
+        in the background. The next call with the same `input_ids` only waits for the result,
+        a call with other `input_ids` discards it. No-op unless `async_masks` is set.
+        """
+        if not self.async_masks or self.batch_parsing_states is None:
+            return
+        self._discard_prefetched()
+        if self._prefetch_executor is None:
+            self._prefetch_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="tcfg-prefetch"
+            )
+        input_ids = _as_cpu_tensor(input_ids)
+        future = self._prefetch_executor.submit(
+            self._advance,
+            input_ids,
+            self.batch_parsing_states,
+            self._rows,
+            self._last_device,
+        )
+        self._prefetched = _Prefetched(
+            input_ids,
+            self.batch_parsing_states,
+            self._rows,
+            getattr(self.grammar_constraint, "last_size", None),
+            future,
+        )
+
+    @property
+    def last_size(self) -> Optional[int]:
+        """Length of the input ids the states were last updated with, ignoring a pending prefetch."""
+        if self._prefetched is not None:
+            return self._prefetched.last_size
+        return getattr(self.grammar_constraint, "last_size", None)
+
+    def _advance(self, input_ids, batch_parsing_states, rows, device):
+        batch_parsing_states, rows = self._update_batch_states(
+            input_ids, batch_parsing_states, rows
+        )
+        acceptance = None
+        if self.execution_mode not in _LAZY_MODES:
+            # lazy masks need the logits, only the states can be prepared
+            # not timed, the step waiting for the prefetch counts it as state update
+            acceptance = self._batch_masks(batch_parsing_states, device, timed=False)
+        return batch_parsing_states, rows, acceptance
+
+    def _update_batch_states(
+        self, input_ids, batch_parsing_states: list, rows: Optional["_Rows"]
+    ) -> Tuple[list, Optional["_Rows"]]:
+        """
+        Parsing states of the rows of `input_ids`, from the previous rows.
 
-        if self.execution_mode == "speculation":
-            # try to accept the most likely token
-            acceptance = torch.zeros(
-                (logits.shape[0], len(self.grammar_constraint.token2byte_mapping)),
-                dtype=torch.bool,
-                device=device,
+        Each row continues the previous row with the same prefix, not the one at the same position: beam
+        search reorders and duplicates the beams between steps. Rows with the same tokens share their state,
+        which is updated once. States are never modified (an update creates a new state), so rows can share
+        them, and forking a beam is free.
+
+        The state after each token is kept as a checkpoint (see `TokenCheckpoint`): rows rolled back by
+        k tokens (e.g. when llama.cpp reuses its prompt cache) resume in O(k), and rows jumping forward
+        only parse their new tokens.
+        """
+        constraint = self.grammar_constraint
+        ids = _as_cpu_tensor(input_ids).numpy()
+        if self._parse_start is None:
+            # without `valid_token_start_idx`, the prompt isn't parsed
+            self._parse_start = (
+                self.valid_token_start_idx
+                if self.valid_token_start_idx is not None
+                else ids.shape[-1]
+            )
+        start = self._parse_start
+        keys = [row[start:].tobytes() for row in ids]
+        if not constraint.incremental:
+            # the recognizer parses the sequences again at each call, whatever the previous states
+            return self._update_unique_rows(input_ids, batch_parsing_states, keys), None
+
+        prompt = ids[:, :start].tobytes()
+        length = ids.shape[-1] - start
+        last_size = constraint.last_size
+        if rows is None or last_size is None:
+            batch_parsing_states = self._update_unique_rows(
+                input_ids, batch_parsing_states, keys
+            )
+            checkpoints = [
+                TokenCheckpoint(None, length, state) for state in batch_parsing_states
+            ]
+            return batch_parsing_states, _Rows(prompt, keys, checkpoints)
+        if rows.prompt != prompt:
+            raise ValueError(
+                "The prompts changed since the previous call, reset the processor to process other sequences."
+            )
+        if last_size <= ids.shape[-1] and rows.keys == [
+            row[start:last_size].tobytes() for row in ids
+        ]:
+            # every row continues the row at the same position, as in greedy search and sampling
+            batch_parsing_states = self._update_unique_rows(
+                input_ids, batch_parsing_states, keys
             )
-            next_tokens = torch.argmax(logits, dim=-1)
-            for i, next_token in enumerate(next_tokens.tolist()):
-                try:
-                    is_next_token_accepted = self.grammar_constraint.accept_token_ids(
-                        [next_token], self.batch_parsing_states[i]
+            checkpoints = [
+                TokenCheckpoint(parent, length, state)
+                for parent, state in zip(rows.checkpoints, batch_parsing_states)
+            ]
+            return batch_parsing_states, _Rows(prompt, keys, checkpoints)
+
+        checkpoints = [
+            constraint.advance_checkpoint(checkpoint, row[start + checkpoint.length :])
+            for row, checkpoint in zip(ids, self._resume_points(ids, rows, last_size))
+        ]
+        constraint.last_size = ids.shape[-1]
+        batch_parsing_states = [checkpoint.state for checkpoint in checkpoints]
+        return batch_parsing_states, _Rows(prompt, keys, checkpoints)
+
+    def _resume_points(
+        self, ids: np.ndarray, rows: "_Rows", last_size: int
+    ) -> List[TokenCheckpoint]:
+        """Checkpoint of the longest prefix of each row that a previous row had."""
+        start = self._parse_start
+        checkpoints_by_key = dict(zip(rows.keys, rows.checkpoints))
+        previous_tokens = None
+        resume_points = []
+        for row in ids:
+            checkpoint = None
+            if last_size <= len(row):
+                checkpoint = checkpoints_by_key.get(row[start:last_size].tobytes())
+            if checkpoint is None:
+                # rolled back or edited
+                if previous_tokens is None:
+                    previous_tokens = [
+                        np.frombuffer(key, dtype=ids.dtype) for key in rows.keys
+                    ]
+                length, i = max(
+                    (_common_prefix_length(row[start:], tokens), i)
+                    for i, tokens in enumerate(previous_tokens)
+                )
+                checkpoint = rows.checkpoints[i].rollback(length)
+                if checkpoint is None:
+                    logger.debug(
+                        "no checkpoint for the prefix of a row, parsing it again"
                     )
-                except ValueError:
-                    is_next_token_accepted = False
-                if is_next_token_accepted:
-                    acceptance[i, next_token] = True
-                else:
-                    # resolve each stack to a tensor of True/False for each token
-                    # indicating acceptance
-                    # acceptance = self.grammar_acceptor.filter_vocab(self.stacks, device)
-                    acceptance[i] = self.grammar_constraint.filter_vocab(
-                        self.batch_parsing_states[i], device
+                    initial_state = (
+                        self.grammar_constraint.string_recognizer.get_initial_parsing_state()
                     )
-        else:
-            acceptance = self.grammar_constraint.batch_filter_vocab(
-                self.batch_parsing_states, device
+                    checkpoint = TokenCheckpoint(None, 0, initial_state)
+            resume_points.append(checkpoint)
+        return resume_points
+
+    def _update_unique_rows(
+        self, input_ids, batch_parsing_states: list, keys: List[bytes]
+    ) -> list:
+        """Updates the states of the rows of `input_ids` with the recognizer, once per distinct row."""
+        first_rows: Dict[bytes, int] = {}
+        for i, key in enumerate(keys):
+            first_rows.setdefault(key, i)
+        if len(first_rows) == len(keys):
+            return self.grammar_constraint.update_state_with_batch_token_seqs(
+                input_ids, batch_parsing_states, self.valid_token_start_idx
             )
+        rows = list(first_rows.values())
+        if isinstance(input_ids, torch.Tensor):
+            unique_input_ids = input_ids[rows]
+        else:
+            unique_input_ids = [input_ids[i] for i in rows]
+        unique_states = self.grammar_constraint.update_state_with_batch_token_seqs(
+            unique_input_ids,
+            [batch_parsing_states[i] for i in rows],
+            self.valid_token_start_idx,
+        )
+        states_by_key = dict(zip(first_rows, unique_states))
+        return [states_by_key[key] for key in keys]
 
-        # --- START OF MODIFIED PATCH for vocab size mismatch ---
-        acceptance_vocab_size = acceptance.shape[-1]
-        masked_logits_vocab_size = masked_logits.shape[-1]
+    def _take_prefetched(self, input_ids):
+        prefetched = self._prefetched
+        if prefetched is None:
+            return None
+        self._prefetched = None
+        input_ids = _as_cpu_tensor(input_ids)
+        if prefetched.input_ids.shape == input_ids.shape and torch.equal(
+            prefetched.input_ids, input_ids
+        ):
+            # errors of the background update are raised here, as in the synchronous path
+            return prefetched.future.result()
+        self._rollback(prefetched)
+        return None
 
-        if masked_logits_vocab_size != acceptance_vocab_size:
-            vocab_diff = acceptance_vocab_size - masked_logits_vocab_size
+    def _discard_prefetched(self):
+        if self._prefetched is not None:
+            self._rollback(self._prefetched)
+            self._prefetched = None
 
-            # --- Log details and warning only once ---
-            if not self._vocab_mismatch_logged:
-                logger.warning(
-                    f"Vocab size mismatch detected: Model logits size = {masked_logits_vocab_size}, "
-                    f"Tokenizer/Acceptance mask size = {acceptance_vocab_size} (Difference: {vocab_diff})"
+    def _rollback(self, prefetched: "_Prefetched"):
+        # wait for the background update, then undo it
+        prefetched.future.exception()
+        self.batch_parsing_states = prefetched.batch_parsing_states
+        self._rows = prefetched.rows
+        if hasattr(self.grammar_constraint, "last_size"):
+            self.grammar_constraint.last_size = prefetched.last_size
+
+    def mask_logits(
+        self,
+        logits: torch.FloatTensor,
+        device: torch.device,
+        acceptance: Optional[torch.Tensor] = None,
+    ) -> torch.FloatTensor:
+        if self.execution_mode == "auto":
+            return self._mask_logits_auto(logits, device)
+        if self.execution_mode in _LAZY_MODES:
+            return self._mask_logits_lazily(logits, device)
+        if acceptance is None:
+            acceptance = self._batch_masks(self.batch_parsing_states, device)
+        return self._apply_acceptance(logits, acceptance, device)
+
+    def _mask_logits_lazily(
+        self,
+        logits: torch.FloatTensor,
+        device: torch.device,
+        lazy_rows: Optional[List[int]] = None,
+        timings: Optional[dict] = None,
+    ) -> torch.FloatTensor:
+        """
+        Keep only the most likely accepted token of each row, checking the top-k candidates one by one.
+        The mask of a row is only computed when none of its candidates is accepted, or directly for the
+        rows not in `lazy_rows` (all rows by default). `timings` is filled with the seconds spent per row
+        checking candidates (`(row, "check")`) and computing its mask (`(row, "mask")`).
+        """
+        stats = self.lazy_stats
+        if lazy_rows is None:
+            lazy_rows = list(range(len(logits)))
+        masked_logits = torch.full_like(logits, -math.inf)
+        masked_rows = sorted(set(range(len(logits))) - set(lazy_rows))
+        if lazy_rows:
+            k = min(stats.k, logits.shape[-1])
+            top = torch.topk(logits[lazy_rows], k, dim=-1)
+            # tokens already masked by another processor are not candidates
+            n_candidates = torch.isfinite(top.values).sum(dim=-1).tolist()
+            for i, row_candidates, n in zip(
+                lazy_rows, top.indices.tolist(), n_candidates
+            ):
+                start = time.perf_counter()
+                rank = self._first_accepted(
+                    row_candidates[:n], self.batch_parsing_states[i]
                 )
+                check_seconds = time.perf_counter() - start
+                if timings is not None:
+                    timings[i, "check"] = check_seconds
+                if self._step_stats is not None:
+                    self._step_stats.check_seconds += check_seconds
+                stats.record(i, rank)
+                if rank is None:
+                    masked_rows.append(i)
+                else:
+                    token_id = row_candidates[rank]
+                    masked_logits[i, token_id] = logits[i, token_id]
+        if masked_rows:
+            start = time.perf_counter()
+            acceptance = self._batch_masks(
+                [self.batch_parsing_states[i] for i in masked_rows], device
+            )
+            masked_logits[masked_rows] = self._apply_acceptance(
+                logits[masked_rows], acceptance, device
+            )
+            if timings is not None:
+                seconds = (time.perf_counter() - start) / len(masked_rows)
+                for i in masked_rows:
+                    timings[i, "mask"] = seconds
+        if self.execution_mode != "speculation":
+            stats.adapt(self.lazy_top_k)
+        return masked_logits
 
-                # Identify and log extra tokens
-                if vocab_diff > 0:  # acceptance mask is larger
-                    extra_token_ids = list(
-                        range(
-                            masked_logits_vocab_size, acceptance_vocab_size
-                        )
-                    )
-                    try:
-                        # Attempt to decode extra tokens using the tokenizer
-                        extra_tokens_str = self.grammar_constraint.tokenizer.decode(
-                            extra_token_ids
-                        )
-                        logger.warning(
-                            f"Tokenizer/Acceptance mask seems to have {vocab_diff} extra token IDs "
-                            f"(IDs {extra_token_ids[0]} to {extra_token_ids[-1]}) compared to the model's logits dimension. "
-                            f"Decoded extra tokens (approximate): '{extra_tokens_str}'. "
-                            f"Truncating acceptance mask."
-                        )
-                    except Exception as e:
-                        logger.warning(
-                            f"Tokenizer/Acceptance mask seems to have {vocab_diff} extra token IDs "
-                            f"(IDs {extra_token_ids[0]} to {extra_token_ids[-1]}) compared to the model's logits dimension, "
-                            f"but decoding failed: {e}. Truncating acceptance mask."
-                        )
-                elif vocab_diff < 0:  # model logits is larger
-                    extra_token_ids = list(
-                        range(
-                            acceptance_vocab_size, masked_logits_vocab_size
-                        )
-                    )
-                    logger.warning(
-                        f"Model logits dimension seems to be {abs(vocab_diff)} larger than the tokenizer's vocab size. "
-                        f"The extra model token IDs are from {extra_token_ids[0]} to {extra_token_ids[-1]}. "
-                        f"Padding acceptance mask with 'False'."
-                        f" (Cannot decode model-specific token IDs from here)."
-                    )
+    def _mask_logits_auto(
+        self, logits: torch.FloatTensor, device: torch.device
+    ) -> torch.FloatTensor:
+        """Check candidates first in the rows whose grammar position is expected to be cheaper that way."""
+        auto_stats = self.auto_stats
+        positions = [
+            auto_stats.position_key(parsing_state)
+            for parsing_state in self.batch_parsing_states
+        ]
+        lazy_rows = [
+            i for i, position in enumerate(positions) if auto_stats.decide(i, position)
+        ]
+        timings = {}
+        masked_logits = self._mask_logits_lazily(logits, device, lazy_rows, timings)
+        for i, position in enumerate(positions):
+            auto_stats.observe(
+                position, timings.get((i, "check")), timings.get((i, "mask"))
+            )
+        auto_stats.steps += 1
+        return masked_logits
 
-                self._vocab_mismatch_logged = True  # Set flag after logging details once
-            # --- End log details and warning only once ---
+    def _first_accepted(self, token_ids: List[int], parsing_state) -> Optional[int]:
+        """Index of the first of `token_ids` accepted in `parsing_state`, if any."""
+        for rank, token_id in enumerate(token_ids):
+            self.lazy_stats.checked += 1
+            if self.grammar_constraint.try_accept_token_id(token_id, parsing_state):
+                return rank
+        return None
 
-            # --- Apply the fix (runs every time a mismatch occurs) ---
-            if vocab_diff > 0:  # acceptance mask is larger
-                # Truncate the acceptance mask to match the logits size
-                acceptance = acceptance[..., :masked_logits_vocab_size]
-                logger.debug(
-                    f"Truncated acceptance mask to shape: {acceptance.shape}"
+    def _batch_masks(
+        self, batch_parsing_states: list, device: torch.device, timed: bool = True
+    ) -> Union[torch.Tensor, List[VocabMask]]:
+        """
+        Masks of a batch of states: packed on accelerators, which expand them on the device (see
+        `MaskBuffers`), a bool tensor on the CPU, which reuses the tensors of the cached masks.
+        """
+        step = self._step_stats if timed else None
+        if step is not None:
+            start = time.perf_counter()
+        if (
+            device is not None
+            and torch.device(device).type != "cpu"
+            and hasattr(self.grammar_constraint, "batch_filter_vocab_mask")
+        ):
+            masks = self.grammar_constraint.batch_filter_vocab_mask(
+                batch_parsing_states, self.mask_executor
+            )
+        else:
+            masks = self.grammar_constraint.batch_filter_vocab(
+                batch_parsing_states, device, self.mask_executor
+            )
+        if step is not None:
+            step.mask_seconds += time.perf_counter() - start
+        return masks
+
+    def _mask_buffers_for(
+        self, vocab_size: int, logits_vocab_size: int, device: torch.device
+    ) -> MaskBuffers:
+        buffers = self._mask_buffers
+        if buffers is None or not buffers.matches(
+            vocab_size, logits_vocab_size, device
+        ):
+            if vocab_size != logits_vocab_size:
+                self._log_vocab_mismatch(vocab_size, logits_vocab_size)
+            # the vocabularies are aligned once here, see `MaskBuffers`
+            buffers = self._mask_buffers = MaskBuffers(
+                vocab_size, logits_vocab_size, device
+            )
+        return buffers
+
+    def _log_vocab_mismatch(self, vocab_size: int, logits_vocab_size: int) -> None:
+        if self._vocab_mismatch_logged:
+            return
+        vocab_diff = vocab_size - logits_vocab_size
+        logger.warning(
+            f"Vocab size mismatch detected: Model logits size = {logits_vocab_size}, "
+            f"Tokenizer/Acceptance mask size = {vocab_size} (Difference: {vocab_diff})"
+        )
+
+        # Identify and log extra tokens
+        if vocab_diff > 0:  # acceptance mask is larger
+            extra_token_ids = list(range(logits_vocab_size, vocab_size))
+            try:
+                # Attempt to decode extra tokens using the tokenizer
+                extra_tokens_str = self.grammar_constraint.tokenizer.decode(
+                    extra_token_ids
                 )
-            elif vocab_diff < 0:  # model logits is larger
-                # Pad the acceptance mask with False to match the logits size
-                num_padding = abs(vocab_diff)
-                padding_tensor = torch.zeros(
-                    (*acceptance.shape[:-1], num_padding),
-                    dtype=torch.bool,
-                    device=device,
+                logger.warning(
+                    f"Tokenizer/Acceptance mask seems to have {vocab_diff} extra token IDs "
+                    f"(IDs {extra_token_ids[0]} to {extra_token_ids[-1]}) compared to the model's logits dimension. "
+                    f"Decoded extra tokens (approximate): '{extra_tokens_str}'. "
+                    f"Truncating acceptance mask."
                 )
-                acceptance = torch.cat((acceptance, padding_tensor), dim=-1)
-                logger.debug(
-                    f"Padded acceptance mask to shape: {acceptance.shape}"
+            except Exception as e:
+                logger.warning(
+                    f"Tokenizer/Acceptance mask seems to have {vocab_diff} extra token IDs "
+                    f"(IDs {extra_token_ids[0]} to {extra_token_ids[-1]}) compared to the model's logits dimension, "
+                    f"but decoding failed: {e}. Truncating acceptance mask."
                 )
+        elif vocab_diff < 0:  # model logits is larger
+            extra_token_ids = list(range(vocab_size, logits_vocab_size))
+            logger.warning(
+                f"Model logits dimension seems to be {abs(vocab_diff)} larger than the tokenizer's vocab size. "
+                f"The extra model token IDs are from {extra_token_ids[0]} to {extra_token_ids[-1]}. "
+                f"Padding acceptance mask with 'False'."
+                f" (Cannot decode model-specific token IDs from here)."
+            )
 
-            # Final check to ensure shapes now match after correction
-            if acceptance.shape[-1] != masked_logits.shape[-1]:
-                # Keep this error outside the flag check as it indicates alignment failure
-                raise RuntimeError(
-                    f"Automatic vocab size alignment failed. "
-                    f"Adjusted acceptance shape: {acceptance.shape}, "
-                    f"Masked logits shape: {masked_logits.shape}"
-                )
-        # --- END OF MODIFIED PATCH ---
+        self._vocab_mismatch_logged = True
+
+    def _apply_acceptance(
+        self,
+        logits: torch.FloatTensor,
+        acceptance: Union[torch.Tensor, List[VocabMask]],
+        device: torch.device,
+    ) -> torch.FloatTensor:
+        """Set the logits of the tokens rejected by `acceptance` (see `_batch_masks`) to -inf."""
+        step = self._step_stats
+        if step is not None:
+            start = time.perf_counter()
+        if isinstance(acceptance, torch.Tensor):
+            buffers = self._mask_buffers_for(
+                acceptance.shape[-1], logits.shape[-1], device
+            )
+            rejected = buffers.rejected_from_acceptance(acceptance.to(buffers.device))
+        else:
+            buffers = self._mask_buffers_for(
+                acceptance[0].vocab_size, logits.shape[-1], device
+            )
+            rejected = buffers.rejected_from_masks(acceptance)
+        if step is not None:
+            step.transfer_seconds += time.perf_counter() - start
 
-        # acceptance is a tensor of shape (batch_size, vocab_size)
         # get the indices of the accepted tokens
         # do the following operation only in debug mode
-        if os.getenv("TCFG_LOG_LEVEL") == "DEBUG":
+        if logger.isEnabledFor(logging.DEBUG):
             # convert acceptance to numpy array
-            batch_size, vocab_size = acceptance.shape
-            acceptance_np = acceptance.cpu().numpy()
+            batch_size = rejected.shape[0]
+            acceptance_np = (~rejected).cpu().numpy()
             accepted_x, accepted_y = acceptance_np.nonzero()
             # dict of {batch_index: [accepted_token_indices]}
             # initialize the dict with empty list
@@ -202,9 +576,14 @@ class GrammarConstrainedLogitsProcessor(LogitsProcessor):
             }
             logger.debug("Accepted tokens for the current batch:\n" + pprint.pformat(accepted_tokens))
 
-        # Logits to -inf where False
-        # Shapes should match perfectly now due to the patch above
-        masked_logits[~acceptance] = -math.inf
+        if step is not None:
+            start = time.perf_counter()
+        if self.inplace_masks:
+            masked_logits = logits.masked_fill_(rejected, -math.inf)
+        else:
+            masked_logits = logits.masked_fill(rejected, -math.inf)
+        if step is not None:
+            step.apply_seconds += time.perf_counter() - start
         return masked_logits
 
     def process_logits(
@@ -219,41 +598,141 @@ class GrammarConstrainedLogitsProcessor(LogitsProcessor):
             device = scores.device
         else:
             device = self.device  # Use explicitly set device if available
+        self._last_device = device
 
-        # we dynamically create stacks at the first call, so that we know the batch size and beam size
-        if self.batch_parsing_states is None:
-            self.batch_parsing_states = [
-                # self.grammar_constraint.init_stacks()
-                copy.deepcopy(
-                    self.grammar_constraint.string_recognizer.get_initial_parsing_state()
-                )
-                for _ in range(len(input_ids))
-            ]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("input_ids: \n" + pprint.pformat(input_ids))
 
-        # TODO: not sure why logger.debug is not working here, only starts in the second call
-        if os.getenv("TCFG_LOG_LEVEL") == "DEBUG":
-            print("-" * 80)
+        stats = self.stats
+        if stats is None:
+            acceptance = self._update_states(input_ids)
+            self._log_stacks()
+            return self.mask_logits(scores, device, acceptance)
 
-        print("input_ids: \n" + pprint.pformat(input_ids)) # new token appended to the end of each prompt
-        # logger.debug("scores: \n" + pprint.pformat(scores)) # .shape prints (batch_size, vocab_size)
-        # logger.debug("last_size: \n" + pprint.pformat(self.last_size)) # always None in the toy example
-        # logger.debug(self.valid_token_start_idx) # always None in the toy example
+        step = self._step_stats = stats.begin_step(
+            len(input_ids), self.grammar_constraint
+        )
+        step.prefetched = self._prefetched is not None
+        start = time.perf_counter()
+        acceptance = self._update_states(input_ids)
+        step.state_update_seconds = time.perf_counter() - start
+        self._log_stacks()
+        try:
+            masked_scores = self.mask_logits(scores, device, acceptance)
+        finally:
+            self._step_stats = None
+        stats.end_step(step, self.batch_parsing_states, self.grammar_constraint)
+        if self.stats_callback is not None:
+            try:
+                self.stats_callback(step)
+            except Exception:
+                logger.exception("stats callback failed")
+        return masked_scores
 
-        self.batch_parsing_states = (
-            self.grammar_constraint.update_state_with_batch_token_seqs(
-                input_ids, self.batch_parsing_states, self.valid_token_start_idx
+    def _log_stacks(self):
+        if logger.isEnabledFor(logging.DEBUG):
+            # updated parsing states for the current batch
+            logger.debug(
+                "updated stacks: \n"
+                + pprint.pformat(
+                    [
+                        stack
+                        for acc_state in self.batch_parsing_states
+                        for stack in acc_state.stacks
+                    ]
+                )
             )
-        )
-        # updated parsing states for the current batch
-        print(
-            "updated stacks: \n"
-            + pprint.pformat(
-                [stack for acc_state in self.batch_parsing_states for stack in acc_state.stacks]
+
+    def _update_states(self, input_ids) -> Optional[torch.Tensor]:
+        """Update the parsing states with `input_ids`, returns the masks of the next step if they were prefetched."""
+        prefetched = self._take_prefetched(input_ids)
+
+        # we dynamically create stacks at the first call, so that we know the batch size and beam size
+        if self.batch_parsing_states is None:
+            # states are never modified in place, all rows start from the same one
+            initial_state = (
+                self.grammar_constraint.string_recognizer.get_initial_parsing_state()
             )
+            self.batch_parsing_states = [initial_state] * len(input_ids)
+
+        if prefetched is not None:
+            self.batch_parsing_states, self._rows, acceptance = prefetched
+            return acceptance
+        self.batch_parsing_states, self._rows = self._update_batch_states(
+            input_ids, self.batch_parsing_states, self._rows
         )
+        return None
 
-        masked_scores = self.mask_logits(scores, device)
-        return masked_scores
+    def jump_forward(self, input_ids, max_length: int = 256) -> List[List[int]]:
+        """
+        Tokens forced by the grammar after `input_ids`, for each sequence of the batch.
+
+        When the grammar admits a single continuation (a literal key, closing brackets, ...), its tokens
+        can be appended without sampling them and fed to the model in a single forward pass, instead of
+        one forward pass and one mask per token. The parsing states are updated with `input_ids`, the
+        next call to the processor must be with `input_ids` followed by the same number of forced tokens
+        for every sequence (e.g. `min(map(len, forced))`, possibly none):
+
+            forced = processor.jump_forward(input_ids)
+            n = min(map(len, forced))
+            if n > 0:
+                input_ids = torch.cat([input_ids, torch.tensor([f[:n] for f in forced])], dim=-1)
+        """
+        self._update_states(input_ids)
+        return [
+            self.grammar_constraint.jump_forward(parsing_state, max_length).token_ids
+            for parsing_state in self.batch_parsing_states
+        ]
+
+    def sample(
+        self,
+        input_ids: torch.LongTensor,
+        scores: torch.FloatTensor,
+        generator: Optional[torch.Generator] = None,
+    ) -> torch.LongTensor:
+        """
+        Sample the next token of each sequence from `softmax(scores)` restricted to the grammar, for custom
+        decoding loops.
+
+        Up to `lazy_stats.k` tokens are drawn from the unconstrained distribution and the first accepted one
+        is returned, which is exact rejection sampling: the mask of a sequence is only computed when all
+        its draws are rejected. In `generate`, the lazy mode keeps the most likely accepted token of the
+        top-k only, which is exact for greedy decoding but not for sampling.
+        """
+        self._update_states(input_ids)
+        stats = self.lazy_stats
+        probs = torch.softmax(scores.float(), dim=-1)
+        draws = torch.multinomial(
+            probs, stats.k, replacement=True, generator=generator
+        ).tolist()
+        next_tokens = []
+        fallback_rows = []
+        for i, row_draws in enumerate(draws):
+            rank = self._first_accepted(row_draws, self.batch_parsing_states[i])
+            stats.record(i, rank)
+            if rank is None:
+                fallback_rows.append(i)
+                next_tokens.append(-1)
+            else:
+                next_tokens.append(row_draws[rank])
+        next_tokens = torch.tensor(next_tokens, dtype=torch.long)
+        if fallback_rows:
+            acceptance = self._batch_masks(
+                [self.batch_parsing_states[i] for i in fallback_rows], scores.device
+            )
+            masked_scores = self._apply_acceptance(
+                scores[fallback_rows], acceptance, scores.device
+            )
+            next_tokens[fallback_rows] = (
+                torch.multinomial(
+                    torch.softmax(masked_scores.float(), dim=-1), 1, generator=generator
+                )
+                .squeeze(-1)
+                .cpu()
+            )
+        if self.execution_mode != "speculation":
+            stats.adapt(self.lazy_top_k)
+        return next_tokens.to(scores.device)
 
     @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
     def __call__(self, input_ids, scores):
@@ -264,12 +743,204 @@ class GrammarConstrainedLogitsProcessor(LogitsProcessor):
         return self.process_logits(input_ids, scores)
 
     def reset(self):
+        self._discard_prefetched()
         self.batch_parsing_states = None
+        self._rows = None
+        self._parse_start = None
         self._vocab_mismatch_logged = False  # Reset flag on reset
+        self.lazy_stats = LazyMaskStats(k=self.lazy_top_k)
+        self.auto_stats.reset_rows()
         if isinstance(self.grammar_constraint, IncrementalGrammarConstraint):
             self.grammar_constraint.reset()
 
 
+@dataclass
+class LazyMaskStats:
+    """
+    Outcome of the lazy masks since the last `reset`: per row of the batch, how many times a candidate
+    was accepted (`hits`) and how many times the full mask had to be computed (`fallbacks`).
+    """
+
+    # number of candidates checked per row at the next step
+    k: int
+    hits: List[int] = field(default_factory=list)
+    fallbacks: List[int] = field(default_factory=list)
+    # number of `try_accept_token_id` calls
+    checked: int = 0
+    # ranks of the last accepted candidates, k follows the largest one
+    recent_ranks: Deque[int] = field(default_factory=lambda: deque(maxlen=32))
+    _fell_back: bool = False
+
+    def record(self, row: int, rank: Optional[int]) -> None:
+        if row >= len(self.hits):
+            self.hits.extend([0] * (row + 1 - len(self.hits)))
+            self.fallbacks.extend([0] * (row + 1 - len(self.fallbacks)))
+        if rank is None:
+            self.fallbacks[row] += 1
+            self._fell_back = True
+        else:
+            self.hits[row] += 1
+            self.recent_ranks.append(rank)
+
+    def adapt(self, max_k: int) -> None:
+        """Check twice as many candidates as the largest recent accepted rank needs, all of them after a fallback."""
+        if self._fell_back or not self.recent_ranks:
+            self.k = max_k
+        else:
+            self.k = max(1, min(max_k, 2 * (max(self.recent_ranks) + 1)))
+        self._fell_back = False
+
+    @property
+    def fallback_rate(self) -> float:
+        total = sum(self.hits) + sum(self.fallbacks)
+        return sum(self.fallbacks) / total if total else 0.0
+
+
+@dataclass
+class PositionStats:
+    """Observed outcome of the lazy path and costs of both paths at a grammar position."""
+
+    # moving averages, None until observed
+    hit_rate: Optional[float] = None
+    check_seconds: Optional[float] = None
+    mask_seconds: Optional[float] = None
+    lazy: int = 0
+    full_mask: int = 0
+    # full masks since the lazy path was last tried
+    since_probe: int = 0
+    last_decision: Optional[bool] = None
+
+
+@dataclass
+class AutoModeStats:
+    """
+    Decisions of the "auto" execution mode.
+
+    A grammar position is the set of stack heads of a parsing state (e.g. the characters of a JSON
+    string, or what may follow a value), for which the processor keeps moving averages of the rate at
+    which a candidate is accepted and of the time spent checking candidates and computing a mask. A row
+    checks candidates first when `check + (1 - hit_rate) * mask < mask`, and still does so once every
+    `probe_interval` full masks to follow changes of the hit rate.
+    """
+
+    smoothing: float = 0.1
+    probe_interval: int = 32
+    positions: Dict[Tuple[FrozenSet[int], bool], PositionStats] = field(
+        default_factory=dict
+    )
+    # decisions per row of the batch
+    lazy_rows: List[int] = field(default_factory=list)
+    full_mask_rows: List[int] = field(default_factory=list)
+    # changes of decision at a position, the last ones as (step, position, lazy)
+    switches: int = 0
+    recent_switches: Deque[tuple] = field(default_factory=lambda: deque(maxlen=256))
+    steps: int = 0
+
+    @staticmethod
+    def position_key(parsing_state) -> Tuple[FrozenSet[int], bool]:
+        heads = frozenset(stack[-1] for stack in parsing_state.stacks if stack)
+        return heads, parsing_state.partial_utf8.n_remain > 0
+
+    def decide(self, row: int, position) -> bool:
+        """Whether the row should check candidates first."""
+        stats = self.positions.setdefault(position, PositionStats())
+        if stats.hit_rate is None or stats.mask_seconds is None:
+            lazy = True
+        elif stats.since_probe >= self.probe_interval:
+            lazy = True
+        else:
+            lazy = (
+                stats.check_seconds + (1 - stats.hit_rate) * stats.mask_seconds
+                < stats.mask_seconds
+            )
+        if stats.last_decision is not None and lazy != stats.last_decision:
+            self.switches += 1
+            self.recent_switches.append((self.steps, position, lazy))
+        stats.last_decision = lazy
+        if row >= len(self.lazy_rows):
+            self.lazy_rows.extend([0] * (row + 1 - len(self.lazy_rows)))
+            self.full_mask_rows.extend([0] * (row + 1 - len(self.full_mask_rows)))
+        if lazy:
+            stats.lazy += 1
+            stats.since_probe = 0
+            self.lazy_rows[row] += 1
+        else:
+            stats.full_mask += 1
+            stats.since_probe += 1
+            self.full_mask_rows[row] += 1
+        return lazy
+
+    def observe(
+        self,
+        position,
+        check_seconds: Optional[float],
+        mask_seconds: Optional[float],
+    ) -> None:
+        """Costs of a row at `position`: the check is None if it was fully masked, the mask if a candidate was accepted."""
+        stats = self.positions[position]
+        if check_seconds is not None:
+            stats.check_seconds = self._average(stats.check_seconds, check_seconds)
+            stats.hit_rate = self._average(stats.hit_rate, float(mask_seconds is None))
+        if mask_seconds is not None:
+            stats.mask_seconds = self._average(stats.mask_seconds, mask_seconds)
+
+    def _average(self, average: Optional[float], value: float) -> float:
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def reset_rows(self) -> None:
+        self.lazy_rows = []
+        self.full_mask_rows = []
+
+
+class _Rows(NamedTuple):
+    # the part of the input ids that isn't parsed
+    prompt: bytes
+    # tokens of each row since the start of the parse
+    keys: List[bytes]
+    checkpoints: List[TokenCheckpoint]
+
+
+def _common_prefix_length(a: np.ndarray, b: np.ndarray) -> int:
+    n = min(len(a), len(b))
+    different = np.flatnonzero(a[:n] != b[:n])
+    return int(different[0]) if len(different) else n
+
+
+class _Prefetched(NamedTuple):
+    input_ids: torch.Tensor
+    # states and constraint position before the update, to roll back a discarded prefetch
+    batch_parsing_states: list
+    rows: Optional["_Rows"]
+    last_size: Optional[int]
+    future: Future
+
+
+def _as_cpu_tensor(input_ids) -> torch.Tensor:
+    if isinstance(input_ids, torch.Tensor):
+        return input_ids.detach().cpu()
+    return torch.as_tensor(input_ids)
+
+
+class GrammarMaskPrefetcher(StoppingCriteria):
+    """
+    Stopping criterion that never stops, it starts the mask computation of a processor created with
+    `async_masks=True` as soon as the next token is sampled, so that it overlaps with the forward pass:
+
+        processor = GrammarConstrainedLogitsProcessor(grammar, async_masks=True)
+        model.generate(..., logits_processor=[processor],
+                       stopping_criteria=[GrammarMaskPrefetcher(processor)])
+    """
+
+    def __init__(self, processor: GrammarConstrainedLogitsProcessor):
+        self.processor = processor
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        self.processor.prefetch(input_ids)
+        return torch.zeros(len(input_ids), dtype=torch.bool, device=input_ids.device)
+
+
 """
 # --------------------------------------------------------------------------- #
 # -- Custom LogitsProcessor that *blocks* tokens leading to an error state -- #
@@ -0,0 +1,166 @@
+"""
+Per-step statistics of `GrammarConstrainedLogitsProcessor`.
+
+Statistics are off by default, and then cost a single `is None` check per step. With
+`GrammarConstrainedLogitsProcessor(..., stats=True)` they are accumulated in `processor.stats`, and with
+`stats_callback=fn`, `fn` is called with the `StepStats` of every step (e.g. to export them).
+
+Timings are measured on the host: on an accelerator, the kernels of a step may still be running when it
+is timed. With `async_masks`, the state update and the masks are computed in the background and
+`state_update_seconds` is the time spent waiting for them.
+"""
+
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+# counters read from the constraint, reported as per-step differences
+_COUNTERS = (
+    "mask_cache_hits",
+    "mask_cache_misses",
+    "cache_lookup_seconds",
+    "parse_state_hits",
+    "parse_state_misses",
+    "trie_nodes_visited",
+)
+
+
+def read_counters(grammar_constraint) -> Dict[str, float]:
+    """Cumulative counters of a constraint, 0 for the ones it doesn't have."""
+    counters = dict.fromkeys(_COUNTERS, 0)
+    mask_cache = getattr(grammar_constraint, "mask_cache", None)
+    if mask_cache is not None:
+        counters["mask_cache_hits"] = mask_cache.hits
+        counters["mask_cache_misses"] = mask_cache.misses
+        counters["cache_lookup_seconds"] = mask_cache.lookup_seconds
+    parse_states = getattr(grammar_constraint, "parse_states", None)
+    if parse_states is not None:
+        counters["parse_state_hits"] = parse_states.hits
+        counters["parse_state_misses"] = parse_states.misses
+    engine = getattr(grammar_constraint, "token_acceptance_engine", None)
+    if engine is not None:
+        counters["trie_nodes_visited"] = engine.nodes_visited
+    return counters
+
+
+@dataclass
+class StepStats:
+    """What a single call of the processor did."""
+
+    step: int
+    batch_size: int
+    # whether the state update and masks came from `prefetch`
+    prefetched: bool = False
+    state_update_seconds: float = 0.0
+    # computing the masks, including the cache lookups
+    mask_seconds: float = 0.0
+    cache_lookup_seconds: float = 0.0
+    # checking candidate tokens, in the lazy execution modes
+    check_seconds: float = 0.0
+    # moving the masks to the device of the logits and expanding them
+    transfer_seconds: float = 0.0
+    # setting the rejected logits to -inf
+    apply_seconds: float = 0.0
+    # number of stacks and deepest stack of each row after the update
+    num_stacks: List[int] = field(default_factory=list)
+    max_stack_depth: List[int] = field(default_factory=list)
+    trie_nodes_visited: int = 0
+    mask_cache_hits: int = 0
+    mask_cache_misses: int = 0
+    parse_state_hits: int = 0
+    parse_state_misses: int = 0
+
+    @property
+    def total_seconds(self) -> float:
+        return (
+            self.state_update_seconds
+            + self.mask_seconds
+            + self.check_seconds
+            + self.transfer_seconds
+            + self.apply_seconds
+        )
+
+    def as_dict(self) -> dict:
+        stats = asdict(self)
+        stats["total_seconds"] = self.total_seconds
+        return stats
+
+
+@dataclass
+class ProcessorStats:
+    """Statistics accumulated over the steps of a processor, see `StepStats`."""
+
+    steps: int = 0
+    state_update_seconds: float = 0.0
+    mask_seconds: float = 0.0
+    cache_lookup_seconds: float = 0.0
+    check_seconds: float = 0.0
+    transfer_seconds: float = 0.0
+    apply_seconds: float = 0.0
+    trie_nodes_visited: int = 0
+    mask_cache_hits: int = 0
+    mask_cache_misses: int = 0
+    parse_state_hits: int = 0
+    parse_state_misses: int = 0
+    max_num_stacks: int = 0
+    max_stack_depth: int = 0
+    last: Optional[StepStats] = None
+    _counters: Optional[Dict[str, float]] = field(default=None, repr=False)
+
+    def begin_step(self, batch_size: int, grammar_constraint) -> StepStats:
+        self._counters = read_counters(grammar_constraint)
+        return StepStats(step=self.steps, batch_size=batch_size)
+
+    def end_step(
+        self, step: StepStats, batch_parsing_states, grammar_constraint
+    ) -> None:
+        counters = read_counters(grammar_constraint)
+        for name, value in counters.items():
+            setattr(step, name, value - self._counters[name])
+        step.num_stacks = [len(state.stacks) for state in batch_parsing_states]
+        step.max_stack_depth = [
+            max((len(stack) for stack in state.stacks), default=0)
+            for state in batch_parsing_states
+        ]
+        self.steps += 1
+        for name in (
+            "state_update_seconds",
+            "mask_seconds",
+            "check_seconds",
+            "transfer_seconds",
+            "apply_seconds",
+        ) + _COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(step, name))
+        self.max_num_stacks = max([self.max_num_stacks, *step.num_stacks])
+        self.max_stack_depth = max([self.max_stack_depth, *step.max_stack_depth])
+        self.last = step
+
+    @property
+    def total_seconds(self) -> float:
+        return (
+            self.state_update_seconds
+            + self.mask_seconds
+            + self.check_seconds
+            + self.transfer_seconds
+            + self.apply_seconds
+        )
+
+    @property
+    def mask_cache_hit_rate(self) -> float:
+        lookups = self.mask_cache_hits + self.mask_cache_misses
+        return self.mask_cache_hits / lookups if lookups else 0.0
+
+    @property
+    def parse_state_hit_rate(self) -> float:
+        lookups = self.parse_state_hits + self.parse_state_misses
+        return self.parse_state_hits / lookups if lookups else 0.0
+
+    def as_dict(self) -> dict:
+        stats = {
+            name: value
+            for name, value in asdict(self).items()
+            if name not in ("last", "_counters")
+        }
+        stats["total_seconds"] = self.total_seconds
+        stats["mask_cache_hit_rate"] = self.mask_cache_hit_rate
+        stats["parse_state_hit_rate"] = self.parse_state_hit_rate
+        return stats
@@ -0,0 +1,177 @@
+"""
+Record and replay the token stream of a constrained generation, without the model.
+
+A `DecodingTrace` holds the grammar, the name of the tokenizer and the sequences produced by `generate`
+(prompt included), and is saved as gzipped JSON:
+
+    output = model.generate(input_ids, logits_processor=[processor], ...)
+    DecodingTrace.from_generation(processor, input_ids, output).save("trace.json.gz")
+
+`replay` drives a fresh `GrammarConstrainedLogitsProcessor` with the recorded tokens, one step at a time
+as `generate` does, and random logits in place of the model, to profile the grammar on its own:
+
+    report = replay(DecodingTrace.load("trace.json.gz"))
+    print(report.summary())
+"""
+
+import gzip
+import json
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+TRACE_FORMAT_VERSION = 1
+
+
+@dataclass
+class DecodingTrace:
+    grammar_str: str
+    start_rule_name: str
+    # `name_or_path` of the tokenizer, to load it again for the replay
+    tokenizer: str
+    prompt_length: int
+    # full sequences, prompt included
+    sequences: List[List[int]]
+    execution_mode: str = "full_mask"
+    # whether the grammar was optimized, see `transformers_cfg.grammar_optimizer`
+    optimize: bool = False
+    # where the grammar starts parsing the sequences, None to only parse the generated tokens
+    valid_token_start_idx: Optional[int] = None
+    metadata: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def from_generation(
+        cls,
+        processor,
+        input_ids: torch.LongTensor,
+        sequences: torch.LongTensor,
+        **metadata: str,
+    ) -> "DecodingTrace":
+        """Trace of `sequences` generated from the prompts `input_ids` with `processor`."""
+        grammar_constraint = processor.grammar_constraint
+        return cls(
+            grammar_str=grammar_constraint.grammar_str,
+            start_rule_name=grammar_constraint.start_rule_name,
+            tokenizer=getattr(grammar_constraint.tokenizer, "name_or_path", ""),
+            prompt_length=input_ids.shape[-1],
+            sequences=sequences.tolist(),
+            execution_mode=processor.execution_mode,
+            optimize=getattr(grammar_constraint, "optimize", False),
+            valid_token_start_idx=processor.valid_token_start_idx,
+            metadata=metadata,
+        )
+
+    @property
+    def num_steps(self) -> int:
+        return len(self.sequences[0]) - self.prompt_length
+
+    def save(self, path: str) -> None:
+        trace = {"version": TRACE_FORMAT_VERSION, **asdict(self)}
+        with gzip.open(path, "wt", encoding="utf-8") as file:
+            json.dump(trace, file, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str) -> "DecodingTrace":
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            trace = json.load(file)
+        version = trace.pop("version", None)
+        if version != TRACE_FORMAT_VERSION:
+            raise ValueError(f"unsupported trace format version {version}")
+        return cls(**trace)
+
+
+def _percentiles(seconds: List[float]) -> Dict[str, float]:
+    if not seconds:
+        return {}
+    ms = np.array(seconds) * 1e3
+    return {
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+
+
+@dataclass
+class ReplayReport:
+    """Per-step latencies of a replay, in seconds."""
+
+    step_seconds: List[float] = field(default_factory=list)
+    mask_seconds: List[float] = field(default_factory=list)
+    state_update_seconds: List[float] = field(default_factory=list)
+    # the slowest steps, as (step, seconds)
+    slowest_steps: List[tuple] = field(default_factory=list)
+
+    def summary(self) -> dict:
+        return {
+            "steps": len(self.step_seconds),
+            "step": _percentiles(self.step_seconds),
+            "mask": _percentiles(self.mask_seconds),
+            "state_update": _percentiles(self.state_update_seconds),
+            "slowest_steps": self.slowest_steps,
+        }
+
+
+def replay(
+    trace: DecodingTrace,
+    tokenizer=None,
+    execution_mode: Optional[str] = None,
+    seed: int = 0,
+    recorded_token_boost: float = 0.0,
+    num_slowest: int = 5,
+    **processor_kwargs,
+) -> ReplayReport:
+    """
+    Replay `trace` with a fresh constraint and processor and random logits.
+
+    The tokenizer is loaded from `trace.tokenizer` unless given. With `recorded_token_boost`, the logit of
+    the recorded token is raised by that much, as a confident model would, which matters for the lazy
+    execution modes. Extra keyword arguments are passed to the processor.
+    """
+    # imported here, the trace format itself doesn't depend on the processor
+    from transformers_cfg.generation.logits_process import (
+        GrammarConstrainedLogitsProcessor,
+    )
+    from transformers_cfg.grammar_utils import IncrementalGrammarConstraint
+
+    if tokenizer is None:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(trace.tokenizer)
+    grammar = IncrementalGrammarConstraint(
+        trace.grammar_str, trace.start_rule_name, tokenizer, optimize=trace.optimize
+    )
+    processor_kwargs.setdefault("valid_token_start_idx", trace.valid_token_start_idx)
+    processor = GrammarConstrainedLogitsProcessor(
+        grammar,
+        execution_mode=execution_mode or trace.execution_mode,
+        stats=True,
+        **processor_kwargs,
+    )
+    sequences = torch.tensor(trace.sequences)
+    generator = torch.Generator().manual_seed(seed)
+    report = ReplayReport()
+    try:
+        for step in range(trace.num_steps):
+            length = trace.prompt_length + step
+            scores = torch.randn((len(sequences), len(tokenizer)), generator=generator)
+            if recorded_token_boost:
+                scores[
+                    torch.arange(len(sequences)), sequences[:, length]
+                ] += recorded_token_boost
+            start = time.perf_counter()
+            processor(sequences[:, :length], scores)
+            report.step_seconds.append(time.perf_counter() - start)
+            step_stats = processor.stats.last
+            report.mask_seconds.append(step_stats.mask_seconds)
+            report.state_update_seconds.append(step_stats.state_update_seconds)
+    finally:
+        processor.close()
+    report.slowest_steps = sorted(
+        enumerate(report.step_seconds), key=lambda step: -step[1]
+    )[:num_slowest]
+    return report
@@ -0,0 +1,404 @@
+"""
+Optimization passes over a parsed grammar, between `parse_ebnf` and `StringRecognizer`.
+
+The encoding of `parse_ebnf` follows the grammar as written: every group and repetition is a rule of
+its own, and alternatives that start the same way are tried side by side. The recognizer keeps a stack
+per alternative being matched and a frame per rule on each stack, so the shape of the grammar drives
+the number of stacks and the cost of the masks. The passes rewrite the grammar into an equivalent one
+(same language from the start rule) with fewer rules and alternatives:
+
+- `merge_ranges`: merges the overlapping and adjacent ranges of char classes, and the alternatives that
+  only differ by their first char class, e.g. `"a" x | [b-c] x` into `[a-c] x`
+- `inline`: replaces the references to rules of a single alternative of at most one element, or used
+  once, by their body, and flattens `A ::= B | ...` when `B` is only used there
+- `dedupe`: merges the rules that match the same strings by construction (e.g. the rules of two `[0-9]+`)
+  and drops duplicate alternatives
+- `left_factor`: factors the common prefix of alternatives, `A ::= x y | x z` into `A ::= x A'` with
+  `A' ::= y | z`
+- `remove_unreachable`: drops the rules that the start rule doesn't reach
+
+Optimization is opt-in (`optimize=True` on the recognizers), the encoding of the optimized grammar
+differs from the one of the grammar as written:
+
+    parsed_grammar = optimize_grammar(parse_ebnf(grammar_str), "root")
+
+Rule ids are kept, so `symbol_table` still maps the names of the rules to their ids; rules that were
+inlined, merged or removed have no definition anymore and are only valid as start rule before
+optimization.
+"""
+
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, List, Sequence, Set, Tuple, Union
+
+from transformers_cfg.parser import (
+    END_OF_GRAMMAR_MARKER,
+    END_OF_RULE_MARKER,
+    REF_RULE_MARKER,
+    AlternativeElements,
+    GrammarRule,
+    ParseState,
+    ReferenceElement,
+    TerminalElement,
+    generate_symbol_id,
+)
+
+logger = logging.getLogger(__name__)
+
+# a reference is the id of the referenced rule, a terminal the tuple of its (start, end) ranges
+Element = Union[int, Tuple[Tuple[int, int], ...]]
+Alternative = Tuple[Element, ...]
+
+OPTIMIZATION_PASSES = (
+    "merge_ranges",
+    "inline",
+    "dedupe",
+    "left_factor",
+    "remove_unreachable",
+)
+# the passes are run again while they change the grammar, at most this many times
+DEFAULT_MAX_ROUNDS = 4
+
+
+class _Grammar:
+    def __init__(self, parsed_grammar: ParseState, start_rule_id: int):
+        self.start_rule_id = start_rule_id
+        self.rules = _read_rules(parsed_grammar.grammar_encoding)
+        # the optimized grammar, new rules get their ids from its symbol table
+        self.state = ParseState()
+        self.state.symbol_table = dict(parsed_grammar.symbol_table)
+        self.names = {
+            rule_id: name for name, rule_id in parsed_grammar.symbol_table.items()
+        }
+        self.names.update(
+            (rule_id, rule.name)
+            for rule_id, rule in parsed_grammar.grammar_rules.items()
+        )
+
+    def to_parse_state(self) -> ParseState:
+        state = self.state
+        for rule_id, alternatives in self.rules.items():
+            rule = GrammarRule(rule_id, self.names.get(rule_id, ""))
+            for elements in alternatives:
+                alternative = AlternativeElements()
+                for element in elements:
+                    if isinstance(element, int):
+                        alternative.add_symbol([ReferenceElement(element)])
+                    else:
+                        alternative.add_symbol([TerminalElement(list(element))])
+                rule.add_alternative(alternative)
+            state.add_rule(rule)
+        return state
+
+
+def _read_rules(grammar_encoding: List[int]) -> Dict[int, List[Alternative]]:
+    rules = {}
+    pos = 0
+    while grammar_encoding[pos] != END_OF_GRAMMAR_MARKER:
+        rule_id = grammar_encoding[pos]
+        pos += 1
+        alternatives = []
+        while grammar_encoding[pos] != END_OF_RULE_MARKER:
+            alternative_end = pos + grammar_encoding[pos]
+            pos += 1
+            elements = []
+            while pos < alternative_end:
+                if grammar_encoding[pos] == REF_RULE_MARKER:
+                    elements.append(grammar_encoding[pos + 1])
+                    pos += 2
+                else:
+                    size = grammar_encoding[pos]
+                    bounds = grammar_encoding[pos + 1 : pos + 1 + size]
+                    elements.append(tuple(zip(bounds[::2], bounds[1::2])))
+                    pos += size + 1
+            alternatives.append(tuple(elements))
+            # skip end of alternate marker
+            pos = alternative_end + 1
+        rules[rule_id] = alternatives
+        # skip end of rule marker
+        pos += 1
+    return rules
+
+
+def _references(alternative: Alternative):
+    return (element for element in alternative if isinstance(element, int))
+
+
+#############################
+#
+# Passes
+#
+#############################
+
+
+def _normalize_ranges(
+    ranges: Tuple[Tuple[int, int], ...],
+) -> Tuple[Tuple[int, int], ...]:
+    # empty ranges (start > end) match nothing
+    sorted_ranges = sorted(r for r in ranges if r[0] <= r[1])
+    if not sorted_ranges:
+        return ranges
+    merged = [sorted_ranges[0]]
+    for start, end in sorted_ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return tuple(merged)
+
+
+def merge_ranges(grammar: _Grammar) -> None:
+    for rule_id, alternatives in grammar.rules.items():
+        merged: List[Alternative] = []
+        # alternatives starting with a char class, by the elements that follow it
+        by_tail: Dict[Alternative, int] = {}
+        for alternative in alternatives:
+            alternative = tuple(
+                element if isinstance(element, int) else _normalize_ranges(element)
+                for element in alternative
+            )
+            if alternative and not isinstance(alternative[0], int):
+                tail = alternative[1:]
+                index = by_tail.get(tail)
+                if index is not None:
+                    ranges = _normalize_ranges(merged[index][0] + alternative[0])
+                    merged[index] = (ranges,) + tail
+                    continue
+                by_tail[tail] = len(merged)
+            merged.append(alternative)
+        grammar.rules[rule_id] = merged
+
+
+def _splice(alternative: Alternative, rule_id: int, body: Alternative) -> Alternative:
+    if rule_id not in alternative:
+        return alternative
+    spliced: List[Element] = []
+    for element in alternative:
+        if element == rule_id:
+            spliced.extend(body)
+        else:
+            spliced.append(element)
+    return tuple(spliced)
+
+
+def inline(grammar: _Grammar) -> None:
+    rules = grammar.rules
+    uses: Counter = Counter()
+    # rule id -> {(referencing rule id, index of the alternative)}, alternatives are only replaced or
+    # appended so that the indices stay valid
+    occurrences: Dict[int, Set[Tuple[int, int]]] = defaultdict(set)
+    for rule_id, alternatives in rules.items():
+        for index, alternative in enumerate(alternatives):
+            for ref in _references(alternative):
+                uses[ref] += 1
+                occurrences[ref].add((rule_id, index))
+
+    for rule_id in list(rules):
+        alternatives = rules[rule_id]
+        if (
+            rule_id == grammar.start_rule_id
+            or not occurrences[rule_id]
+            or any(rule_id in alternative for alternative in alternatives)
+        ):
+            continue
+        if len(alternatives) == 1:
+            body = alternatives[0]
+            if uses[rule_id] > 1 and len(body) > 1:
+                continue
+            places = occurrences.pop(rule_id)
+            for parent, index in places:
+                rules[parent][index] = _splice(rules[parent][index], rule_id, body)
+            for ref in _references(body):
+                uses[ref] += uses[rule_id] - 1
+                occurrences[ref].discard((rule_id, 0))
+                occurrences[ref].update(places)
+        else:
+            # only where the rule is a whole alternative, otherwise what comes before or after the
+            # reference would be matched once per alternative of the rule
+            if uses[rule_id] > 1:
+                continue
+            ((parent, index),) = occurrences[rule_id]
+            parent_alternatives = rules[parent]
+            if parent_alternatives[index] != (rule_id,):
+                continue
+            del occurrences[rule_id]
+            new_indices = [index] + list(
+                range(
+                    len(parent_alternatives),
+                    len(parent_alternatives) + len(alternatives) - 1,
+                )
+            )
+            parent_alternatives[index] = alternatives[0]
+            parent_alternatives.extend(alternatives[1:])
+            for old_index, (new_index, alternative) in enumerate(
+                zip(new_indices, alternatives)
+            ):
+                for ref in _references(alternative):
+                    occurrences[ref].discard((rule_id, old_index))
+                    occurrences[ref].add((parent, new_index))
+        del rules[rule_id]
+        del uses[rule_id]
+
+
+def dedupe(grammar: _Grammar) -> None:
+    rules = grammar.rules
+    # partition refinement: rules stay in the same class while their alternatives are the same up to
+    # the classes of the rules they reference
+    class_of = dict.fromkeys(rules, 0)
+    num_classes = 1
+    while True:
+        signatures: Dict[tuple, int] = {}
+        new_class_of = {}
+        for rule_id, alternatives in rules.items():
+            signature = (
+                class_of[rule_id],
+                frozenset(
+                    tuple(
+                        # undefined rules are only equivalent to themselves
+                        (
+                            ("ref", class_of.get(element, -1 - element))
+                            if isinstance(element, int)
+                            else ("chars", element)
+                        )
+                        for element in alternative
+                    )
+                    for alternative in alternatives
+                ),
+            )
+            new_class_of[rule_id] = signatures.setdefault(signature, len(signatures))
+        class_of = new_class_of
+        if len(signatures) == num_classes:
+            break
+        num_classes = len(signatures)
+
+    representatives: Dict[int, int] = {}
+    if grammar.start_rule_id in class_of:
+        representatives[class_of[grammar.start_rule_id]] = grammar.start_rule_id
+    for rule_id in rules:
+        representatives.setdefault(class_of[rule_id], rule_id)
+    replacement = {
+        rule_id: representatives[class_of[rule_id]]
+        for rule_id in rules
+        if representatives[class_of[rule_id]] != rule_id
+    }
+    for rule_id in replacement:
+        del rules[rule_id]
+    for rule_id, alternatives in rules.items():
+        # duplicate alternatives, in order
+        rules[rule_id] = list(
+            dict.fromkeys(
+                (
+                    tuple(replacement.get(element, element) for element in alternative)
+                    if replacement
+                    else alternative
+                )
+                for alternative in alternatives
+            )
+        )
+
+
+def _common_prefix_length(alternatives: List[Alternative]) -> int:
+    length = 0
+    for elements in zip(*alternatives):
+        if any(element != elements[0] for element in elements[1:]):
+            break
+        length += 1
+    return length
+
+
+def left_factor(grammar: _Grammar) -> None:
+    rules = grammar.rules
+    worklist = list(rules)
+    while worklist:
+        rule_id = worklist.pop()
+        alternatives = rules[rule_id]
+        groups: Dict[Element, List[Alternative]] = defaultdict(list)
+        for alternative in alternatives:
+            if alternative:
+                groups[alternative[0]].append(alternative)
+        if all(len(group) < 2 for group in groups.values()):
+            continue
+        factored: List[Alternative] = []
+        done = set()
+        for alternative in alternatives:
+            group = groups.get(alternative[0]) if alternative else None
+            if group is None or len(group) < 2:
+                factored.append(alternative)
+            elif alternative[0] not in done:
+                # the group is factored at the place of its first alternative
+                done.add(alternative[0])
+                prefix_length = _common_prefix_length(group)
+                suffixes = list(dict.fromkeys(a[prefix_length:] for a in group))
+                if len(suffixes) == 1:
+                    factored.append(alternative)
+                    continue
+                base_name = grammar.names.get(rule_id, "")
+                suffix_rule_id = generate_symbol_id(grammar.state, base_name)
+                grammar.names[suffix_rule_id] = f"{base_name}_{suffix_rule_id}"
+                rules[suffix_rule_id] = suffixes
+                factored.append(alternative[:prefix_length] + (suffix_rule_id,))
+                worklist.append(suffix_rule_id)
+        rules[rule_id] = factored
+
+
+def remove_unreachable(grammar: _Grammar) -> None:
+    rules = grammar.rules
+    reachable = {grammar.start_rule_id}
+    worklist = [grammar.start_rule_id]
+    while worklist:
+        for alternative in rules.get(worklist.pop(), ()):
+            for ref in _references(alternative):
+                if ref not in reachable:
+                    reachable.add(ref)
+                    worklist.append(ref)
+    for rule_id in [rule_id for rule_id in rules if rule_id not in reachable]:
+        del rules[rule_id]
+
+
+_PASSES = {
+    "merge_ranges": merge_ranges,
+    "inline": inline,
+    "dedupe": dedupe,
+    "left_factor": left_factor,
+    "remove_unreachable": remove_unreachable,
+}
+
+
+def _size(rules: Dict[int, List[Alternative]]) -> Tuple[int, int]:
+    return len(rules), sum(len(alternatives) for alternatives in rules.values())
+
+
+def optimize_grammar(
+    parsed_grammar: ParseState,
+    start_rule_name: str = "root",
+    passes: Sequence[str] = OPTIMIZATION_PASSES,
+    max_rounds: int = DEFAULT_MAX_ROUNDS,
+) -> ParseState:
+    """
+    An equivalent grammar from `start_rule_name`, rewritten by `passes` (see the module docstring).
+    `parsed_grammar` isn't modified, a grammar without `start_rule_name` is returned as is.
+    """
+    unknown = [name for name in passes if name not in _PASSES]
+    if unknown:
+        raise ValueError(
+            f"unknown optimization passes {unknown}, expected some of {list(_PASSES)}"
+        )
+    start_rule_id = parsed_grammar.symbol_table.get(start_rule_name)
+    if start_rule_id not in parsed_grammar.grammar_rules:
+        return parsed_grammar
+
+    grammar = _Grammar(parsed_grammar, start_rule_id)
+    size = _size(grammar.rules)
+    for _ in range(max_rounds):
+        before = {rule_id: list(alts) for rule_id, alts in grammar.rules.items()}
+        for name in passes:
+            _PASSES[name](grammar)
+        if grammar.rules == before:
+            break
+    logger.debug(
+        "optimized grammar from %d rules and %d alternatives to %d rules and %d alternatives",
+        *size,
+        *_size(grammar.rules),
+    )
+    return grammar.to_parse_state()
@@ -0,0 +1,119 @@
+"""
+Preallocated buffers to apply token masks to logits.
+
+Masks are applied as a `(batch_size, logits_vocab_size)` bool tensor of the rejected tokens, written
+into a buffer allocated once and reused at every step, then applied with `masked_fill`. The difference
+between the vocabulary of the tokenizer (the masks) and the one of the model (the logits) is resolved
+when the buffer is allocated: the model-only tokens are rejected once and for all, the tokenizer-only
+tokens are never copied.
+
+On an accelerator, packed masks (`VocabMask`, 1 bit per token) are copied to the device through a
+pinned staging buffer and only expanded there, instead of expanding them on the CPU and copying 1 byte
+per token.
+"""
+
+import logging
+from typing import Optional, Sequence
+
+import numpy as np
+import torch
+
+from transformers_cfg.vocab_mask import WORD_BITS, VocabMask, num_words
+
+logger = logging.getLogger(__name__)
+
+
+class MaskBuffers:
+    """Buffers for masks over `vocab_size` tokens applied to logits over `logits_vocab_size` tokens on `device`."""
+
+    def __init__(
+        self,
+        vocab_size: int,
+        logits_vocab_size: int,
+        device: Optional[torch.device] = None,
+    ):
+        self.vocab_size = vocab_size
+        self.logits_vocab_size = logits_vocab_size
+        self.device = (
+            torch.device(device) if device is not None else torch.device("cpu")
+        )
+        # columns shared by the masks and the logits
+        self.num_columns = min(vocab_size, logits_vocab_size)
+        self.num_rows = 0
+        self._rejected: Optional[torch.Tensor] = None
+        # packed masks, staged on the host and expanded on the device
+        self._pin_memory = self.device.type == "cuda"
+        self._packed_host: Optional[torch.Tensor] = None
+        self._packed_device: Optional[torch.Tensor] = None
+        self._bits: Optional[torch.Tensor] = None
+        self._bit_values = torch.tensor(
+            [1 << i for i in range(8)], dtype=torch.uint8, device=self.device
+        )
+        # the staging buffer is only rewritten once its last copy is done
+        self._copy_done = None
+
+    def _reserve(self, num_rows: int) -> None:
+        if num_rows <= self.num_rows:
+            return
+        self.num_rows = num_rows
+        # model-only tokens are always rejected, they are never written afterwards
+        self._rejected = torch.ones(
+            (num_rows, self.logits_vocab_size), dtype=torch.bool, device=self.device
+        )
+        self._packed_host = self._packed_device = self._bits = None
+
+    def rejected_from_acceptance(self, acceptance: torch.Tensor) -> torch.Tensor:
+        """Rejected tokens of a `(batch_size, vocab_size)` bool tensor of the accepted ones."""
+        num_rows = acceptance.shape[0]
+        self._reserve(num_rows)
+        rejected = self._rejected[:num_rows]
+        torch.logical_not(
+            acceptance[:, : self.num_columns], out=rejected[:, : self.num_columns]
+        )
+        return rejected
+
+    def rejected_from_masks(self, masks: Sequence[VocabMask]) -> torch.Tensor:
+        """Rejected tokens of a batch of packed masks, expanded on the device."""
+        num_rows = len(masks)
+        self._reserve(num_rows)
+        if self._packed_host is None:
+            num_bytes = num_words(self.vocab_size) * (WORD_BITS // 8)
+            self._packed_host = torch.empty(
+                (self.num_rows, num_bytes),
+                dtype=torch.uint8,
+                pin_memory=self._pin_memory,
+            )
+            self._packed_device = torch.empty(
+                (self.num_rows, num_bytes), dtype=torch.uint8, device=self.device
+            )
+            self._bits = torch.empty(
+                (self.num_rows, num_bytes, 8), dtype=torch.uint8, device=self.device
+            )
+        if self._copy_done is not None:
+            self._copy_done.synchronize()
+        packed_host = self._packed_host[:num_rows]
+        np.copyto(packed_host.numpy(), VocabMask.stack_words(masks).view(np.uint8))
+        packed_device = self._packed_device[:num_rows]
+        packed_device.copy_(packed_host, non_blocking=self._pin_memory)
+        if self._pin_memory:
+            self._copy_done = torch.cuda.Event()
+            self._copy_done.record()
+        # bit i of byte j is token 8 * j + i, as in `VocabMask`
+        bits = self._bits[:num_rows]
+        torch.bitwise_and(packed_device.unsqueeze(-1), self._bit_values, out=bits)
+        rejected = self._rejected[:num_rows]
+        torch.eq(
+            bits.view(num_rows, -1)[:, : self.num_columns],
+            0,
+            out=rejected[:, : self.num_columns],
+        )
+        return rejected
+
+    def matches(
+        self, vocab_size: int, logits_vocab_size: int, device: torch.device
+    ) -> bool:
+        return (
+            self.vocab_size == vocab_size
+            and self.logits_vocab_size == logits_vocab_size
+            and self.device == torch.device(device)
+        )
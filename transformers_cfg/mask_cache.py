@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Dict, Hashable, Optional
+
+import torch
+
+from transformers_cfg.vocab_mask import VocabMask
+
+logger = logging.getLogger(__name__)
+
+# default budget of a cache, packed masks of a 150k vocabulary take ~19 KB each
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+MaskCacheInfo = namedtuple(
+    "MaskCacheInfo", ["hits", "misses", "evictions", "currsize", "nbytes", "max_bytes"]
+)
+
+
+class _Entry:
+    __slots__ = ("mask", "tensors", "nbytes")
+
+    def __init__(self, mask: VocabMask):
+        self.mask = mask
+        # bool tensors of the mask, by device
+        self.tensors: Dict[str, torch.Tensor] = {}
+        self.nbytes = mask.words.nbytes
+
+
+class MaskCache:
+    """
+    LRU cache of token masks, bounded by the memory it holds.
+
+    Masks are stored as packed `VocabMask` bitsets on the CPU. The bool tensor of a mask is only
+    materialized on a device when it is requested (`to_tensor`) and counts towards the same budget,
+    so evicting a mask also releases its device memory.
+
+    Unlike a method-level `lru_cache`, the cache belongs to its recognizer: it is freed with it,
+    or explicitly with `clear()`/`close()`. It is safe to use from several threads.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._nbytes = 0
+        self._closed = False
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # with `timed`, the time spent in `get` is accumulated in `lookup_seconds`
+        self.timed = False
+        self.lookup_seconds = 0.0
+
+    def get(self, key: Hashable) -> Optional[VocabMask]:
+        if self.timed:
+            start = time.perf_counter()
+            try:
+                return self._get(key)
+            finally:
+                self.lookup_seconds += time.perf_counter() - start
+        return self._get(key)
+
+    def _get(self, key: Hashable) -> Optional[VocabMask]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry.mask
+
+    def put(self, key: Hashable, mask: VocabMask) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            if key in self._entries:
+                self._remove(key)
+            entry = _Entry(mask)
+            if entry.nbytes > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._nbytes += entry.nbytes
+            self._evict()
+
+    def to_tensor(
+        self, key: Hashable, mask: VocabMask, device: Optional[torch.device] = None
+    ) -> torch.Tensor:
+        """
+        The bool tensor of `mask` (cached under `key`) on `device`, materialized once per device.
+        The returned tensor is shared and must not be modified in place.
+        """
+        device_key = str(torch.device(device) if device is not None else "cpu")
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.mask is not mask:
+                return mask.to_tensor(device)
+            tensor = entry.tensors.get(device_key)
+            if tensor is None:
+                tensor = mask.to_tensor(device)
+                tensor_nbytes = tensor.numel() * tensor.element_size()
+                entry.tensors[device_key] = tensor
+                entry.nbytes += tensor_nbytes
+                self._nbytes += tensor_nbytes
+                self._entries.move_to_end(key)
+                self._evict()
+            return tensor
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key)
+        self._nbytes -= entry.nbytes
+
+    def _evict(self) -> None:
+        while self._nbytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def cache_info(self) -> MaskCacheInfo:
+        return MaskCacheInfo(
+            self.hits,
+            self.misses,
+            self.evictions,
+            len(self._entries),
+            self._nbytes,
+            self.max_bytes,
+        )
+
+    def clear(self) -> None:
+        """Drop all the masks and their device tensors, and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.lookup_seconds = 0.0
+
+    def close(self) -> None:
+        """Release everything, later masks are no longer cached."""
+        self.clear()
+        self._closed = True
@@ -0,0 +1,93 @@
+"""
+Persistent parse stacks.
+
+A stack of the recognizer is a sequence of grammar element offsets, the head (`stack[-1]`) being the element
+to match next. Stacks are stored as a graph-structured stack: a non-empty stack is a `StackNode` holding
+its head and the stack below it, and nodes are hash-consed, i.e. there is at most one live node per
+(head, stack below) pair. Hence
+- stacks share their common bottom part instead of copying it, pushing or popping an element is O(1)
+  whatever the depth of the stack
+- equal stacks are the same object, so hashing and comparing a stack is O(1) (by identity)
+
+The empty stack is `()`, so `len(stack)`, `stack[-1]`, `tuple(stack)` and `() in stacks` behave as with
+the tuples used before.
+"""
+
+import threading
+import weakref
+from typing import Iterable, Iterator, Tuple, Union
+
+EMPTY_STACK = ()
+
+# interned nodes by (head, stack below)
+_nodes: "weakref.WeakValueDictionary" = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+
+class StackNode:
+    """A non-empty stack, only created through `push`."""
+
+    __slots__ = ("head", "parent", "depth", "__weakref__")
+
+    def __init__(self, head: int, parent: "Stack"):
+        self.head = head
+        # the stack without its head
+        self.parent = parent
+        self.depth = len(parent) + 1
+
+    def __len__(self) -> int:
+        return self.depth
+
+    def __getitem__(self, index: int) -> int:
+        if index == -1:
+            return self.head
+        return tuple(self)[index]
+
+    def __iter__(self) -> Iterator[int]:
+        """Element offsets from the bottom to the head, as in the tuple of the stack."""
+        return reversed(list(self.top_down()))
+
+    def top_down(self) -> Iterator[int]:
+        stack = self
+        while stack:
+            yield stack.head
+            stack = stack.parent
+
+    def __repr__(self) -> str:
+        return f"StackNode{tuple(self)}"
+
+    # nodes are immutable and interned, copies would break the identity of equal stacks
+
+    def __copy__(self) -> "StackNode":
+        return self
+
+    def __deepcopy__(self, memo) -> "StackNode":
+        return self
+
+    def __reduce__(self):
+        return as_stack, (tuple(self),)
+
+
+Stack = Union[Tuple[()], StackNode]
+
+
+def push(stack: Stack, element_offset: int) -> StackNode:
+    """The stack with `element_offset` as new head, in O(1)."""
+    key = (element_offset, stack)
+    node = _nodes.get(key)
+    if node is None:
+        with _lock:
+            node = _nodes.get(key)
+            if node is None:
+                node = _nodes[key] = StackNode(element_offset, stack)
+    return node
+
+
+def as_stack(element_offsets: Iterable[int]) -> Stack:
+    """The stack of a sequence of element offsets, from the bottom to the head (e.g. a tuple stack)."""
+    if isinstance(element_offsets, StackNode):
+        return element_offsets
+    stack = EMPTY_STACK
+    for element_offset in element_offsets:
+        stack = push(stack, element_offset)
+    return stack
@@ -4,7 +4,7 @@ import sys
 from abc import ABC
 from functools import cached_property
 from dataclasses import dataclass, field
-from typing import List, Tuple, Dict, Set
+from typing import List, Tuple, Dict, Optional, Set
 
 logger = logging.getLogger(__name__)
 
@@ -48,6 +48,11 @@ class TerminalElement(GrammarElement):
             outbuf.extend(range)
         return outbuf
 
+    @classmethod
+    def deserialize(cls, data: List[int]) -> "TerminalElement":
+        size = data[0]
+        return cls([(data[i], data[i + 1]) for i in range(1, size + 1, 2)])
+
     @classmethod
     def from_range(cls, start: int, end: int) -> "GrammarElement":
         return cls([(start, end)])
@@ -63,6 +68,11 @@ class ReferenceElement(GrammarElement):
     def serialize(self) -> List[int]:
         return [REF_RULE_MARKER, self.referee_id]
 
+    @classmethod
+    def deserialize(cls, data: List[int]) -> "ReferenceElement":
+        assert data[0] == REF_RULE_MARKER
+        return cls(data[1])
+
 
 @dataclass
 class AlternativeElements(Codable):
@@ -90,6 +100,21 @@ class AlternativeElements(Codable):
         outbuf.append(END_OF_ALTERNATE_MARKER)
         return outbuf
 
+    @classmethod
+    def deserialize(cls, data: List[int]) -> "AlternativeElements":
+        # the grouping of elements into symbols is not encoded, each element becomes a symbol
+        alternative = cls()
+        pos = 1
+        while pos < data[0]:
+            if data[pos] == REF_RULE_MARKER:
+                element = ReferenceElement.deserialize(data[pos : pos + 2])
+                pos += 2
+            else:
+                element = TerminalElement.deserialize(data[pos : pos + data[pos] + 1])
+                pos += data[pos] + 1
+            alternative.add_symbol([element])
+        return alternative
+
 
 @dataclass
 class GrammarRule(Codable):
@@ -112,6 +137,18 @@ class GrammarRule(Codable):
         outbuf.append(END_OF_RULE_MARKER)
         return outbuf
 
+    @classmethod
+    def deserialize(cls, data: List[int], name: str = "") -> "GrammarRule":
+        rule = cls(data[0], name)
+        pos = 1
+        while data[pos] != END_OF_RULE_MARKER:
+            alternative_end = pos + data[pos] + 1
+            rule.add_alternative(
+                AlternativeElements.deserialize(data[pos:alternative_end])
+            )
+            pos = alternative_end
+        return rule
+
 
 class ParseState:
     def __init__(self):
@@ -134,6 +171,38 @@ class ParseState:
         outbuf.append(END_OF_GRAMMAR_MARKER)
         return outbuf
 
+    @cached_property
+    def rule_offsets(self) -> List[int]:
+        return compute_rule_offsets(self.grammar_encoding)
+
+    @classmethod
+    def from_grammar_encoding(
+        cls,
+        grammar_encoding: List[int],
+        symbol_table: Dict[str, int],
+        rule_names: Optional[Dict[int, str]] = None,
+    ) -> "ParseState":
+        """Rebuild the parse state of a grammar from its encoding, e.g. loaded with `load_compiled`."""
+        state = cls()
+        state.symbol_table = dict(symbol_table)
+        if rule_names is None:
+            rule_names = {v: k for k, v in symbol_table.items()}
+        pos = 0
+        while grammar_encoding[pos] != END_OF_GRAMMAR_MARKER:
+            rule_end = pos + 1
+            while grammar_encoding[rule_end] != END_OF_RULE_MARKER:
+                rule_end += grammar_encoding[rule_end] + 1
+            rule_id = grammar_encoding[pos]
+            state.add_rule(
+                GrammarRule.deserialize(
+                    grammar_encoding[pos : rule_end + 1],
+                    rule_names.get(rule_id, ""),
+                )
+            )
+            pos = rule_end + 1
+        state.__dict__["grammar_encoding"] = list(grammar_encoding)
+        return state
+
     def print(self, file=sys.stdout):
         print_grammar(file, self)
 
@@ -183,6 +252,24 @@ class ParseState:
         graph.render(file, format="png", cleanup=True)
 
 
+def compute_rule_offsets(grammar_encoding: List[int]) -> List[int]:
+    """Offsets of the rules in the grammar encoding, indexed by rule id (-1 for undefined rules)."""
+    rule_offsets: List[int] = []
+    offset = 0
+    while grammar_encoding[offset] != END_OF_GRAMMAR_MARKER:
+        rule_id = grammar_encoding[offset]
+        if len(rule_offsets) <= rule_id:
+            rule_offsets.extend([-1] * (rule_id - len(rule_offsets) + 1))
+        rule_offsets[rule_id] = offset
+        # skip rule id and alternates
+        offset += 1
+        while grammar_encoding[offset] != END_OF_RULE_MARKER:
+            offset += 1 + grammar_encoding[offset]
+        # skip end of rule marker
+        offset += 1
+    return rule_offsets
+
+
 def get_symbol_id(state: ParseState, symbol_name: str) -> int:
     if symbol_name not in state.symbol_table:
         state.symbol_table[symbol_name] = len(state.symbol_table)
@@ -220,6 +307,35 @@ def hex_to_int(c: str) -> int:
     return -1
 
 
+def _syntax_error(src: str, pos: int, message: str) -> RuntimeError:
+    """`message` located at the line and column of `pos` in `src`, with the text that follows."""
+    line = src.count("\n", 0, pos) + 1
+    column = pos - (src.rfind("\n", 0, pos) + 1) + 1
+    line_end = src.find("\n", pos)
+    if line_end == -1:
+        line_end = len(src)
+    excerpt = src[pos : min(line_end, pos + 40)]
+    return RuntimeError(f"{message} at line {line}, column {column}: {excerpt!r}")
+
+
+# The parsing functions below walk an index over the grammar text and return the index after what they
+# parsed, so that parsing is linear in the size of the grammar. The functions taking and returning the
+# remaining text are thin wrappers around them.
+
+
+def _skip_white_space(src: str, pos: int, rm_leading_newline: bool) -> int:
+    end = len(src)
+    while pos < end and (src[pos].isspace() or src[pos] == "#"):
+        if src[pos] == "#":
+            while pos < end and src[pos] not in ("\r", "\n"):
+                pos += 1
+        else:
+            if not rm_leading_newline and src[pos] in ("\r", "\n"):
+                break
+            pos += 1
+    return pos
+
+
 def remove_leading_white_space(src, rm_leading_newline):
     """
     Skips over whitespace and comments in the input string.
@@ -239,16 +355,16 @@ def remove_leading_white_space(src, rm_leading_newline):
     Returns:
     str: The remaining portion of the input string after skipping whitespace and comments.
     """
-    pos = 0
-    while pos < len(src) and (src[pos].isspace() or src[pos] == "#"):
-        if src[pos] == "#":
-            while pos < len(src) and src[pos] not in ("\r", "\n"):
-                pos += 1
-        else:
-            if not rm_leading_newline and src[pos] in ("\r", "\n"):
-                break
-            pos += 1
-    return src[pos:]
+    return src[_skip_white_space(src, 0, rm_leading_newline) :]
+
+
+def _parse_name(src: str, pos: int) -> int:
+    end = pos
+    while end < len(src) and is_word_char(src[end]):
+        end += 1
+    if end == pos:
+        raise _syntax_error(src, pos, "expecting name")
+    return end
 
 
 def parse_name(src: str) -> Tuple[str, str]:
@@ -260,98 +376,106 @@ def parse_name(src: str) -> Tuple[str, str]:
     Returns:
         name, remaining_src
     """
-    pos = 0
-    while pos < len(src) and is_word_char(src[pos]):
-        pos += 1
-    if pos == 0:
-        raise RuntimeError("expecting name at " + src)
+    pos = _parse_name(src, 0)
     return src[:pos], src[pos:]
 
 
+def _parse_char(src: str, pos: int) -> Tuple[str, int]:
+    if pos >= len(src):
+        raise _syntax_error(src, pos, "unexpected end of input")
+    # if we have a backslash, it's maybe an escape
+    if src[pos] != "\\":
+        return src[pos], pos + 1
+    if pos + 1 >= len(src):
+        raise _syntax_error(src, pos, "incomplete escape")
+    esc = src[pos + 1]
+    if esc == "x":
+        if pos + 3 < len(src):
+            first = hex_to_int(src[pos + 2])
+            second = hex_to_int(src[pos + 3])
+            if first > -1 and second > -1:
+                return chr((first << 4) + second), pos + 4
+        raise _syntax_error(src, pos, "expecting \\xNN")
+    elif esc in ("u", "U"):
+        size = 4 if esc == "u" else 8
+        if pos + 2 + size > len(src):
+            raise _syntax_error(src, pos, f"incomplete \\{esc}{'X' * size} escape")
+        hex_value = src[pos + 2 : pos + 2 + size]
+        if all(c in "0123456789ABCDEFabcdef" for c in hex_value):
+            return chr(int(hex_value, 16)), pos + 2 + size
+        raise _syntax_error(src, pos, f"expecting \\{esc}{'X' * size}")
+    elif esc in ('"', "[", "]"):
+        return esc, pos + 2
+    elif esc == "r":
+        return "\r", pos + 2
+    elif esc == "n":
+        return "\n", pos + 2
+    elif esc == "t":
+        return "\t", pos + 2
+    elif esc == "\\":
+        return "\\", pos + 2
+    raise _syntax_error(src, pos, "unknown escape")
+
+
 def parse_char(src: str) -> Tuple[str, str]:
     """
     parse the leading char from the input string
     :param src:
     :return: char, remaining_src
     """
+    char, pos = _parse_char(src, 0)
+    return char, src[pos:]
 
-    # if we have a backslash, it's maybe an escape
-    if src[0] == "\\":
-        esc = src[1]
-        if esc == "x":
-            first = hex_to_int(src[2])
-            if first > -1:
-                second = hex_to_int(src[3])
-                if second > -1:
-                    return chr((first << 4) + second), src[4:]
-            raise RuntimeError("expecting \\xNN at " + src)
-        elif esc == "u":
-            if len(src) >= 6:
-                hex_value = src[2:6]
-                if all(c in "0123456789ABCDEFabcdef" for c in hex_value):
-                    return chr(int(hex_value, 16)), src[6:]
-                raise RuntimeError("expecting \\uXXXX at " + src)
-            raise RuntimeError("incomplete \\uXXXX escape at " + src)
-        elif esc == "U":
-            if len(src) >= 10:
-                hex_value = src[2:10]
-                if all(c in "0123456789ABCDEFabcdef" for c in hex_value):
-                    return chr(int(hex_value, 16)), src[10:]
-                raise RuntimeError("expecting \\UXXXXXXXX at " + src)
-            raise RuntimeError("incomplete \\UXXXXXXXX escape at " + src)
-        elif esc in ('"', "[", "]"):
-            return esc, src[2:]
-        elif esc == "r":
-            return "\r", src[2:]
-        elif esc == "n":
-            return "\n", src[2:]
-        elif esc == "t":
-            return "\t", src[2:]
-        elif esc == "\\":
-            return "\\", src[2:]
-        raise RuntimeError("unknown escape at " + src)
-    elif src:
-        return src[0], src[1:]
-    raise RuntimeError("unexpected end of input")
-
-
-def _parse_rhs_literal_string(src: str, alternative: AlternativeElements) -> str:
-    assert src[0] == '"', f"rule should start with '\"', but got {src[0]}"
-    remaining_src = src[1:]
 
+def _parse_rhs_literal_string_at(
+    src: str, pos: int, alternative: AlternativeElements
+) -> int:
+    assert src[pos] == '"', f"rule should start with '\"', but got {src[pos]}"
+    start = pos
+    pos += 1
     # advance until we get an end quote or run out of input
-    while remaining_src and remaining_src[0] != '"':
-        char, remaining_src = parse_char(remaining_src)
+    while pos < len(src) and src[pos] != '"':
+        char, pos = _parse_char(src, pos)
         alternative.add_element(TerminalElement([(ord(char), ord(char))]))
 
     # in case we ran out of input before finding the end quote
-    if not remaining_src:
-        raise RuntimeError(f"expecting an end quote at {src},but not found")
+    if pos >= len(src):
+        raise _syntax_error(src, start, "expecting an end quote for the string")
 
-    # remove the end quote and return the remaining string
-    return remaining_src[1:]
-
-
-def _parse_rhs_negated_char_ranges(src: str, alternative: AlternativeElements) -> str:
-    assert src[:2] == "[^", f"rule should start with '[^', but got {src[:2]}"
-    remaining_src = src[2:]
-    neg_outbuf = []
-    while remaining_src and remaining_src[0] != "]":
-        char, remaining_src = parse_char(remaining_src)
+    # skip the end quote
+    return pos + 1
 
-        neg_outbuf.append(ord(char))
-        if remaining_src[0] == "-" and remaining_src[1] != "]":
-            endchar_pair, remaining_src = parse_char(remaining_src[1:])
 
-            neg_outbuf.extend(range(ord(char) + 1, ord(endchar_pair)))
+def _parse_char_ranges(src: str, pos: int) -> Tuple[List[Tuple[int, int]], int]:
+    """The ranges of a char class from `pos`, after the opening bracket, and the index after the ']'."""
+    start = pos
+    ranges = []
+    while pos < len(src) and src[pos] != "]":
+        char, pos = _parse_char(src, pos)
+        if src.startswith("-", pos) and pos + 1 < len(src) and src[pos + 1] != "]":
+            endchar_pair, pos = _parse_char(src, pos + 1)
+            ranges.append((ord(char), ord(endchar_pair)))
         else:
-            # This is the case for enumerate, e.g., [^0123456789], [^abcdef]
+            # This is the case for enumerate, e.g., [0123456789], [abcdef]
             # Each char is considered as a range of itself, i.e., c-c
-            neg_outbuf.append(ord(char))
-    if not remaining_src:
-        raise RuntimeError(
-            f"expecting an ] at {src},but not found, is the char range closed?"
-        )
+            ranges.append((ord(char), ord(char)))
+    if pos >= len(src):
+        raise _syntax_error(src, start - 1, "expecting an ], is the char range closed?")
+    return ranges, pos + 1
+
+
+def _parse_rhs_negated_char_ranges_at(
+    src: str, pos: int, alternative: AlternativeElements
+) -> int:
+    assert src.startswith(
+        "[^", pos
+    ), f"rule should start with '[^', but got {src[pos:pos + 2]}"
+    excluded, pos = _parse_char_ranges(src, pos + 2)
+    neg_outbuf = []
+    for start, end in excluded:
+        # the upper bound of a range is not excluded, kept as is for compatibility of the encodings
+        neg_outbuf.append(start)
+        neg_outbuf.extend(range(start + 1, end))
 
     # Compute allowed chars ranges
     neg_outbuf = [-1] + sorted(set(neg_outbuf)) + [0xFF + 1]  # min ord, ..., max ord
@@ -365,49 +489,59 @@ def _parse_rhs_negated_char_ranges(src: str, alternative: AlternativeElements) -
             ranges.append((allowed_start, allowed_end))
 
     alternative.add_element(TerminalElement(ranges))
-    return remaining_src[1:]
+    return pos
 
 
-def _parse_rhs_char_ranges(src: str, alternative: AlternativeElements) -> str:
-    assert src[0] == "[", f"rule should start with '[', but got {src[0]}"
-    remaining_src = src[1:]
-    ranges = []
-    while remaining_src and remaining_src[0] != "]":
-        char, remaining_src = parse_char(remaining_src)
-
-        if remaining_src[0] == "-" and remaining_src[1] != "]":
-            endchar_pair, remaining_src = parse_char(remaining_src[1:])
-            ranges.append((ord(char), ord(endchar_pair)))
-        else:
-            # This is the case for enumerate, e.g., [0123456789], [abcdef]
-            # Each char is considered as a range of itself, i.e., c-c
-            ranges.append((ord(char), ord(char)))
-    if not remaining_src:
-        raise RuntimeError(
-            f"expecting an ] at {src},but not found, is the char range closed?"
-        )
+def _parse_rhs_char_ranges_at(
+    src: str, pos: int, alternative: AlternativeElements
+) -> int:
+    assert src[pos] == "[", f"rule should start with '[', but got {src[pos]}"
+    ranges, pos = _parse_char_ranges(src, pos + 1)
     alternative.add_element(TerminalElement(ranges))
-    return remaining_src[1:]
+    return pos
 
 
-def _parse_rhs_any_char(src: str, alternative: AlternativeElements) -> str:
-    assert src[0] == ".", f"rule should start with '.', but got {src[0]}"
-    remaining_src = src[1:]
+def _parse_rhs_any_char_at(src: str, pos: int, alternative: AlternativeElements) -> int:
+    assert src[pos] == ".", f"rule should start with '.', but got {src[pos]}"
     # The only symbol not allowed is '\n'
     alternative.add_element(
         TerminalElement([(0, ord("\n") - 1), (ord("\n") + 1, 0xFF)])
     )
-    return remaining_src
+    return pos + 1
+
+
+def _parse_rhs_symbol_reference_at(
+    src: str, pos: int, state: ParseState, alternative: AlternativeElements
+) -> int:
+    assert is_word_char(
+        src[pos]
+    ), f"rule should start with a word char, but got {src[pos]}"
+    end = _parse_name(src, pos)
+    ref_rule_id = get_symbol_id(state, src[pos:end])
+    alternative.add_element(ReferenceElement(ref_rule_id))
+    return end
+
+
+def _parse_rhs_literal_string(src: str, alternative: AlternativeElements) -> str:
+    return src[_parse_rhs_literal_string_at(src, 0, alternative) :]
+
+
+def _parse_rhs_negated_char_ranges(src: str, alternative: AlternativeElements) -> str:
+    return src[_parse_rhs_negated_char_ranges_at(src, 0, alternative) :]
+
+
+def _parse_rhs_char_ranges(src: str, alternative: AlternativeElements) -> str:
+    return src[_parse_rhs_char_ranges_at(src, 0, alternative) :]
+
+
+def _parse_rhs_any_char(src: str, alternative: AlternativeElements) -> str:
+    return src[_parse_rhs_any_char_at(src, 0, alternative) :]
 
 
 def _parse_rhs_symbol_reference(
     src: str, state: ParseState, alternative: AlternativeElements
 ) -> str:
-    assert is_word_char(src[0]), f"rule should start with a word char, but got {src[0]}"
-    name, remaining_src = parse_name(src)
-    ref_rule_id = get_symbol_id(state, name)
-    alternative.add_element(ReferenceElement(ref_rule_id))
-    return remaining_src
+    return src[_parse_rhs_symbol_reference_at(src, 0, state, alternative) :]
 
 
 """
@@ -416,12 +550,12 @@ def _parse_rhs_error_state(
 ) -> str:
     assert src[0] == "-", f"rule should start with '-', but got {src[0]}"
     remaining_src = remove_leading_white_space(src[1:], True)
-    
+
     # TODO: currently, we are not using the error state, so whatever follows the "-" is implemented as a normal rule
 
     # below is the same code as what's done in _parse_rhs_grouping()
     # but we essentially need a way to NEGATE whatever is generated from the parse_rhs() call done in here
-    
+
     # synthetic_rule_id = generate_symbol_id(state, rule_name)          # parse nested alternates into synthesized rule
     # remaining_src = parse_rhs(state, remaining_src, rule_name, synthetic_rule_id, True)   # TODO: how to NEGATE?
     # alternative.add_element(ReferenceElement(synthetic_rule_id))      # output reference to synthesized rule
@@ -431,37 +565,40 @@ def _parse_rhs_error_state(
 
 
 def _parse_rhs_grouping(
-    remaining_src: str,
+    src: str,
+    pos: int,
     state: ParseState,
     rule_name: str,
     alternative: AlternativeElements,
-) -> str:
-    assert (
-        remaining_src[0] == "("
-    ), f"rule should start with '(', but got {remaining_src[0]}"
-    remaining_src = remove_leading_white_space(remaining_src[1:], True)
+) -> int:
+    assert src[pos] == "(", f"rule should start with '(', but got {src[pos]}"
+    pos = _skip_white_space(src, pos + 1, True)
     # parse nested alternates into synthesized rule
     synthetic_rule_id = generate_symbol_id(state, rule_name)
-    remaining_src = parse_rhs(state, remaining_src, rule_name, synthetic_rule_id, True)
+    pos = _parse_rhs(state, src, pos, rule_name, synthetic_rule_id, True)
     # output reference to synthesized rule
     alternative.add_element(ReferenceElement(synthetic_rule_id))
 
-    if not remaining_src or remaining_src[0] != ")":
-        raise RuntimeError("expecting ')' at " + remaining_src)
-    return remaining_src[1:]
+    if not src.startswith(")", pos):
+        raise _syntax_error(src, pos, "expecting ')'")
+    return pos + 1
 
 
 def _parse_rhs_repetition_operators(
-    remaining_src: str,
+    src: str,
+    pos: int,
     state: ParseState,
     rule_name: str,
     alternative: AlternativeElements,
-) -> str:
-    assert remaining_src[0] in (
+) -> int:
+    operator = src[pos]
+    assert operator in (
         "*",
         "+",
         "?",
-    ), f"rule should start with '*', '+', or '?', but got {remaining_src[0]}"
+    ), f"rule should start with '*', '+', or '?', but got {operator}"
+    if not alternative.symbols:
+        raise _syntax_error(src, pos, f"expecting an item before '{operator}'")
 
     # apply transformation to previous symbol (last_sym_start -
     # end) according to rewrite rules:
@@ -473,38 +610,44 @@ def _parse_rhs_repetition_operators(
     sub_rule_first_alternative = sub_rule.add_empty_alternative()
     # add preceding symbol to generated rule
     sub_rule_first_alternative.add_symbol(alternative.symbols[-1])
-    if remaining_src[0] in ("*", "+"):
+    if operator in ("*", "+"):
         # cause generated rule to recurse
         sub_rule_first_alternative.add_element(ReferenceElement(sub_rule_id))
     sub_rule_second_alternative = AlternativeElements()
     sub_rule.add_alternative(sub_rule_second_alternative)
-    if remaining_src[0] == "+":
+    if operator == "+":
         # add preceding symbol as alternate only for '+'
         sub_rule_second_alternative.add_symbol(alternative.symbols[-1])
 
     state.add_rule(sub_rule)
     alternative.symbols[-1] = [ReferenceElement(sub_rule_id)]
-    return remaining_src[1:]
+    return pos + 1
 
 
 def _parse_rhs_numbered_repetition_operators(
-    remaining_src: str,
+    src: str,
+    pos: int,
     state: ParseState,
     rule_name: str,
     alternative: AlternativeElements,
-) -> str:
-    assert (
-        remaining_src[0] == "{"
-    ), f"rule should start with '{{', but got {remaining_src[0]}"
+) -> int:
+    assert src[pos] == "{", f"rule should start with '{{', but got {src[pos]}"
+    if not alternative.symbols:
+        raise _syntax_error(src, pos, "expecting an item before '{'")
 
     # parse numbers
-    closing_brace_idx = remaining_src.find("}")
-    numbers_src = remaining_src[1:closing_brace_idx]
+    closing_brace_idx = src.find("}", pos)
+    if closing_brace_idx == -1:
+        raise _syntax_error(src, pos, "expecting '}'")
+    numbers_src = src[pos + 1 : closing_brace_idx]
     n_src, m_src = (
-        numbers_src.split(",") if "," in numbers_src else (numbers_src, numbers_src)
+        numbers_src.split(",", 1) if "," in numbers_src else (numbers_src, numbers_src)
     )  # {n} -> {n, n}
-    n = int(n_src) if n_src else 0
-    m = int(m_src) if m_src else None
+    try:
+        n = int(n_src) if n_src.strip() else 0
+        m = int(m_src) if m_src.strip() else None
+    except ValueError:
+        raise _syntax_error(src, pos, "expecting {n}, {n,}, {,m} or {n,m}")
 
     # rules:
     # S{n} = S{n, n} --> S' ::= S S S ... S (n times)
@@ -532,134 +675,132 @@ def _parse_rhs_numbered_repetition_operators(
 
     state.grammar_rules[sub_rule_id] = sub_rule
     alternative.symbols[-1] = [ReferenceElement(sub_rule_id)]
-    return remaining_src[closing_brace_idx + 1 :]
+    return closing_brace_idx + 1
 
 
-def parse_simple_rhs(
-    state: ParseState, rhs: str, rule_name: str, rule: GrammarRule, is_nested: bool
-) -> str:
-    remaining_rhs = rhs
+def _parse_simple_rhs(
+    state: ParseState,
+    src: str,
+    pos: int,
+    rule_name: str,
+    rule: GrammarRule,
+    is_nested: bool,
+) -> int:
     alternative = AlternativeElements()
 
-    while remaining_rhs:
-        # print(f"remaining_rhs: '{remaining_rhs}'")
-        # print(f"remaining_rhs[0]: '{remaining_rhs[0]}'")
-        if remaining_rhs[0] == '"':
+    while pos < len(src):
+        char = src[pos]
+        if char == '"':
             # literal string
-            remaining_rhs = _parse_rhs_literal_string(remaining_rhs, alternative)
-        elif remaining_rhs[:2] == "[^":
+            pos = _parse_rhs_literal_string_at(src, pos, alternative)
+        elif src.startswith("[^", pos):
             # negated char range(s)
-            remaining_rhs = _parse_rhs_negated_char_ranges(remaining_rhs, alternative)
-        elif remaining_rhs[0] == "[":
+            pos = _parse_rhs_negated_char_ranges_at(src, pos, alternative)
+        elif char == "[":
             # char range(s)
-            remaining_rhs = _parse_rhs_char_ranges(remaining_rhs, alternative)
-        elif remaining_rhs[0] == ".":
+            pos = _parse_rhs_char_ranges_at(src, pos, alternative)
+        elif char == ".":
             # any char
-            remaining_rhs = _parse_rhs_any_char(remaining_rhs, alternative)
-        elif is_word_char(remaining_rhs[0]):
+            pos = _parse_rhs_any_char_at(src, pos, alternative)
+        elif is_word_char(char):
             # rule reference
-            remaining_rhs = _parse_rhs_symbol_reference(
-                remaining_rhs, state, alternative
-            )
-        # elif remaining_rhs[0] == "-":
-        #     # our error state
-        #     remaining_rhs = _parse_rhs_error_state(
-        #         remaining_rhs, state, rule_name, alternative
-        #     )
-        elif remaining_rhs[0] == "(":
+            pos = _parse_rhs_symbol_reference_at(src, pos, state, alternative)
+        elif char == "(":
             # grouping
-            remaining_rhs = _parse_rhs_grouping(
-                remaining_rhs, state, rule_name, alternative
+            pos = _parse_rhs_grouping(src, pos, state, rule_name, alternative)
+        elif char == "{":
+            # numbered repetition operator
+            pos = _parse_rhs_numbered_repetition_operators(
+                src, pos, state, rule_name, alternative
             )
-        elif remaining_rhs[0] in ("*", "+", "?", "{"):
+        elif char in ("*", "+", "?"):
             # repetition operator
-            if remaining_rhs[0] == "{":
-                remaining_rhs = _parse_rhs_numbered_repetition_operators(
-                    remaining_rhs, state, rule_name, alternative
-                )
-            else:
-                remaining_rhs = _parse_rhs_repetition_operators(
-                    remaining_rhs, state, rule_name, alternative
-                )
-        else:
-            # case for newline, i.e., end of rule
-            assert remaining_rhs[0] in [
-                "\n",
-                "|",
-                ")",
-            ], f"rule should end with newline or '|', but got {remaining_rhs[0]}"
-            # we break here so that we call parse_rule again to parse the next rule
+            pos = _parse_rhs_repetition_operators(
+                src, pos, state, rule_name, alternative
+            )
+        elif char in ("\r", "\n", "|", ")"):
+            # end of the alternative: newline ends the rule, we break here so that we call parse_rule
+            # again to parse the next rule
             break
+        else:
+            raise _syntax_error(src, pos, "unexpected character")
         # Here we do not rm newline deliberately so that we know the rhs is ended
-        remaining_rhs = remove_leading_white_space(
-            remaining_rhs, rm_leading_newline=is_nested
-        )
+        pos = _skip_white_space(src, pos, rm_leading_newline=is_nested)
 
         alternative.close_current_symbol()
 
     rule.add_alternative(alternative)
-    return remaining_rhs
+    return pos
 
 
-def parse_rhs(
-    state: ParseState, rhs: str, rule_name: str, rule_id: int, is_nested: bool
+def parse_simple_rhs(
+    state: ParseState, rhs: str, rule_name: str, rule: GrammarRule, is_nested: bool
 ) -> str:
+    return rhs[_parse_simple_rhs(state, rhs, 0, rule_name, rule, is_nested) :]
+
+
+def _parse_rhs(
+    state: ParseState,
+    src: str,
+    pos: int,
+    rule_name: str,
+    rule_id: int,
+    is_nested: bool,
+) -> int:
     rule = GrammarRule(rule_id, rule_name)
-    # print(f"parsed rule: {rule_name}")
-    remaining_rhs = parse_simple_rhs(state, rhs, rule_name, rule, is_nested)
-    while remaining_rhs and remaining_rhs[0] == "|":
-        remaining_rhs = remove_leading_white_space(remaining_rhs[1:], True)
-        remaining_rhs = parse_simple_rhs(
-            state, remaining_rhs, rule_name, rule, is_nested
-        )
+    pos = _parse_simple_rhs(state, src, pos, rule_name, rule, is_nested)
+    while src.startswith("|", pos):
+        pos = _skip_white_space(src, pos + 1, True)
+        pos = _parse_simple_rhs(state, src, pos, rule_name, rule, is_nested)
 
     state.add_rule(rule)
-    return remaining_rhs
+    return pos
 
 
-def parse_rule(state: ParseState, rule_text: str) -> str:
-    name, remaining_rule_text = parse_name(rule_text)
-    remaining_rule_text = remove_leading_white_space(remaining_rule_text, False)
+def parse_rhs(
+    state: ParseState, rhs: str, rule_name: str, rule_id: int, is_nested: bool
+) -> str:
+    return rhs[_parse_rhs(state, rhs, 0, rule_name, rule_id, is_nested) :]
+
+
+def _parse_rule(state: ParseState, src: str, pos: int) -> int:
+    name_end = _parse_name(src, pos)
+    name = src[pos:name_end]
+    pos = _skip_white_space(src, name_end, False)
     # check if the rule is already defined, TODO: what will happen if the rule is already defined?
     rule_id = get_symbol_id(state, name)
 
-    if remaining_rule_text[:3] != "::=":
-        raise RuntimeError("expecting ::= at " + remaining_rule_text)
-    remaining_rule_text = remove_leading_white_space(remaining_rule_text[3:], True)
+    if not src.startswith("::=", pos):
+        raise _syntax_error(src, pos, "expecting ::=")
+    pos = _skip_white_space(src, pos + 3, True)
 
-    remaining_rule_text = parse_rhs(state, remaining_rule_text, name, rule_id, False)
+    pos = _parse_rhs(state, src, pos, name, rule_id, False)
+
+    if src.startswith("\r\n", pos):
+        pos += 2
+    elif src.startswith("\r", pos) or src.startswith("\n", pos):
+        pos += 1
+    elif pos < len(src):
+        raise _syntax_error(src, pos, "expecting newline or end")
+    return _skip_white_space(src, pos, True)
 
-    if remaining_rule_text and remaining_rule_text[0] == "\r":
-        remaining_rule_text = (
-            remaining_rule_text[2:]
-            if remaining_rule_text[1] == "\n"
-            else remaining_rule_text[1:]
-        )
-    elif remaining_rule_text and remaining_rule_text[0] == "\n":
-        remaining_rule_text = remaining_rule_text[1:]
-    elif remaining_rule_text:
-        raise RuntimeError("expecting newline or end at " + remaining_rule_text)
-    return remove_leading_white_space(remaining_rule_text, True)
+
+def parse_rule(state: ParseState, rule_text: str) -> str:
+    return rule_text[_parse_rule(state, rule_text, 0) :]
 
 
 def parse_ebnf(grammar_text: str) -> ParseState:
     try:
         state = ParseState()
-        remaining_grammar_text = remove_leading_white_space(grammar_text, True)
-        last_grammar_repr = ""
-        while remaining_grammar_text:
-            if last_grammar_repr:
-                last_parsed_rule_len = len(last_grammar_repr) - len(
-                    remaining_grammar_text
-                )
-                logger.debug(
-                    f"last_parsed_rule: {last_grammar_repr[:last_parsed_rule_len]}"
-                )
-            last_grammar_repr = remaining_grammar_text
-            remaining_grammar_text = parse_rule(state, remaining_grammar_text)
+        pos = _skip_white_space(grammar_text, 0, True)
+        while pos < len(grammar_text):
+            rule_start = pos
+            pos = _parse_rule(state, grammar_text, pos)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"last_parsed_rule: {grammar_text[rule_start:pos]}")
         return state
     except RuntimeError as err:
-        logger.warning("error parsing grammar:", err)
+        logger.warning("error parsing grammar: %s", err)
         return ParseState()
 
 
@@ -0,0 +1,126 @@
+"""
+Process-wide cache of the parsing states of prompt prefixes.
+
+With `valid_token_start_idx`, the first call of a processor decodes the prefix of every row and parses it
+with the grammar. Requests often share long prefixes (system prompts, few-shot examples): the state after
+every `block_chars` characters of a parsed prefix is kept, keyed by the grammar and a hash of the text so
+far, and a prefix is parsed from its longest cached block instead of from the start, so that rows only
+parse their own tail.
+
+The key is the decoded text rather than the token ids, since the state only depends on the characters:
+the same prefix is found whatever the tokenizer and the tokenization.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Optional
+
+from transformers_cfg.recognizer import AcceptState, StringRecognizer
+
+# states are checkpointed every `block_chars` characters
+DEFAULT_BLOCK_CHARS = 64
+DEFAULT_MAX_ENTRIES = 65536
+
+PrefixCacheInfo = namedtuple(
+    "PrefixCacheInfo", ["hits", "misses", "reused_chars", "parsed_chars", "currsize"]
+)
+
+
+class PrefixStateCache:
+    """
+    LRU cache of the parsing states of text prefixes, by grammar. It is safe to use from several threads,
+    the states are immutable and shared by the recognizers of the same grammar.
+    """
+
+    def __init__(
+        self,
+        block_chars: int = DEFAULT_BLOCK_CHARS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        self.block_chars = block_chars
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[bytes, AcceptState]" = OrderedDict()
+        self._lock = threading.Lock()
+        # prefixes resumed from a cached block or parsed from the start
+        self.hits = 0
+        self.misses = 0
+        self.reused_chars = 0
+        self.parsed_chars = 0
+
+    def parse(
+        self, string_recognizer: StringRecognizer, grammar_key: str, text: str
+    ) -> AcceptState:
+        """The state of `text` from the initial state of `string_recognizer`, whose grammar is `grammar_key`."""
+        block = self.block_chars
+        hasher = hashlib.sha256(grammar_key.encode("utf-8"))
+        keys = []
+        for end in range(block, len(text) + 1, block):
+            hasher.update(text[end - block : end].encode("utf-8", "surrogatepass"))
+            keys.append(hasher.digest())
+
+        parsing_state, resumed = None, 0
+        with self._lock:
+            for i in range(len(keys) - 1, -1, -1):
+                parsing_state = self._entries.get(keys[i])
+                if parsing_state is not None:
+                    self._entries.move_to_end(keys[i])
+                    resumed = i + 1
+                    break
+            if parsing_state is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.reused_chars += resumed * block
+            self.parsed_chars += len(text) - resumed * block
+        if parsing_state is None:
+            parsing_state = string_recognizer.get_initial_parsing_state()
+
+        for i in range(resumed, len(keys)):
+            parsing_state = string_recognizer._update_state_with_string(
+                text[i * block : (i + 1) * block], parsing_state
+            )
+            self._put(keys[i], parsing_state)
+        # the tail after the last complete block isn't cached
+        return string_recognizer._update_state_with_string(
+            text[len(keys) * block :], parsing_state
+        )
+
+    def _put(self, key: bytes, parsing_state: AcceptState) -> None:
+        with self._lock:
+            self._entries[key] = parsing_state
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def info(self) -> PrefixCacheInfo:
+        with self._lock:
+            return PrefixCacheInfo(
+                self.hits,
+                self.misses,
+                self.reused_chars,
+                self.parsed_chars,
+                len(self._entries),
+            )
+
+    def clear(self) -> None:
+        """Drop all the states and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.reused_chars = 0
+            self.parsed_chars = 0
+
+
+_prefix_state_cache: Optional[PrefixStateCache] = None
+_prefix_state_cache_lock = threading.Lock()
+
+
+def get_prefix_state_cache() -> PrefixStateCache:
+    """The cache shared by the recognizers of this process."""
+    global _prefix_state_cache
+    with _prefix_state_cache_lock:
+        if _prefix_state_cache is None:
+            _prefix_state_cache = PrefixStateCache()
+        return _prefix_state_cache
@@ -1,10 +1,13 @@
 import logging
+import threading
 from functools import lru_cache
-from typing import List, Tuple, Set, Optional
+from typing import Callable, Dict, FrozenSet, Hashable, List, Set, Optional, Tuple
 
+from transformers_cfg.parse_stack import EMPTY_STACK, Stack, as_stack, push
 from transformers_cfg.parser import (
     END_OF_RULE_MARKER,
     END_OF_ALTERNATE_MARKER,
+    compute_rule_offsets,
     parse_ebnf,
     REF_RULE_MARKER,
 )
@@ -14,7 +17,7 @@ import logging
 
 
 class AcceptState:
-    def __init__(self, stacks: Set[Tuple[int]], partial_utf8: PartialUTF8):
+    def __init__(self, stacks: Set[Stack], partial_utf8: PartialUTF8):
         self.stacks = stacks
         self.partial_utf8 = partial_utf8
 
@@ -27,15 +30,90 @@ class AcceptState:
         if len(self.stacks) == 0:
             return True
         # if any of the stack is empty, we can stop
-        for stack in self.stacks:
-            if len(stack) == 0:
-                return True
-            else:
-                return False
+        return any(len(stack) == 0 for stack in self.stacks)
 
     def must_stop(self) -> bool:
         return len(self.stacks) == 0 or all(len(stack) == 0 for stack in self.stacks)
 
+    def key(self) -> Tuple[FrozenSet[Stack], PartialUTF8]:
+        """Hashable key of the state, equal for states with the same stacks and partial UTF-8 sequence."""
+        return frozenset(self.stacks), self.partial_utf8
+
+
+# beyond this number of interned states, a `ParseStateTable` starts over
+DEFAULT_MAX_PARSE_STATES = 100_000
+
+
+class ParseStateTable:
+    """
+    Interned parsing states, identified by small integers, and the memo of their transitions.
+
+    Equal states get the same id and share a canonical `AcceptState`, whose stacks are a frozenset
+    (so its key is computed in O(1)). Transitions are memoized as `(state id, label) -> state id`,
+    where the label is everything the next state depends on besides the current one, e.g. the bytes
+    of a token. Ids are only valid within the table, which is cleared when it holds `max_states` states.
+    """
+
+    def __init__(self, max_states: int = DEFAULT_MAX_PARSE_STATES):
+        self.max_states = max_states
+        self._ids: Dict[Hashable, int] = {}
+        self.states: List[AcceptState] = []
+        self._transitions: Dict[Tuple[int, Hashable], int] = {}
+        # bumped when the table is cleared, ids of previous generations are invalid
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def intern(self, parsing_state: AcceptState) -> int:
+        with self._lock:
+            return self._intern(parsing_state)
+
+    def _intern(self, parsing_state: AcceptState) -> int:
+        key = parsing_state.key()
+        state_id = self._ids.get(key)
+        if state_id is None:
+            if len(self.states) >= self.max_states:
+                self._clear()
+            state_id = self._ids[key] = len(self.states)
+            self.states.append(AcceptState(*key))
+        return state_id
+
+    def transition(
+        self,
+        parsing_state: AcceptState,
+        label: Hashable,
+        compute: Callable[[], AcceptState],
+    ) -> AcceptState:
+        """The canonical state after `label` from `parsing_state`, computed with `compute()` on a miss."""
+        with self._lock:
+            state_id = self._intern(parsing_state)
+            next_id = self._transitions.get((state_id, label))
+            if next_id is not None:
+                self.hits += 1
+                return self.states[next_id]
+            generation = self._generation
+        next_state = compute()
+        with self._lock:
+            self.misses += 1
+            next_id = self._intern(next_state)
+            if self._generation == generation:
+                self._transitions[(state_id, label)] = next_id
+            return self.states[next_id]
+
+    def _clear(self) -> None:
+        self._ids.clear()
+        self.states = []
+        self._transitions.clear()
+        self._generation += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+
 
 class StringRecognizer:
     def __init__(
@@ -43,7 +121,7 @@ class StringRecognizer:
         grammar_encoding: List[int],
         start_rule_id: int = -1,
         rule_offsets: Optional[List[int]] = None,
-        stacks: Optional[Set[Tuple[int]]] = None,
+        stacks: Optional[Set[Stack]] = None,
     ):
         # strictly speaking, we don't need to copy grammar_encoding because we don't modify it
         # but we do it anyway to be safe
@@ -57,8 +135,9 @@ class StringRecognizer:
             self.rule_offsets = self.init_rules(start_rule_id)
         # each stack is a list of indices into grammar_encoding
         # each index points to a rule's
+        # stacks are `StackNode`s, see `transformers_cfg.parse_stack`
         if stacks is not None:
-            self.stacks = stacks
+            self.stacks = {as_stack(stack) for stack in stacks}
         else:
             if start_rule_id == -1:
                 raise ValueError("start_rule_id cannot be None if stacks is None")
@@ -66,47 +145,26 @@ class StringRecognizer:
         self.start_rule_id = start_rule_id
 
     def init_rules(self, start_rule_id: int) -> List[int]:
-        _rule_offset = 0
-        rule_offsets: List = []
         # Build `rules` as an array of rule IDs to their positions in `grammar_src`
-        while self.grammar_encoding[_rule_offset] != 0xFFFF:
-            rule_id = self.grammar_encoding[_rule_offset]
-            # store the offset idx
-            if len(rule_offsets) <= rule_id:
-                rule_offsets.extend([-1] * (rule_id - len(rule_offsets) + 1))
-            rule_offsets[rule_id] = _rule_offset
-
-            # Skip rule ID
-            # _rule_offset += 1
-            simple_rhs_offset = _rule_offset + 1
-
-            # Skip rule alternates
-            while self.grammar_encoding[simple_rhs_offset] != END_OF_RULE_MARKER:
-                simple_rhs_offset = (
-                    simple_rhs_offset + 1 + self.grammar_encoding[simple_rhs_offset]
-                )
-
-            # Skip 0 denoting end of rule
-            # _rule_offset += 1
-            _rule_offset = simple_rhs_offset + 1
+        rule_offsets = compute_rule_offsets(self.grammar_encoding)
 
         retrieved_start_rule_id = self.grammar_encoding[rule_offsets[start_rule_id]]
         assert retrieved_start_rule_id == start_rule_id
 
         return rule_offsets
 
-    def init_stack(self, start_rule_id: int) -> Set[Tuple[int]]:
+    def init_stack(self, start_rule_id: int) -> Set[Stack]:
 
         stacks = set()
         # Loop over alternates of start rule to build initial stacks
         sub_rhs_offset = self.rule_offsets[start_rule_id] + 1
         while self.grammar_encoding[sub_rhs_offset]:
-            stack: List[int] = []
+            stack: Stack = EMPTY_STACK
             # If alternate is nonempty, add to stack
             element_offset = sub_rhs_offset + 1
             if self.grammar_encoding[element_offset] != END_OF_ALTERNATE_MARKER:
-                stack.append(element_offset)
-            stacks.update(self.expand_stack_head(tuple(stack)))
+                stack = push(stack, element_offset)
+            stacks.update(self.expand_stack_head(stack))
             sub_rhs_offset += 1 + self.grammar_encoding[sub_rhs_offset]
         return stacks
 
@@ -117,7 +175,7 @@ class StringRecognizer:
         return AcceptState(set(), PartialUTF8())
 
     @lru_cache(maxsize=32768)
-    def expand_stack_head(self, stack: Tuple[int]) -> Set[Tuple[int]]:
+    def expand_stack_head(self, stack: Stack) -> Set[Stack]:
         """
         Stack is the internal state of the recognizer(Pushdown Automaton).
         This method updates the stack by advancing it to the next element.
@@ -140,25 +198,22 @@ class StringRecognizer:
             ref_rule_id = self.grammar_encoding[cur_element_offset + 1]
             # find the offset of the referenced rule
             ref_subrule_offset = self.rule_offsets[ref_rule_id] + 1
-            new_stacks: Set[Tuple[int]] = set()
+            new_stacks: Set[Stack] = set()
+            # the original stack without the last element, shared by the new stacks
+            base_stack = stack.parent
+            # if the rule ref is followed by another element, we add it to the stack
+            next_element_offset = cur_element_offset + 2
+            if self.grammar_encoding[next_element_offset] != END_OF_ALTERNATE_MARKER:
+                base_stack = push(base_stack, next_element_offset)
             # Loop over alternates of referenced rule to build new stacks
             while self.grammar_encoding[ref_subrule_offset] != END_OF_RULE_MARKER:
-                # copy the original stack without the last element
-                new_stack = list(stack[:-1])
-                # if the rule ref is followed by another element, we add it to the stack
-                next_element_offset = cur_element_offset + 2
-                if (
-                    self.grammar_encoding[next_element_offset]
-                    != END_OF_ALTERNATE_MARKER
-                ):
-                    new_stack.append(next_element_offset)
-
+                new_stack = base_stack
                 # if the referenced rule is not empty, we add its element offset to the stack
                 ref_element_offset = ref_subrule_offset + 1
                 if self.grammar_encoding[ref_element_offset] != END_OF_ALTERNATE_MARKER:
-                    new_stack.append(ref_element_offset)
+                    new_stack = push(new_stack, ref_element_offset)
 
-                new_stacks.update(self.expand_stack_head(tuple(new_stack)))
+                new_stacks.update(self.expand_stack_head(new_stack))
                 ref_subrule_offset += self.grammar_encoding[ref_subrule_offset] + 1
 
             return new_stacks
@@ -174,7 +229,7 @@ class StringRecognizer:
     def _try_accept_bytes(
         self,
         byte_seq: bytes,
-        stacks: Set[Tuple[int]],
+        stacks: Set[Stack],
         partial_utf8: PartialUTF8,
         verbose=True,
     ):
@@ -242,13 +297,13 @@ class StringRecognizer:
 
     @lru_cache(maxsize=30000)
     def _update_state_with_code_point_for_all_stacks(
-        self, code_point: int, stacks: Tuple[Tuple[int]]
-    ) -> Set[Tuple[int]]:
+        self, code_point: int, stacks: FrozenSet[Stack]
+    ) -> Set[Stack]:
         """
         consume a character from the stack
         char_code_point: can be a Unicode code point, including ascii code points which are in the range [0, 127]
         """
-        new_stacks: Set[Tuple[int]] = set()
+        new_stacks: Set[Stack] = set()
 
         if code_point == 0:
             return new_stacks
@@ -260,8 +315,8 @@ class StringRecognizer:
 
     @lru_cache(maxsize=30000)
     def _update_state_with_code_point_for_single_stack(
-        self, code_point: int, stack: Tuple[int]
-    ) -> Set[Tuple[int]]:
+        self, code_point: int, stack: Stack
+    ) -> Set[Stack]:
         """
         consume a character from the stack
         char_code_point: can be a Unicode code point, including ascii code points which are in the range [0, 127]
@@ -272,7 +327,7 @@ class StringRecognizer:
         # code_point = 0 is a special case when the uf8 sequence is not complete, we return an empty stack
         # to indicate that the character is not accepted
 
-        new_stacks: Set[Tuple[int]] = set()
+        new_stacks: Set[Stack] = set()
         if code_point == 0:
             return new_stacks
         # stack is empty
@@ -287,27 +342,24 @@ class StringRecognizer:
 
         size = self.grammar_encoding[element_offset]
         element_offset += size + 1
-        new_stack = list(stack[:-1])
+        new_stack = stack.parent
         if self.grammar_encoding[element_offset]:
-            new_stack.append(element_offset)
-        # # Explicitly convert list to tuple of int to make it hashable
-        new_tuple_stack: Tuple[int, ...] = tuple(new_stack)
+            new_stack = push(new_stack, element_offset)
 
-        return self.expand_stack_head(new_tuple_stack)
+        return self.expand_stack_head(new_stack)
 
     def _update_state_with_code_points_for_all_stacks(
-        self, code_points: List[int], stacks: Set[Tuple[int]], verbose=False
-    ) -> Set[Tuple[int]]:
+        self, code_points: List[int], stacks: Set[Stack], verbose=False
+    ) -> Set[Stack]:
         """
         code points is a list of Unicode code points. For example, the code points for "hello" is [104, 101, 108, 108, 111]
         For unicode string "こんにちは世界", the code points are [12371, 12435, 12395, 12385, 12399, 19990, 30028]
 
         """
         for i, code_point in enumerate(code_points):
-            # for lru_cache to work, we need to convert the list of stacks into a tuple of stacks
-            tuple_stacks: Tuple[Tuple[int], ...] = tuple(stacks)
+            # for lru_cache to work, we need to convert the set of stacks into a frozenset
             stacks = self._update_state_with_code_point_for_all_stacks(
-                code_point, tuple_stacks
+                code_point, frozenset(stacks)
             )
             if len(stacks) > 0 and verbose:
                 accepted_code_point = code_points[: i + 1]
@@ -318,7 +370,7 @@ class StringRecognizer:
         return stacks
 
     def _accept_code_points(
-        self, code_points: List[int], stacks: Set[Tuple[int]], verbose=False
+        self, code_points: List[int], stacks: Set[Stack], verbose=False
     ) -> bool:
         stacks = self._update_state_with_code_points_for_all_stacks(
             code_points, stacks, verbose
@@ -423,6 +475,55 @@ class StringRecognizer:
         )
         return at_least_one_stack_is_empty
 
+    #############################
+    #
+    # Forced continuations
+    #
+    #############################
+
+    @lru_cache(maxsize=30000)
+    def single_code_point_at_element(self, element_offset: int) -> Optional[int]:
+        """The code point accepted by the element if it accepts exactly one, else None."""
+        size = self.grammar_encoding[element_offset]
+        ranges = self.grammar_encoding[element_offset + 1 : element_offset + 1 + size]
+        code_points = set(ranges)
+        if len(code_points) != 1:
+            return None
+        (code_point,) = code_points
+        # code point 0 marks an incomplete UTF-8 sequence
+        return code_point if code_point != 0 else None
+
+    def forced_continuation(
+        self, parsing_state: AcceptState, max_length: int = 256
+    ) -> str:
+        """
+        The longest string that every continuation of `parsing_state` starts with, up to `max_length`
+        characters: while all stacks expect the same single code point and none of them is exhausted
+        (i.e. stopping is not an option), that code point is forced.
+        """
+        if parsing_state.partial_utf8.n_remain > 0:
+            # in the middle of a code point
+            return ""
+        stacks = parsing_state.stacks
+        forced: List[str] = []
+        while stacks and len(forced) < max_length:
+            code_point = None
+            for stack in stacks:
+                if len(stack) == 0:
+                    return "".join(forced)
+                stack_code_point = self.single_code_point_at_element(stack[-1])
+                if stack_code_point is None or code_point not in (
+                    None,
+                    stack_code_point,
+                ):
+                    return "".join(forced)
+                code_point = stack_code_point
+            forced.append(chr(code_point))
+            stacks = self._update_state_with_code_point_for_all_stacks(
+                code_point, frozenset(stacks)
+            )
+        return "".join(forced)
+
     #############################
     #
     # Not Used
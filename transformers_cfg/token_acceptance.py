@@ -0,0 +1,518 @@
+import logging
+import weakref
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+import numpy as np
+
+from transformers_cfg.dfa import DEAD_STATE, ByteDFA, RegularityAnalysis
+from transformers_cfg.parse_stack import EMPTY_STACK, Stack, push
+from transformers_cfg.parser import (
+    END_OF_RULE_MARKER,
+    END_OF_GRAMMAR_MARKER,
+    REF_RULE_MARKER,
+)
+from transformers_cfg.recognizer import StringRecognizer
+from transformers_cfg.tokenization.byte_trie import ROOT_NODE, ByteTrie
+from transformers_cfg.utf8_utils import PartialUTF8, decode_utf8
+from transformers_cfg.vocab_mask import WORD_DTYPE, VocabMask
+
+logger = logging.getLogger(__name__)
+
+# the memos keyed by stacks are cleared when they reach this size
+MAX_CACHED_STACK_ENTRIES = 32768
+
+
+@dataclass
+class CompiledPosition:
+    """
+    Precomputed token acceptance for a single grammar element used as stack head.
+
+    The element is compiled in isolation, i.e. with the stack `(element_offset,)`.
+    - `accepted` holds the tokens that are accepted regardless of what lies below the head on the stack.
+    - `escape_nodes` are the trie nodes at which the local stack becomes empty while the token still
+      continues. Tokens below these nodes depend on the rest of the stack and are checked at runtime.
+    """
+
+    accepted: VocabMask
+    escape_nodes: np.ndarray = field(
+        default_factory=lambda: np.zeros(0, dtype=np.int32)
+    )
+    # bitset (4 x uint64) of the child bytes of each escape node, used to skip escape nodes cheaply
+    escape_child_bytes: Optional[np.ndarray] = None
+
+    @property
+    def is_context_free(self) -> bool:
+        return len(self.escape_nodes) == 0
+
+
+def _byte_table_to_words(byte_table: np.ndarray) -> np.ndarray:
+    """Pack a (..., 256) bool table into (..., 4) uint64 words."""
+    return np.packbits(byte_table, axis=-1, bitorder="little").view(WORD_DTYPE)
+
+
+def _csr_positions(starts: np.ndarray, counts: np.ndarray, total: int) -> np.ndarray:
+    """Concatenation of the ranges `starts[i]:starts[i] + counts[i]`."""
+    first = np.cumsum(counts) - counts
+    return np.repeat(starts - first, counts) + np.arange(total)
+
+
+class TokenAcceptanceEngine:
+    """
+    Ahead-of-time token acceptance for a grammar over a fixed vocabulary.
+
+    Instead of walking the whole `ByteTrie` for every stack at every decoding step, the engine
+    walks it once per grammar element (lazily, or eagerly via `compile`) and stores the set of
+    accepted tokens together with the trie nodes where acceptance depends on the enclosing context.
+    At runtime, the mask for a stack is the precomputed set plus a residual walk restricted to
+    the context-dependent subtrees.
+    """
+
+    def __init__(
+        self,
+        recognizer: StringRecognizer,
+        byte_trie: ByteTrie,
+        vocab_size: int,
+        eos_token_id: int,
+        use_unicode: bool,
+    ):
+        self.recognizer = recognizer
+        self.byte_trie = byte_trie.build()
+        self.vocab_size = vocab_size
+        self.eos_token_id = eos_token_id
+        self.use_unicode = use_unicode
+        self._compiled: Dict[Tuple[int, Optional[PartialUTF8]], CompiledPosition] = {}
+        # memos of the trie walks, they belong to the engine so that they are freed with it
+        self._element_byte_tables: Dict[int, np.ndarray] = {}
+        self._heads_byte_tables: Dict[FrozenSet[int], np.ndarray] = {}
+        self._byte_steps: Dict[Tuple[Stack, int], Set[Stack]] = {}
+        self._element_dfa_states: Dict[int, Optional[int]] = {}
+        # regular regions of the grammar are compiled into this automaton, see `element_dfa_state`
+        self.dfa = self._new_dfa()
+        # trie nodes expanded by the walks, approximate when masks are computed concurrently
+        self.nodes_visited = 0
+
+    def __len__(self):
+        return len(self._compiled)
+
+    def clear(self) -> None:
+        """Drop the compiled positions, the memos of the trie walks and the DFA states."""
+        self._compiled = {}
+        self._element_byte_tables = {}
+        self._heads_byte_tables = {}
+        self._byte_steps = {}
+        self._element_dfa_states = {}
+        # the compiled positions refer to the states of the DFA, which is rebuilt with them
+        self.dfa = self._new_dfa()
+
+    def _new_dfa(self) -> ByteDFA:
+        # the DFA holds the engine weakly, so that the engine is freed with its recognizer
+        engine = weakref.proxy(self)
+        return ByteDFA(
+            lambda stacks, byte: engine._step_byte(stacks, byte),
+            lambda stacks: engine._first_byte_table(stacks),
+        )
+
+    #############################
+    #
+    # Compilation
+    #
+    #############################
+
+    def terminal_element_offsets(self) -> List[int]:
+        """All offsets of terminal elements in the grammar encoding, i.e. all possible stack heads."""
+        grammar_encoding = self.recognizer.grammar_encoding
+        offsets = []
+        pos = 0
+        while grammar_encoding[pos] != END_OF_GRAMMAR_MARKER:
+            # skip rule id
+            pos += 1
+            while grammar_encoding[pos] != END_OF_RULE_MARKER:
+                alternative_end = pos + grammar_encoding[pos]
+                pos += 1
+                while pos < alternative_end:
+                    if grammar_encoding[pos] == REF_RULE_MARKER:
+                        pos += 2
+                    else:
+                        offsets.append(pos)
+                        pos += grammar_encoding[pos] + 1
+                # skip end of alternate marker
+                pos = alternative_end + 1
+            # skip end of rule marker
+            pos += 1
+        return offsets
+
+    def compile(self, element_offsets: Optional[List[int]] = None) -> None:
+        """Eagerly compile the given element offsets, or all terminal elements of the grammar."""
+        if element_offsets is None:
+            element_offsets = self.terminal_element_offsets()
+        partial_utf8 = PartialUTF8() if self.use_unicode else None
+        for element_offset in element_offsets:
+            self.get_compiled_position(element_offset, partial_utf8)
+        logger.debug(f"compiled token acceptance for {len(element_offsets)} elements")
+
+    def get_compiled_position(
+        self, element_offset: int, partial_utf8: Optional[PartialUTF8]
+    ) -> CompiledPosition:
+        key = (element_offset, partial_utf8)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = self._compile_position(element_offset, partial_utf8)
+            self._compiled[key] = compiled
+        return compiled
+
+    def _compile_position(
+        self, element_offset: int, partial_utf8: Optional[PartialUTF8]
+    ) -> CompiledPosition:
+        escape_nodes: List[int] = []
+        dfa_state = None
+        if partial_utf8 is None or partial_utf8.n_remain <= 0:
+            dfa_state = self.element_dfa_state(element_offset)
+        accepted_token_ids = None
+        if dfa_state is not None:
+            accepted_token_ids = self._walk_dfa(dfa_state, escape_nodes)
+        if accepted_token_ids is None:
+            accepted_token_ids = self._walk(
+                ROOT_NODE,
+                {push(EMPTY_STACK, element_offset)},
+                partial_utf8,
+                escape_nodes,
+            )
+        accepted = VocabMask.from_token_ids(self.vocab_size, accepted_token_ids)
+        escape_child_bytes = None
+        if escape_nodes:
+            trie = self.byte_trie
+            child_byte_table = np.zeros((len(escape_nodes), 256), dtype=bool)
+            for i, node in enumerate(escape_nodes):
+                lo, hi = trie.child_offsets[node], trie.child_offsets[node + 1]
+                child_byte_table[i, trie.child_bytes[lo:hi]] = True
+            escape_child_bytes = _byte_table_to_words(child_byte_table)
+        return CompiledPosition(
+            accepted, np.array(escape_nodes, dtype=np.int32), escape_child_bytes
+        )
+
+    #############################
+    #
+    # Trie walks
+    #
+    #############################
+
+    def _element_byte_table(self, element_offset: int) -> np.ndarray:
+        """
+        Bytes that can follow a code point boundary with the element as stack head.
+        In unicode mode, a byte starting a multi-byte character is allowed if the character can still be accepted.
+        """
+        byte_table = self._element_byte_tables.get(element_offset)
+        if byte_table is None:
+            byte_table = self._compute_element_byte_table(element_offset)
+            self._element_byte_tables[element_offset] = byte_table
+        return byte_table
+
+    def _compute_element_byte_table(self, element_offset: int) -> np.ndarray:
+        recognizer = self.recognizer
+        byte_table = np.zeros(256, dtype=bool)
+        for byte in range(256):
+            if not self.use_unicode:
+                byte_table[byte] = recognizer.accept_code_point_at_element(
+                    byte, element_offset
+                )
+                continue
+            code_points, partial_utf8 = decode_utf8(bytes([byte]), PartialUTF8())
+            if code_points:
+                byte_table[byte] = recognizer.accept_code_point_at_element(
+                    code_points[0], element_offset
+                )
+            else:
+                byte_table[byte] = recognizer.partial_utf8_accept_at_element(
+                    element_offset, partial_utf8
+                )
+        return byte_table
+
+    def _heads_byte_table(self, element_offsets: FrozenSet[int]) -> np.ndarray:
+        byte_table = self._heads_byte_tables.get(element_offsets)
+        if byte_table is None:
+            byte_table = np.zeros(256, dtype=bool)
+            for element_offset in element_offsets:
+                byte_table |= self._element_byte_table(element_offset)
+            if len(self._heads_byte_tables) >= MAX_CACHED_STACK_ENTRIES:
+                self._heads_byte_tables = {}
+            self._heads_byte_tables[element_offsets] = byte_table
+        return byte_table
+
+    def _first_byte_table(self, stacks) -> np.ndarray:
+        """The bytes that are accepted next by the non-empty stacks, on a code point boundary."""
+        return self._heads_byte_table(frozenset(stack[-1] for stack in stacks if stack))
+
+    def _step_byte(self, stacks, byte: int) -> Set[Stack]:
+        """Advance stacks by a single byte, interpreting the byte as a code point."""
+        new_stacks = set()
+        for stack in stacks:
+            if stack:
+                new_stacks.update(self._step_byte_single_stack(stack, byte))
+        return new_stacks
+
+    def _step_byte_single_stack(self, stack: Stack, byte: int) -> Set[Stack]:
+        key = (stack, byte)
+        new_stacks = self._byte_steps.get(key)
+        if new_stacks is None:
+            new_stacks = self._compute_byte_step(stack, byte)
+            if len(self._byte_steps) >= MAX_CACHED_STACK_ENTRIES:
+                self._byte_steps = {}
+            self._byte_steps[key] = new_stacks
+        return new_stacks
+
+    def _compute_byte_step(self, stack: Stack, byte: int) -> Set[Stack]:
+        recognizer = self.recognizer
+        element_offset = stack.head
+        if not recognizer.accept_code_point_at_element(byte, element_offset):
+            return set()
+        element_offset += recognizer.grammar_encoding[element_offset] + 1
+        new_stack = stack.parent
+        if recognizer.grammar_encoding[element_offset]:
+            new_stack = push(new_stack, element_offset)
+        return recognizer.expand_stack_head(new_stack)
+
+    def _walk(
+        self,
+        node: int,
+        stacks: Set[Stack],
+        partial_utf8: Optional[PartialUTF8],
+        escape_nodes: Optional[List[int]] = None,
+    ) -> np.ndarray:
+        """
+        Token ids below `node` (excluding the tokens ending at `node`) that are accepted from the given stacks.
+
+        The walk only records the subtrees it prunes; since a subtree is a contiguous range of the trie's
+        token order, the accepted tokens are the complement of these ranges.
+        """
+        rejected: List[np.ndarray] = []
+        if self.use_unicode:
+            self._walk_unicode(node, stacks, partial_utf8, rejected, escape_nodes)
+        else:
+            self._walk_bytes(node, stacks, rejected, escape_nodes)
+        return self._accepted_below(node, rejected)
+
+    def _accepted_below(self, node: int, rejected: List[np.ndarray]) -> np.ndarray:
+        """Token ids below `node`, except the ones in the `rejected` subtrees."""
+        trie = self.byte_trie
+        lo = trie.subtree_start[node] + trie.node_token_count[node]
+        hi = trie.subtree_end[node]
+        token_ids = trie.token_order[lo:hi]
+        if rejected:
+            rejected_nodes = np.concatenate(rejected)
+            # pruned subtrees are disjoint, so their boundaries are unique
+            boundaries = np.zeros(hi - lo + 1, dtype=np.int32)
+            boundaries[trie.subtree_start[rejected_nodes] - lo] += 1
+            boundaries[trie.subtree_end[rejected_nodes] - lo] -= 1
+            token_ids = token_ids[np.cumsum(boundaries[:-1]) == 0]
+        return token_ids[(token_ids >= 0) & (token_ids != self.eos_token_id)]
+
+    def _walk_bytes(
+        self,
+        node: int,
+        stacks: Set[Stack],
+        rejected: List[np.ndarray],
+        escape_nodes: Optional[List[int]] = None,
+    ) -> None:
+        trie = self.byte_trie
+        self.nodes_visited += 1
+        lo, hi = trie.child_offsets[node], trie.child_offsets[node + 1]
+        if lo == hi:
+            return
+        if escape_nodes is not None and () in stacks:
+            # the local rule is exhausted but the token continues: depends on the context
+            escape_nodes.append(node)
+        child_bytes = trie.child_bytes[lo:hi]
+        child_nodes = trie.child_nodes[lo:hi]
+        allowed = self._first_byte_table(stacks)[child_bytes]
+        if not allowed.all():
+            rejected.append(child_nodes[~allowed])
+        for byte, child in zip(
+            child_bytes[allowed].tolist(), child_nodes[allowed].tolist()
+        ):
+            self._walk_bytes(
+                child, self._step_byte(stacks, byte), rejected, escape_nodes
+            )
+
+    @cached_property
+    def regularity(self) -> RegularityAnalysis:
+        return RegularityAnalysis(
+            self.recognizer.grammar_encoding, self.recognizer.rule_offsets
+        )
+
+    def element_dfa_state(self, element_offset: int) -> Optional[int]:
+        """
+        State of `self.dfa` for the stack `(element_offset,)`,
+        or None if the element is not in a regular region of the grammar.
+        In unicode mode, only regions over ASCII code points are compiled, for which bytes are code points.
+        """
+        if element_offset in self._element_dfa_states:
+            return self._element_dfa_states[element_offset]
+        dfa_state = None
+        if self.regularity.is_regular_region(
+            element_offset, ascii_only=self.use_unicode
+        ):
+            dfa_state = self.dfa.state([push(EMPTY_STACK, element_offset)])
+        self._element_dfa_states[element_offset] = dfa_state
+        return dfa_state
+
+    def _walk_dfa(
+        self, start_state: int, escape_nodes: List[int]
+    ) -> Optional[np.ndarray]:
+        """
+        Walk of the whole trie through the transition table of the DFA, one trie level at a time.
+        Same result as `_walk` from the stacks of `start_state`, or None if the DFA grows too large.
+        """
+        trie = self.byte_trie
+        dfa = self.dfa
+        escape_nodes_of_walk: List[int] = []
+        # the walk visits exactly the accepted nodes
+        accepted_nodes: List[np.ndarray] = []
+        rejected: List[np.ndarray] = []
+        nodes = np.array([ROOT_NODE], dtype=np.int32)
+        states = np.array([start_state], dtype=np.int32)
+        while len(nodes):
+            self.nodes_visited += len(nodes)
+            starts = trie.child_offsets[nodes]
+            counts = trie.child_offsets[nodes + 1] - starts
+            escaping = dfa.exits[states] & (counts > 0)
+            escape_nodes_of_walk.extend(nodes[escaping].tolist())
+            if not dfa.expand(states):
+                return None
+            total = int(counts.sum())
+            if total == 0:
+                break
+            children = _csr_positions(starts, counts, total)
+            next_states = dfa.transitions[
+                np.repeat(states, counts), trie.child_bytes[children]
+            ]
+            child_nodes = trie.child_nodes[children]
+            alive = next_states != DEAD_STATE
+            rejected.append(child_nodes[~alive])
+            nodes = child_nodes[alive]
+            states = next_states[alive]
+            accepted_nodes.append(nodes)
+        escape_nodes.extend(escape_nodes_of_walk)
+
+        nodes = np.concatenate(accepted_nodes) if accepted_nodes else nodes
+        counts = trie.node_token_count[nodes]
+        num_accepted = int(counts.sum())
+        if num_accepted > len(trie.token_order) // 4:
+            # cheaper to remove the rejected subtrees from all the tokens
+            return self._accepted_below(ROOT_NODE, rejected)
+        nodes, counts = nodes[counts > 0], counts[counts > 0]
+        token_ids = trie.token_order[
+            _csr_positions(trie.subtree_start[nodes], counts, num_accepted)
+        ]
+        return token_ids[(token_ids >= 0) & (token_ids != self.eos_token_id)]
+
+    def _partial_accept(self, stacks, partial_utf8: PartialUTF8) -> bool:
+        for stack in stacks:
+            if len(stack) == 0:
+                return True
+            if self.recognizer.partial_utf8_accept_at_element(stack[-1], partial_utf8):
+                return True
+        return False
+
+    def _walk_unicode(
+        self,
+        node: int,
+        stacks: Set[Stack],
+        partial_utf8: PartialUTF8,
+        rejected: List[np.ndarray],
+        escape_nodes: Optional[List[int]] = None,
+    ) -> None:
+        trie = self.byte_trie
+        self.nodes_visited += 1
+        lo, hi = trie.child_offsets[node], trie.child_offsets[node + 1]
+        if lo == hi:
+            return
+        child_bytes = trie.child_bytes[lo:hi]
+        child_nodes = trie.child_nodes[lo:hi]
+        if () in stacks:
+            if escape_nodes is not None:
+                escape_nodes.append(node)
+            # an exhausted stack must not justify the acceptance of further (partial) bytes:
+            # locally the continuation is handled at runtime with the actual context,
+            # at runtime it is the end of the grammar
+            stacks = {stack for stack in stacks if stack}
+            if not stacks:
+                rejected.append(child_nodes)
+                return
+        recognizer = self.recognizer
+        if partial_utf8.n_remain <= 0:
+            # on a code point boundary, the byte table decides exactly which children are accepted
+            allowed = self._first_byte_table(stacks)[child_bytes]
+            if not allowed.all():
+                rejected.append(child_nodes[~allowed])
+            for byte, child in zip(
+                child_bytes[allowed].tolist(), child_nodes[allowed].tolist()
+            ):
+                code_points, new_partial_utf8 = decode_utf8(bytes([byte]), partial_utf8)
+                new_stacks = recognizer._update_state_with_code_points_for_all_stacks(
+                    code_points, stacks
+                )
+                self._walk_unicode(
+                    child, new_stacks, new_partial_utf8, rejected, escape_nodes
+                )
+            return
+        for i, byte in enumerate(child_bytes.tolist()):
+            code_points, new_partial_utf8 = decode_utf8(bytes([byte]), partial_utf8)
+            new_stacks = recognizer._update_state_with_code_points_for_all_stacks(
+                code_points, stacks
+            )
+            # every prefix of an accepted token must be accepted as well
+            if not self._partial_accept(new_stacks, new_partial_utf8):
+                rejected.append(child_nodes[i : i + 1])
+                continue
+            self._walk_unicode(
+                int(child_nodes[i]),
+                new_stacks,
+                new_partial_utf8,
+                rejected,
+                escape_nodes,
+            )
+
+    #############################
+    #
+    # Runtime
+    #
+    #############################
+
+    def get_token_acceptance(
+        self, stack: Stack, partial_utf8: PartialUTF8
+    ) -> VocabMask:
+        """
+        Acceptance over the vocabulary for a single stack, EOS excluded.
+        The returned mask may be shared with the engine and must not be modified in place.
+        """
+        if len(stack) == 0:
+            return VocabMask.zeros(self.vocab_size)
+        compiled = self.get_compiled_position(
+            stack[-1], partial_utf8 if self.use_unicode else None
+        )
+        if compiled.is_context_free or len(stack) == 1:
+            # for a stack of length 1, the context is empty and so are the escaped continuations
+            return compiled.accepted
+
+        context_stacks = self.recognizer.expand_stack_head(stack.parent)
+        first_bytes = _byte_table_to_words(self._first_byte_table(context_stacks))
+        candidates = np.flatnonzero(
+            (compiled.escape_child_bytes & first_bytes).any(axis=1)
+        )
+        if len(candidates) == 0:
+            return compiled.accepted
+
+        # the local stack can only be exhausted on a code point boundary
+        boundary = PartialUTF8() if self.use_unicode else None
+        token_ids = [
+            self._walk(int(compiled.escape_nodes[i]), context_stacks, boundary)
+            for i in candidates
+        ]
+        token_ids = np.concatenate(token_ids)
+        if len(token_ids) == 0:
+            return compiled.accepted
+        acceptance = compiled.accepted.copy()
+        acceptance.set_token_ids(token_ids)
+        return acceptance
@@ -1,23 +1,68 @@
+import bisect
 import logging
+import os
 from abc import ABC
-from functools import lru_cache
-from typing import List, Optional, Tuple
+from concurrent.futures import Executor
+from functools import cached_property
+from typing import Hashable, List, NamedTuple, Optional
 
+import numpy as np
 import torch
 from transformers import PreTrainedTokenizer
 
-from transformers_cfg.recognizer import StringRecognizer, AcceptState
+from transformers_cfg.mask_cache import DEFAULT_MAX_BYTES, MaskCache
+from transformers_cfg.parse_stack import Stack, as_stack, push
+from transformers_cfg.recognizer import (
+    AcceptState,
+    ParseStateTable,
+    StringRecognizer,
+)
+from transformers_cfg.compiled_grammar import grammar_hash, parse_ebnf_cached
+from transformers_cfg.grammar_optimizer import optimize_grammar
 from transformers_cfg.parser import parse_ebnf
-from transformers_cfg.tokenization.byte_trie import ByteTrie, TrieNode
+from transformers_cfg.prefix_cache import get_prefix_state_cache
+from transformers_cfg.token_acceptance import TokenAcceptanceEngine
+from transformers_cfg.tokenization.byte_trie import ROOT_NODE, ByteTrie, TrieNode
 from transformers_cfg.tokenization.mapping.token2byte import (
     Token2ByteMapping,
 )
+from transformers_cfg.tokenization.vocab_index import VocabularyIndex
 from transformers_cfg.utf8_utils import PartialUTF8
+from transformers_cfg.vocab_mask import VocabMask
 
 logger = logging.getLogger(__name__)
 
 
+class JumpForward(NamedTuple):
+    # tokens forced by the grammar, and the parsing state after them
+    token_ids: List[int]
+    parsing_state: AcceptState
+
+
+class TokenCheckpoint(NamedTuple):
+    """
+    Parsing state after the first `length` tokens of a sequence, linked to the checkpoint of a shorter
+    prefix. The checkpoints of a sequence form a chain shared with the sequences of the same prefix
+    (e.g. beams), rolling back k tokens walks up k links.
+    """
+
+    parent: Optional["TokenCheckpoint"]
+    length: int
+    state: AcceptState
+
+    def rollback(self, length: int) -> Optional["TokenCheckpoint"]:
+        """The last checkpoint of at most `length` tokens, None if the chain starts after them."""
+        checkpoint = self
+        while checkpoint is not None and checkpoint.length > length:
+            checkpoint = checkpoint.parent
+        return checkpoint
+
+
 class BaseTokenRecognizer(ABC):
+    # whether the states of a batch are updated token by token from the given states (see
+    # `IncrementalTokenRecognizer.advance_checkpoint`), rather than parsed again at each call
+    incremental = False
+
     def __init__(
         self,
         grammar_str: str,
@@ -25,23 +70,43 @@ class BaseTokenRecognizer(ABC):
         start_rule_name: Optional[str] = "root",
         trie: Optional[ByteTrie] = None,
         token2byte_mapping: Optional[Token2ByteMapping] = None,
+        vocab_index: Optional[VocabularyIndex] = None,
+        optimize: bool = False,
     ):
-        parsed_grammar = parse_ebnf(grammar_str)
+        # identical grammars are parsed once, see `transformers_cfg.compiled_grammar`
+        parsed_grammar = parse_ebnf_cached(grammar_str)
+        if optimize:
+            # the cached grammar isn't modified, see `transformers_cfg.grammar_optimizer`
+            parsed_grammar = optimize_grammar(parsed_grammar, start_rule_name)
         grammar_encoding = parsed_grammar.grammar_encoding
+        self.grammar_str = grammar_str
+        self.start_rule_name = start_rule_name
+        self.optimize = optimize
         self.parsed_grammar = parsed_grammar # may not need if we don't use self.id_symbol inside BlockBadStateLogitsProcessor
         parsed_grammar.print() # added for debugging
         self.start_rule_id = parsed_grammar.symbol_table.get(start_rule_name)
         self.use_unicode = self.detect_unicode(grammar_str)
 
-        self.eos_token_id = tokenizer.eos_token_id
         self.tokenizer = tokenizer
-        self.string_recognizer = StringRecognizer(grammar_encoding, self.start_rule_id)
+        self.string_recognizer = StringRecognizer(
+            grammar_encoding,
+            self.start_rule_id,
+            rule_offsets=parsed_grammar.rule_offsets,
+        )
+        # the vocabulary index is shared by all constraints over the same tokenizer
+        if vocab_index is None and (trie is None or token2byte_mapping is None):
+            vocab_index = VocabularyIndex.from_tokenizer(tokenizer)
+        self.vocab_index = vocab_index
+        if vocab_index is not None:
+            self.eos_token_id = vocab_index.eos_token_id
+        else:
+            self.eos_token_id = tokenizer.eos_token_id
         if trie is None:
-            self.byte_trie = ByteTrie.from_tokenizer(tokenizer)
+            self.byte_trie = vocab_index.byte_trie
         else:
             self.byte_trie = trie
         if token2byte_mapping is None:
-            self.token2byte_mapping = Token2ByteMapping.from_hf_tokenizer(tokenizer)
+            self.token2byte_mapping = vocab_index.new_token2byte_mapping()
         else:
             self.token2byte_mapping = token2byte_mapping
 
@@ -70,38 +135,75 @@ class BaseTokenRecognizer(ABC):
         """Process a list of tokens according to the grammar rules."""
         raise NotImplementedError
 
+    @property
+    def vocab_size(self) -> int:
+        return len(self.token2byte_mapping)
+
     def batch_filter_vocab(
-        self, batch_parsing_states: List[AcceptState], device: torch.device
+        self,
+        batch_parsing_states: List[AcceptState],
+        device: torch.device,
+        executor: Optional[Executor] = None,
     ) -> torch.Tensor:
-        batch_acceptance = []
-        for parsing_state in batch_parsing_states:
-            batch_acceptance.append(self.filter_vocab(parsing_state, device))
-        return torch.stack(batch_acceptance)
+        return VocabMask.batch_to_tensor(
+            self.batch_filter_vocab_mask(batch_parsing_states, executor), device
+        )
+
+    def batch_filter_vocab_mask(
+        self,
+        batch_parsing_states: List[AcceptState],
+        executor: Optional[Executor] = None,
+    ) -> List[VocabMask]:
+        """
+        Masks of a batch of parsing states. Rows with identical states (common with beam search)
+        share the same mask, which is computed once; distinct masks are computed on `executor` if given.
+        """
+        keys = [self.parsing_state_key(state) for state in batch_parsing_states]
+        unique_states = dict(zip(keys, batch_parsing_states))
+        masks = dict(
+            zip(
+                unique_states,
+                self._map(self.filter_vocab_mask, unique_states.values(), executor),
+            )
+        )
+        return [masks[key] for key in keys]
+
+    @staticmethod
+    def parsing_state_key(parsing_state: AcceptState) -> Hashable:
+        """Hashable key of a parsing state, equal for states accepting the same tokens."""
+        return parsing_state.key()
+
+    @staticmethod
+    def _map(fn, items, executor: Optional[Executor] = None) -> list:
+        items = list(items)
+        if executor is None or len(items) < 2:
+            return [fn(item) for item in items]
+        return list(executor.map(fn, items))
 
     def filter_vocab(
         self, parsing_state: AcceptState, device: torch.device
     ) -> torch.Tensor:
+        return self.filter_vocab_mask(parsing_state).to_tensor(device)
+
+    def filter_vocab_mask(self, parsing_state: AcceptState) -> VocabMask:
         if not parsing_state.stacks:  # Check if stacks is empty
-            # Handle the empty case: for example, return a tensor of False
-            # The size of the tensor should match the size of your vocabulary
-            vocab_size = len(self.token2byte_mapping)
+            # Handle the empty case: only EOS is accepted
             logger.debug(f"Empty stack, sum of acceptance: {0}")
-            # size of the vocab
-            accepts = [False] * vocab_size
-            accepts[self.eos_token_id] = True
-            return torch.tensor(accepts, dtype=torch.bool, device=device)
+            return VocabMask.from_token_ids(self.vocab_size, [self.eos_token_id])
 
-        acceptance = self.get_next_token_acceptance(parsing_state, device)
-        return acceptance
+        return self.get_next_token_acceptance_mask(parsing_state)
 
     def get_next_token_acceptance(
         self, parsing_state: AcceptState, device: torch.device
     ) -> torch.Tensor:
+        return self.get_next_token_acceptance_mask(parsing_state).to_tensor(device)
+
+    def get_next_token_acceptance_mask(self, parsing_state: AcceptState) -> VocabMask:
         raise NotImplementedError
 
     def validate_and_set_eos_acceptance(
-        self, acceptance: torch.Tensor, stack: Tuple[int]
-    ) -> torch.Tensor:
+        self, acceptance: VocabMask, stack: Stack
+    ) -> VocabMask:
         if len(stack) == 0:
             # if the stack is empty, we can accept EOS
             acceptance[self.eos_token_id] = True
@@ -116,6 +218,12 @@ class BaseTokenRecognizer(ABC):
         """Accept a list of token IDs according to the grammar rules."""
         raise NotImplementedError
 
+    def jump_forward(
+        self, parsing_state: AcceptState, max_length: int = 256
+    ) -> JumpForward:
+        """Tokens forced by the grammar from `parsing_state`, see `IncrementalTokenRecognizer.jump_forward`."""
+        raise NotImplementedError
+
     @staticmethod
     def detect_unicode(text: str) -> bool:
         # check if the text contains any unicode characters
@@ -123,6 +231,8 @@ class BaseTokenRecognizer(ABC):
 
 
 class IncrementalTokenRecognizer(BaseTokenRecognizer):
+    incremental = True
+
     def __init__(
         self,
         grammar_str: str,
@@ -130,6 +240,11 @@ class IncrementalTokenRecognizer(BaseTokenRecognizer):
         tokenizer: PreTrainedTokenizer,
         trie: Optional[ByteTrie] = None,
         homomorphism: Optional[Token2ByteMapping] = None,
+        precompile: bool = False,
+        vocab_index: Optional[VocabularyIndex] = None,
+        mask_cache_bytes: int = DEFAULT_MAX_BYTES,
+        use_prefix_cache: bool = True,
+        optimize: bool = False,
     ):
         super().__init__(
             grammar_str,
@@ -137,8 +252,30 @@ class IncrementalTokenRecognizer(BaseTokenRecognizer):
             start_rule_name,
             trie=trie,
             token2byte_mapping=homomorphism,
+            vocab_index=vocab_index,
+            optimize=optimize,
         )
         self.last_size = None
+        # token acceptance is compiled per grammar element, lazily unless `precompile` is set
+        self.token_acceptance_engine = TokenAcceptanceEngine(
+            self.string_recognizer,
+            self.byte_trie,
+            len(self.token2byte_mapping),
+            self.eos_token_id,
+            self.use_unicode,
+        )
+        if precompile:
+            self.token_acceptance_engine.compile()
+        # masks by (stack, partial utf8 state), freed with the recognizer
+        self.mask_cache = MaskCache(max_bytes=mask_cache_bytes)
+        # interned parsing states and the memo of their transitions by token
+        self.parse_states = ParseStateTable()
+        # states of the prompt prefixes, shared by the recognizers of the process
+        self.prefix_cache = get_prefix_state_cache() if use_prefix_cache else None
+        # the states of an optimized grammar are different
+        self._prefix_cache_key = (
+            f"{grammar_hash(grammar_str)}:{start_rule_name}:{int(optimize)}"
+        )
 
     def _update_state_with_token_id(
         self, token_id: int, parsing_state: AcceptState
@@ -162,11 +299,90 @@ class IncrementalTokenRecognizer(BaseTokenRecognizer):
                     f"the stacks are {parsing_state.stacks}"
                 )
 
-        bytes_or_codepoints = self.token2byte_mapping.map(token_id)
-        parsing_state = self.string_recognizer._update_state_with_bytes(
-            bytes_or_codepoints, parsing_state
+        # the mapping is called for every token, it keeps track of the position in the sequence
+        token_bytes = bytes(self.token2byte_mapping.map(token_id))
+        return self._update_state_with_token_bytes(token_bytes, parsing_state)
+
+    def advance_checkpoint(
+        self, checkpoint: TokenCheckpoint, token_ids: List[int]
+    ) -> TokenCheckpoint:
+        """The checkpoint after `token_ids` following `checkpoint`, with a checkpoint per token."""
+        for token_id in token_ids:
+            checkpoint = TokenCheckpoint(
+                checkpoint,
+                checkpoint.length + 1,
+                self._update_state_with_token_id(int(token_id), checkpoint.state),
+            )
+        return checkpoint
+
+    def _update_state_with_token_bytes(
+        self, token_bytes: bytes, parsing_state: AcceptState
+    ) -> AcceptState:
+        # the next state only depends on the bytes of the token, which may depend on its position
+        # (e.g. the leading space is dropped after BOS), so they label the transition rather than the token id
+        return self.parse_states.transition(
+            parsing_state,
+            token_bytes,
+            lambda: self.string_recognizer._update_state_with_bytes(
+                token_bytes, parsing_state
+            ),
         )
-        return parsing_state
+
+    def jump_forward(
+        self, parsing_state: AcceptState, max_length: int = 256
+    ) -> JumpForward:
+        """
+        Tokens forced by the grammar from `parsing_state`, e.g. a literal key or closing brackets in JSON.
+
+        The forced string is the longest string every continuation starts with
+        (`StringRecognizer.forced_continuation`, at most `max_length` characters), retokenized on its own.
+        The tokens can be appended to the sequence without sampling them, note that the model might
+        have picked a token spanning the end of the forced string and what follows.
+        """
+        forced = self.string_recognizer.forced_continuation(parsing_state, max_length)
+        token_ids = []
+        for token_id in self._tokenize_forced(forced.encode("utf-8")):
+            next_state = self._update_state_with_token_bytes(
+                self.token2byte_mapping.token_bytes(token_id), parsing_state
+            )
+            if not next_state.stacks:
+                break
+            token_ids.append(token_id)
+            parsing_state = next_state
+        return JumpForward(token_ids, parsing_state)
+
+    def _tokenize_forced(self, forced: bytes) -> List[int]:
+        if not forced:
+            return []
+        token_ids = self.tokenizer.encode(
+            forced.decode("utf-8"), add_special_tokens=False
+        )
+        token_bytes = self.token2byte_mapping.token_bytes
+        if b"".join(token_bytes(token_id) for token_id in token_ids) == forced:
+            return token_ids
+        # e.g. sentencepiece tokenizers prepend a space to the text
+        return self._longest_match_tokenize(forced)
+
+    def _longest_match_tokenize(self, data: bytes) -> List[int]:
+        """Greedy longest-match tokenization of `data` over the trie, stops at the first byte without a token."""
+        trie = self.byte_trie
+        token_ids = []
+        pos = 0
+        while pos < len(data):
+            node = ROOT_NODE
+            longest = None
+            for end in range(pos, len(data)):
+                node = trie.child(node, data[end])
+                if node is None:
+                    break
+                node_token_ids = trie.node_token_ids(node)
+                if len(node_token_ids) > 0:
+                    longest = (end + 1, int(node_token_ids[0]))
+            if longest is None:
+                break
+            pos, token_id = longest
+            token_ids.append(token_id)
+        return token_ids
 
         # if self.last_size is not set (which would be the case when processing the first token).
         # In this case, do nothing.
@@ -190,7 +406,7 @@ class IncrementalTokenRecognizer(BaseTokenRecognizer):
 
             # self.grammar_acceptor.accept_token_ids(valid_prefix_tokens, self.stacks)
             batch_parsing_states = [
-                self._update_state_with_single_token_seq(prefix, parsing_state)
+                self._parse_prefix(prefix, parsing_state)
                 for prefix, parsing_state in zip(
                     valid_prefix_tokens, batch_parsing_states
                 )
@@ -204,6 +420,16 @@ class IncrementalTokenRecognizer(BaseTokenRecognizer):
                     input_ids, batch_parsing_states
                 )
             ]
+        elif len(input_ids[0]) >= self.last_size:
+            # tokens appended without sampling them (see `jump_forward`), possibly none
+            new_batch_parsing_states = []
+            for single_input_ids, parsing_state in zip(input_ids, batch_parsing_states):
+                for token_id in single_input_ids[self.last_size :]:
+                    parsing_state = self._update_state_with_token_id(
+                        int(token_id), parsing_state
+                    )
+                new_batch_parsing_states.append(parsing_state)
+            batch_parsing_states = new_batch_parsing_states
             #  ensure that the input size is consistent with the expected incremental processing
             #  (i.e., one token at a time).
         else:
@@ -226,6 +452,29 @@ class IncrementalTokenRecognizer(BaseTokenRecognizer):
 
         return batch_parsing_states
 
+    def _parse_prefix(
+        self, token_ids: List[int], parsing_state: Optional[AcceptState] = None
+    ) -> AcceptState:
+        """
+        The state after the prompt prefix `token_ids`, parsed as text. When starting from the initial state,
+        the longest part of the text already parsed by a recognizer of the same grammar isn't parsed again
+        (see `transformers_cfg.prefix_cache`).
+        """
+        initial_state = self.string_recognizer.get_initial_parsing_state()
+        if (
+            self.prefix_cache is None
+            or len(token_ids) == 0
+            or (
+                parsing_state is not None and parsing_state.key() != initial_state.key()
+            )
+        ):
+            return self._update_state_with_single_token_seq(token_ids, parsing_state)
+        return self.prefix_cache.parse(
+            self.string_recognizer,
+            self._prefix_cache_key,
+            self.tokenizer.decode(token_ids),
+        )
+
     def _update_state_with_single_token_seq(
         self,
         token_ids: List[int],
@@ -251,6 +500,36 @@ class IncrementalTokenRecognizer(BaseTokenRecognizer):
                     logging.debug(f"The decoded string is {decoded_string}")
         return parsing_state
 
+    def try_accept_token_id(self, token_id: int, parsing_state: AcceptState) -> bool:
+        """
+        Whether the mask of `parsing_state` accepts `token_id`, without computing the mask.
+        Unlike `_update_state_with_token_id`, the token mapping is left untouched.
+        """
+        if token_id == self.eos_token_id:
+            return parsing_state.must_stop() or parsing_state.can_stop()
+        if (
+            not 0 <= token_id < len(self._trie_tokens)
+            or not self._trie_tokens[token_id]
+        ):
+            # special tokens are not in the trie and never accepted
+            return False
+        next_state = self._update_state_with_token_bytes(
+            self.token2byte_mapping.token_bytes(token_id), parsing_state
+        )
+        # an empty stack is kept whatever the bytes, but a finished parse cannot start a code point
+        return any(
+            len(stack) > 0 or next_state.partial_utf8.n_remain <= 0
+            for stack in next_state.stacks
+        )
+
+    @cached_property
+    def _trie_tokens(self) -> np.ndarray:
+        trie_tokens = np.zeros(self.vocab_size, dtype=bool)
+        trie_tokens[self.byte_trie.token_order] = True
+        # tokens without bytes end at the root of the trie, they are not accepted either
+        trie_tokens[self.byte_trie.node_token_ids(ROOT_NODE)] = False
+        return trie_tokens
+
     def accept_token_ids(
         self,
         token_ids: List[int],
@@ -262,54 +541,93 @@ class IncrementalTokenRecognizer(BaseTokenRecognizer):
         )
         return len(output_state.stacks) > 0
 
-    def get_next_token_acceptance(
-        self, parsing_state: AcceptState, device: torch.device
-    ) -> torch.Tensor:
-        acceptance_matrix = torch.stack(
+    def get_next_token_acceptance_mask(self, parsing_state: AcceptState) -> VocabMask:
+        # Merge stacks: accepted by any stack => accepted
+        return VocabMask.union(
             [
                 self.get_next_token_acceptance_for_single_stack(
-                    tuple(stack), parsing_state.partial_utf8, device
+                    stack, parsing_state.partial_utf8
                 )
                 for stack in parsing_state.stacks
             ]
         )
-        # Merge stacks: any True => True
-        acceptance = acceptance_matrix.any(dim=0)
-        return acceptance
 
-    # If running on a GPU device this cache can continue to fill up GPU memory
-    # Dereferencing the object will not clear the cache
-    @lru_cache(maxsize=32768)
-    def get_next_token_acceptance_for_single_stack(
-        self, stack: Tuple[int], partial_utf8: PartialUTF8, device: torch.device
+    def filter_vocab(
+        self, parsing_state: AcceptState, device: torch.device
     ) -> torch.Tensor:
-        # stack = list(stack)  # needs to come in as a tuple for lru_cache
-        assert isinstance(stack, tuple)
+        if len(parsing_state.stacks) != 1:
+            return super().filter_vocab(parsing_state, device)
+        # a single stack: the mask is the cached one, so is its tensor on the device
+        (stack,) = parsing_state.stacks
+        key = (stack, parsing_state.partial_utf8)
+        mask = self.get_next_token_acceptance_for_single_stack(*key)
+        return self.mask_cache.to_tensor(key, mask, device)
 
-        if self.use_unicode:
+    def batch_filter_vocab(
+        self,
+        batch_parsing_states: List[AcceptState],
+        device: torch.device,
+        executor: Optional[Executor] = None,
+    ) -> torch.Tensor:
+        if not all(len(state.stacks) == 1 for state in batch_parsing_states):
+            return super().batch_filter_vocab(batch_parsing_states, device, executor)
+        # single stacks: compute the distinct masks, then reuse their cached device tensors
+        keys = [
+            (next(iter(state.stacks)), state.partial_utf8)
+            for state in batch_parsing_states
+        ]
+        unique_keys = list(dict.fromkeys(keys))
+        masks = self._map(
+            lambda key: self.get_next_token_acceptance_for_single_stack(*key),
+            unique_keys,
+            executor,
+        )
+        tensors = {
+            key: self.mask_cache.to_tensor(key, mask, device)
+            for key, mask in zip(unique_keys, masks)
+        }
+        return torch.stack([tensors[key] for key in keys])
 
-            accept_f = lambda x: self.string_recognizer._try_accept_bytes(
-                x, {stack}, partial_utf8=partial_utf8
-            )
-            token_acceptance = self.byte_trie.get_next_token_acceptance(
-                accept=accept_f, accept_eos=False, eos_token_id=self.eos_token_id
+    def get_next_token_acceptance_for_single_stack(
+        self, stack: Stack, partial_utf8: PartialUTF8
+    ) -> VocabMask:
+        # the mask is cached and shared, it must not be modified
+        stack = as_stack(stack)
+        key = (stack, partial_utf8)
+        token_acceptance = self.mask_cache.get(key)
+        if token_acceptance is None:
+            token_acceptance = self._compute_token_acceptance_for_single_stack(
+                stack, partial_utf8
             )
-        else:
-            accepts = [False] * len(self.token2byte_mapping)
-            token_acceptance = check_token_acceptance_in_trie(
-                self.byte_trie.root,
-                [stack],
-                self.string_recognizer,
-                self.eos_token_id,
-                accepts,
+            self.mask_cache.put(key, token_acceptance)
+        return token_acceptance
+
+    def _compute_token_acceptance_for_single_stack(
+        self, stack: Stack, partial_utf8: PartialUTF8
+    ) -> VocabMask:
+        # precomputed acceptance of the stack head, plus a residual walk for context-dependent tokens
+        token_acceptance = self.token_acceptance_engine.get_token_acceptance(
+            stack, partial_utf8
+        )
+        if len(stack) == 0:
+            # the engine returns a fresh mask for an empty stack, so it's safe to modify it
+            token_acceptance = self.validate_and_set_eos_acceptance(
+                token_acceptance, stack
             )
-        x = torch.tensor(token_acceptance, dtype=torch.bool, device=device)
-        x_eos = self.validate_and_set_eos_acceptance(x, stack)
-        return x_eos
+        return token_acceptance
 
     def reset(self):
         self.last_size = None
 
+    def close(self):
+        """
+        Release the cached masks, including their device tensors, the interned parsing states and
+        what the token acceptance engine has compiled.
+        """
+        self.mask_cache.close()
+        self.parse_states.clear()
+        self.token_acceptance_engine.clear()
+
 
 # def check_token_acceptance_in_trie(trie, stacks, grammar, eos_token_id, accepts):
 
@@ -352,7 +670,7 @@ class IncrementalTokenRecognizer(BaseTokenRecognizer):
 
 def check_token_acceptance_in_trie(
     trie_node: TrieNode,
-    stacks: List[Tuple[int]],
+    stacks: List[Stack],
     recognizer: StringRecognizer,
     eos_token_id: int,
     accepts: List[bool],
@@ -380,10 +698,10 @@ def check_token_acceptance_in_trie(
                 continue
 
             next_element_offset += num_chars + 1
-            new_stack = list(stk[:-1])
+            new_stack = stk.parent
             if recognizer.grammar_encoding[next_element_offset]:
-                new_stack.append(next_element_offset)
-            new_stacks.update(recognizer.expand_stack_head(tuple(new_stack)))
+                new_stack = push(new_stack, next_element_offset)
+            new_stacks.update(recognizer.expand_stack_head(new_stack))
 
         if new_stacks:
             check_token_acceptance_in_trie(
@@ -393,9 +711,73 @@ def check_token_acceptance_in_trie(
     return accepts
 
 
+# beyond this number of checkpoints, a sequence keeps every other one
+DEFAULT_MAX_CHECKPOINTS = 256
+# tokens decoded again before the first changed token, see `NonIncrementalTokenSeqRecognizer._decode`
+DECODE_WINDOW_TOKENS = 8
+
+
+def _common_prefix_length(a: List[int], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    if a[:n] == b[:n]:
+        return n
+    return next(i for i in range(n) if a[i] != b[i])
+
+
+class ParseCheckpoints(NamedTuple):
+    """
+    Parsing states of the prefixes of a text, at increasing offsets starting with 0 (the initial state).
+    The state of a text only depends on its characters, so it can be resumed from any checkpoint whose
+    prefix it shares, whatever the tokens it was decoded from.
+    """
+
+    text: str
+    offsets: List[int]
+    states: List[AcceptState]
+    # the tokens `text` was decoded from
+    token_ids: Optional[List[int]] = None
+
+    def resume_point(self, text: str) -> int:
+        """Index of the last checkpoint whose prefix is also a prefix of `text`."""
+        if text.startswith(self.text):
+            return len(self.offsets) - 1
+        common = len(os.path.commonprefix([self.text, text]))
+        return bisect.bisect_right(self.offsets, common) - 1
+
+
 class NonIncrementalTokenSeqRecognizer(IncrementalTokenRecognizer):
-    def __init__(self, grammar_str, start_rule_name, tokenizer):
-        super().__init__(grammar_str, start_rule_name, tokenizer)
+    """
+    Recognizer parsing the decoded text of the generated tokens at each call rather than their bytes, so
+    that `input_ids` may be edited between calls (retokenized, rolled back, ...).
+
+    The states of the previous texts are kept as checkpoints (see `ParseCheckpoints`): a call only parses
+    the text after the longest prefix it shares with a previous text of the batch, not the whole text.
+    Likewise, only the tokens after the longest token prefix shared with a previous row, and a few before
+    them, are decoded again. What remains linear in the length of the output at each call is copying and
+    comparing the token ids and the text, which is much cheaper than decoding and parsing them.
+    """
+
+    incremental = False
+
+    def __init__(
+        self,
+        grammar_str,
+        start_rule_name,
+        tokenizer,
+        vocab_index=None,
+        max_checkpoints: int = DEFAULT_MAX_CHECKPOINTS,
+        optimize: bool = False,
+    ):
+        super().__init__(
+            grammar_str,
+            start_rule_name,
+            tokenizer,
+            vocab_index=vocab_index,
+            optimize=optimize,
+        )
+        self.max_checkpoints = max_checkpoints
+        # checkpoints of the text of each row at the previous call
+        self.checkpoints: List[ParseCheckpoints] = []
 
     def update_state_with_batch_token_seqs(
         self, input_ids, batch_parsing_states, valid_token_start_idx=None
@@ -413,7 +795,7 @@ class NonIncrementalTokenSeqRecognizer(IncrementalTokenRecognizer):
 
             # self.grammar_acceptor.accept_token_ids(valid_prefix_tokens, self.stacks)
             resulting_batch_parsing_states = [
-                self._update_state_with_single_token_seq(token_ids, parsing_state)
+                self._parse_prefix(token_ids, parsing_state)
                 for token_ids, parsing_state in zip(
                     valid_prefix_tokens, batch_parsing_states
                 )
@@ -421,24 +803,94 @@ class NonIncrementalTokenSeqRecognizer(IncrementalTokenRecognizer):
             #  if the length of the current input IDs (input_ids[0]) is exactly one more than self.last_size.
             #  This is expected in a scenario where inputs are processed incrementally, one token at a time.
             self.last_size = len(input_ids[0])
+            self.checkpoints = []
         else:
 
             # loop over the input_ids after the last_size
             resulting_batch_parsing_states = []
+            checkpoints = []
 
-            for single_input_ids, _ in zip(input_ids, batch_parsing_states):
+            for row, single_input_ids in enumerate(input_ids):
                 valid_input_ids = single_input_ids[self.last_size :]
-                # for i, token_id in enumerate(valid_input_ids):
-                # parsing_state = self._consume_token_id(token_id, parsing_state)
-                parsing_state = self._update_state_with_single_token_seq(
-                    valid_input_ids, parsing_state=None
-                )
+                if hasattr(valid_input_ids, "tolist"):
+                    token_ids = valid_input_ids.tolist()
+                else:
+                    token_ids = list(valid_input_ids)
+                row_checkpoints = self._parse_from_checkpoint(
+                    self._decode(token_ids, row), row
+                )._replace(token_ids=token_ids)
+                parsing_state = row_checkpoints.states[-1]
                 if len(parsing_state.stacks) == 0:
                     raise ValueError("The input is not accepted")
                 resulting_batch_parsing_states.append(parsing_state)
+                checkpoints.append(row_checkpoints)
+            self.checkpoints = checkpoints
 
         return resulting_batch_parsing_states
 
+    def _decode(self, token_ids: List[int], row: int) -> str:
+        """
+        The text of `token_ids`, from the text of the previous row sharing the most tokens with them.
+
+        Decoding isn't compositional (a character can span several tokens, sentencepiece drops the
+        leading space of the first token, ...), so the tokens are decoded again from a few tokens before
+        the first changed one, and the result is only used if the old tokens decoded from the same point
+        are a suffix of the old text.
+        """
+        best, best_common = None, 0
+        # the same row first, its tokens are a prefix at every step of a generation
+        for previous in self.checkpoints[row : row + 1] + self.checkpoints:
+            if previous.token_ids is None:
+                continue
+            common = _common_prefix_length(previous.token_ids, token_ids)
+            if common > best_common:
+                best, best_common = previous, common
+            if common == len(previous.token_ids):
+                break
+        start = best_common - DECODE_WINDOW_TOKENS
+        if best is not None and start > 0:
+            old_tail = self.tokenizer.decode(best.token_ids[start:])
+            if best.text.endswith(old_tail) and not old_tail.startswith("\ufffd"):
+                prefix = best.text[: len(best.text) - len(old_tail)]
+                return prefix + self.tokenizer.decode(token_ids[start:])
+        return self.tokenizer.decode(token_ids)
+
+    def _parse_from_checkpoint(self, text: str, row: int) -> ParseCheckpoints:
+        """Checkpoints of `text`, parsed from the best checkpoint of the previous texts of the batch."""
+        best, best_index = None, -1
+        if row < len(self.checkpoints) and text.startswith(self.checkpoints[row].text):
+            # the previous text of the row is a prefix, as at every step of a generation
+            best = self.checkpoints[row]
+            best_index = len(best.offsets) - 1
+        else:
+            for previous in self.checkpoints:
+                index = previous.resume_point(text)
+                if best is None or previous.offsets[index] > best.offsets[best_index]:
+                    best, best_index = previous, index
+        if best is None:
+            offsets = [0]
+            states = [self.string_recognizer.get_initial_parsing_state()]
+        else:
+            # rolled back edits drop the checkpoints after the common prefix
+            offsets = best.offsets[: best_index + 1]
+            states = best.states[: best_index + 1]
+        if offsets[-1] < len(text):
+            states.append(
+                self.string_recognizer._update_state_with_string(
+                    text[offsets[-1] :], states[-1]
+                )
+            )
+            offsets.append(len(text))
+        if len(offsets) > self.max_checkpoints:
+            # keep the initial state and the last one
+            offsets = offsets[:-1:2] + offsets[-1:]
+            states = states[:-1:2] + states[-1:]
+        return ParseCheckpoints(text, offsets, states)
+
+    def reset(self):
+        super().reset()
+        self.checkpoints = []
+
 
 if __name__ == "__main__":
     from transformers import AutoTokenizer
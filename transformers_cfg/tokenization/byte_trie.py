@@ -1,8 +1,9 @@
 import logging
-from functools import lru_cache
-from typing import Dict, List, Set, Tuple, Optional
+from typing import Dict, Iterable, List, Set, Tuple, Optional
 from collections import deque
 
+import numpy as np
+
 from transformers_cfg.tokenization.mapping.token2byte import (
     Token2ByteMapping,
 )
@@ -10,53 +11,240 @@ from transformers_cfg.tokenization.tokenizer import TCFG_Tokenizer
 
 logger = logging.getLogger(__name__)
 
+ROOT_NODE = 0
+
 
 class TrieNode:
-    def __init__(self):
-        self.children: Dict[int, "TrieNode"] = {}
-        self.is_end_of_word: bool = False
-        self.token_id: Optional[int] = None
+    """Read-only view of a node of a `ByteTrie`, kept for the node-based API."""
+
+    __slots__ = ("trie", "index")
+
+    def __init__(self, trie: "ByteTrie", index: int):
+        self.trie = trie
+        self.index = index
+
+    @property
+    def children(self) -> Dict[int, "TrieNode"]:
+        return {
+            byte: TrieNode(self.trie, child)
+            for byte, child in self.trie.children(self.index)
+        }
+
+    @property
+    def is_end_of_word(self) -> bool:
+        return self.trie.node_token_count[self.index] > 0
+
+    @property
+    def token_id(self) -> Optional[int]:
+        token_ids = self.trie.node_token_ids(self.index)
+        # as in a dict-based trie, the last token inserted with these bytes wins
+        return int(token_ids[-1]) if len(token_ids) else None
 
 
 class ByteTrie:
+    """
+    Byte-level trie over the vocabulary, stored as flat arrays.
+
+    Nodes are numbered in depth-first (pre-)order and tokens are laid out in the same order in
+    `token_order`, so the tokens below a node occupy the contiguous slice
+    `token_order[subtree_start[node]:subtree_end[node]]`, starting with the tokens of the node itself.
+    Pruning a subtree therefore rejects a contiguous range of positions.
+
+    - `child_offsets`, `child_bytes`, `child_nodes`: children in CSR layout, sorted by byte
+    - `node_token_count`: number of tokens ending at each node (tokens may share the same bytes)
+    """
+
+    ARRAY_NAMES = (
+        "child_offsets",
+        "child_bytes",
+        "child_nodes",
+        "node_token_count",
+        "subtree_start",
+        "subtree_end",
+        "token_order",
+    )
+
     def __init__(self):
-        self.root = TrieNode()
+        # (bytes, token id) pairs the arrays are built from, None for a trie restored from arrays
+        self._entries: Optional[List[Tuple[bytes, int]]] = []
+        self._built = False
+        self.vocab_size: Optional[int] = None
 
     def insert(self, word, token_id=None):
-        node = self.root
-        for char in word:
-            if char not in node.children:
-                node.children[char] = TrieNode()
-            node = node.children[char]
-        node.is_end_of_word = True
-        node.token_id = token_id
+        if self._entries is None:
+            self._entries = self._entries_from_arrays()
+        self._entries.append((bytes(word), token_id))
+        self._built = False
 
     @classmethod
-    def from_tokenizer(cls, tokenizer):
-        vocab: Dict[str, int] = tokenizer.get_vocab()
+    def from_token_bytes(
+        cls, entries: Iterable[Tuple[bytes, int]], vocab_size: Optional[int] = None
+    ) -> "ByteTrie":
         trie = cls()
-        mapping = Token2ByteMapping.from_hf_tokenizer(tokenizer)
+        trie._entries = [(bytes(word), token_id) for word, token_id in entries]
+        trie.vocab_size = vocab_size
+        trie._build()
+        return trie
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, use_cache: bool = True):
+        if use_cache:
+            from transformers_cfg.tokenization.vocab_cache import load_vocab_artifact
+
+            # the cached trie is shared by all users of the tokenizer
+            artifact = load_vocab_artifact(tokenizer)
+            if artifact is not None:
+                return artifact.trie
+        mapping = Token2ByteMapping.from_hf_tokenizer(tokenizer, use_cache=False)
+        return cls.from_token2byte_mapping(tokenizer, mapping)
+
+    @classmethod
+    def from_token2byte_mapping(cls, tokenizer, mapping: Token2ByteMapping):
+        vocab: Dict[str, int] = tokenizer.get_vocab()
         TCFG_tokenizer = TCFG_Tokenizer.from_hf_tokenizer(tokenizer)
 
         token_ids_to_ignore: Set[
             int
         ] = TCFG_tokenizer.get_special_token_ids_to_excluded()
-        for token_id in range(TCFG_tokenizer.real_vocab_size()):
-            if token_id not in token_ids_to_ignore:
-                byte_repr = mapping.map(token_id)
-                trie.insert(byte_repr, token_id)
-        trie.vocab_size = len(vocab)
+        entries = [
+            (mapping.map(token_id), token_id)
+            for token_id in range(TCFG_tokenizer.real_vocab_size())
+            if token_id not in token_ids_to_ignore
+        ]
+        return cls.from_token_bytes(entries, vocab_size=len(vocab))
+
+    @classmethod
+    def from_arrays(
+        cls, arrays: Dict[str, np.ndarray], vocab_size: Optional[int] = None
+    ) -> "ByteTrie":
+        """Restore a trie from `to_arrays`, e.g. from memory-mapped files."""
+        trie = cls()
+        for name in cls.ARRAY_NAMES:
+            setattr(trie, name, arrays[name])
+        trie._entries = None
+        trie._built = True
+        trie.vocab_size = vocab_size
         return trie
 
-    @lru_cache(maxsize=128)
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        self.build()
+        return {name: getattr(self, name) for name in self.ARRAY_NAMES}
+
+    def _entries_from_arrays(self) -> List[Tuple[bytes, int]]:
+        entries = []
+        nodes = [(ROOT_NODE, b"")]
+        while nodes:
+            node, word = nodes.pop()
+            for token_id in self.node_token_ids(node).tolist():
+                entries.append((word, token_id))
+            for byte, child in self.children(node):
+                nodes.append((child, word + bytes([byte])))
+        return entries
+
+    def _build(self):
+        # sorting the byte strings visits the trie in depth-first order:
+        # a prefix sorts before its extensions and siblings sort by byte
+        entries = sorted(self._entries, key=lambda entry: entry[0])
+
+        parents = [-1]
+        edge_bytes = [0]
+        token_counts = [0]
+        subtree_start = [0]
+        subtree_end = [len(entries)]
+        path = [ROOT_NODE]
+        previous = b""
+        for position, (word, _) in enumerate(entries):
+            common = 0
+            limit = min(len(word), len(previous))
+            while common < limit and word[common] == previous[common]:
+                common += 1
+            # close the subtrees that do not contain this word
+            while len(path) > common + 1:
+                subtree_end[path.pop()] = position
+            for depth in range(common, len(word)):
+                node = len(parents)
+                parents.append(path[-1])
+                edge_bytes.append(word[depth])
+                token_counts.append(0)
+                subtree_start.append(position)
+                subtree_end.append(len(entries))
+                path.append(node)
+            token_counts[path[-1]] += 1
+            previous = word
+
+        parents = np.array(parents, dtype=np.int32)
+        # stable sort: children of a node keep their (byte) order
+        child_nodes = np.argsort(parents[1:], kind="stable").astype(np.int32) + 1
+        self.child_offsets = np.searchsorted(
+            parents[child_nodes], np.arange(len(parents) + 1)
+        ).astype(np.int32)
+        self.child_nodes = child_nodes
+        self.child_bytes = np.array(edge_bytes, dtype=np.uint8)[child_nodes]
+        self.node_token_count = np.array(token_counts, dtype=np.int32)
+        self.subtree_start = np.array(subtree_start, dtype=np.int32)
+        self.subtree_end = np.array(subtree_end, dtype=np.int32)
+        self.token_order = np.array(
+            [-1 if token_id is None else token_id for _, token_id in entries],
+            dtype=np.int64,
+        )
+        # the entries can be recovered from the arrays if more tokens are inserted
+        self._entries = None
+        self._built = True
+        logger.debug(f"built ByteTrie with {self.num_nodes} nodes")
+
+    def build(self) -> "ByteTrie":
+        """Build the flat arrays, if tokens were inserted since the last build."""
+        if not self._built:
+            self._build()
+        return self
+
+    @property
+    def num_nodes(self) -> int:
+        self.build()
+        return len(self.node_token_count)
+
+    @property
+    def root(self) -> TrieNode:
+        self.build()
+        return TrieNode(self, ROOT_NODE)
+
+    def children(self, node: int) -> List[Tuple[int, int]]:
+        """(byte, child node) pairs of a node, sorted by byte"""
+        self.build()
+        lo, hi = self.child_offsets[node], self.child_offsets[node + 1]
+        return list(
+            zip(self.child_bytes[lo:hi].tolist(), self.child_nodes[lo:hi].tolist())
+        )
+
+    def child(self, node: int, byte: int) -> Optional[int]:
+        """The child of a node along `byte`, if any."""
+        self.build()
+        lo, hi = self.child_offsets[node], self.child_offsets[node + 1]
+        i = lo + int(np.searchsorted(self.child_bytes[lo:hi], byte))
+        if i < hi and self.child_bytes[i] == byte:
+            return int(self.child_nodes[i])
+        return None
+
+    def node_token_ids(self, node: int) -> np.ndarray:
+        self.build()
+        start = self.subtree_start[node]
+        return self.token_order[start : start + self.node_token_count[node]]
+
+    def subtree_token_ids(self, node: int) -> np.ndarray:
+        self.build()
+        return self.token_order[self.subtree_start[node] : self.subtree_end[node]]
+
     def __len__(self):
-        # return len(self.dfs(verbose=False))
-        return self.vocab_size
+        if self.vocab_size is not None:
+            return self.vocab_size
+        self.build()
+        return int(self.token_order.max()) + 1 if len(self.token_order) else 0
 
     def bfs(
         self, predicate=lambda x: True, verbose=False
     ) -> List[Tuple[List[int], int]]:
-        queue = deque([(self.root, [])])
+        self.build()
+        queue = deque([(ROOT_NODE, [])])
         valid_byte_seqs: List[Tuple[List[int], int]] = []
         counter = {"visited": 0, "pruned": 0}
 
@@ -64,9 +252,9 @@ class ByteTrie:
             counter["visited"] += 1
             node, byte_seq = queue.popleft()
             if predicate(byte_seq):
-                if node.is_end_of_word:
-                    valid_byte_seqs.append((byte_seq, node.token_id))
-                for char, next_node in node.children.items():
+                for token_id in self.node_token_ids(node).tolist():
+                    valid_byte_seqs.append((byte_seq, token_id))
+                for char, next_node in self.children(node):
                     new_byte_seq: List[int] = byte_seq.copy()
                     new_byte_seq.append(char)
                     queue.append((next_node, new_byte_seq))
@@ -93,12 +281,15 @@ class ByteTrie:
         def _visualize(node, prefix, depth):
             if depth > max_depth:
                 return
-            for char, next_node in node.children.items():
-                print(f"{prefix}{char} (Token ID: {next_node.token_id})")
+            for char, next_node in self.children(node):
+                print(
+                    f"{prefix}{char} (Token ID: {TrieNode(self, next_node).token_id})"
+                )
                 _visualize(next_node, prefix + "  ", depth + 1)
 
         print("Visualizing ByteTrie:")
-        _visualize(self.root, "", 1)
+        self.build()
+        _visualize(ROOT_NODE, "", 1)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
+from typing import List, Optional
 
+import numpy as np
 import torch
 from transformers_cfg.tokenization.SUPPORTED_TOKENIZERS import SUPPORTED_TOKENIZERS
 from .ByteProxyMapping import ByteProxyMapping, LLAMAByteProxyMapping
@@ -21,6 +23,32 @@ from transformers_cfg.tokenization.utils import get_tokenizer_charset
 log = logging.getLogger(__name__)
 
 
+class TokenBytesTable:
+    """
+    Stateless token id -> bytes table, stored as a flat byte buffer with offsets.
+    The arrays can be memory-mapped, see `transformers_cfg.tokenization.vocab_cache`.
+    """
+
+    __slots__ = ("offsets", "data")
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_token_bytes(cls, token_bytes: List[bytes]) -> "TokenBytesTable":
+        offsets = np.zeros(len(token_bytes) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in token_bytes], out=offsets[1:])
+        data = np.frombuffer(b"".join(token_bytes), dtype=np.uint8)
+        return cls(offsets, data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, token_id: int) -> bytes:
+        return self.data[self.offsets[token_id] : self.offsets[token_id + 1]].tobytes()
+
+
 class Token2ByteMapping(ABC):
     def __init__(self, tokenizer):
         self.eos_token_id = tokenizer.eos_token_id
@@ -28,6 +56,8 @@ class Token2ByteMapping(ABC):
         self.tokenizer = tokenizer
         self.special = tokenizer.all_special_ids
         self._length = len(self.tokenizer.get_vocab())
+        # precomputed `token_bytes`, e.g. loaded from the vocabulary cache
+        self.token_bytes_table: Optional[TokenBytesTable] = None
 
     def __len__(self):
         return self._length
@@ -36,8 +66,34 @@ class Token2ByteMapping(ABC):
     def map(self, token_id: int, verbose=False) -> bytes:
         pass
 
+    def token_bytes(self, token_id: int) -> bytes:
+        """The bytes of a token, independently of its position in the sequence."""
+        table = self.token_bytes_table
+        if table is not None and token_id < len(table):
+            return table[token_id]
+        return self._token_bytes(token_id)
+
+    def _token_bytes(self, token_id: int) -> bytes:
+        raise NotImplementedError
+
+    def build_token_bytes_table(self) -> TokenBytesTable:
+        return TokenBytesTable.from_token_bytes(
+            [self._token_bytes(token_id) for token_id in range(len(self))]
+        )
+
     @classmethod
-    def from_hf_tokenizer(cls, hf_tokenizer):
+    def from_hf_tokenizer(cls, hf_tokenizer, use_cache: bool = True):
+        mapping = cls._from_hf_tokenizer(hf_tokenizer)
+        if use_cache:
+            from transformers_cfg.tokenization.vocab_cache import load_vocab_artifact
+
+            artifact = load_vocab_artifact(hf_tokenizer)
+            if artifact is not None:
+                mapping.token_bytes_table = artifact.token_bytes
+        return mapping
+
+    @classmethod
+    def _from_hf_tokenizer(cls, hf_tokenizer):
         assert (
             type(hf_tokenizer) in SUPPORTED_TOKENIZERS
         ), f"Tokenizer not supported: {hf_tokenizer.__class__.__name__}, supported tokenizers: {SUPPORTED_TOKENIZERS}"
@@ -90,7 +146,14 @@ class Token2ByteMapping(ABC):
 class GPT2Token2ByteMapping(Token2ByteMapping):
     def __init__(self, tokenizer):
         super().__init__(tokenizer)
-        self.byte_proxy_mapping = ByteProxyMapping(tokenizer)
+        self._byte_proxy_mapping: Optional[ByteProxyMapping] = None
+
+    @property
+    def byte_proxy_mapping(self) -> ByteProxyMapping:
+        # built lazily: it loads the slow tokenizer, which is not needed when the token bytes are cached
+        if self._byte_proxy_mapping is None:
+            self._byte_proxy_mapping = ByteProxyMapping(self.tokenizer)
+        return self._byte_proxy_mapping
 
     def map2proxy_token(self, token_id: int) -> str:
         # This is the case for BOS,
@@ -102,12 +165,17 @@ class GPT2Token2ByteMapping(Token2ByteMapping):
         proxy_token = self.tokenizer.convert_ids_to_tokens(token_id)
         return proxy_token
 
+    def _token_bytes(self, token_id: int) -> bytes:
+        return self.byte_proxy_mapping.map(self.map2proxy_token(token_id))
+
     def map(self, token_id: int, verbose=False) -> bytes:
-        proxy_token = self.map2proxy_token(token_id)
+        # if token_id is tensor, convert it to int
+        if isinstance(token_id, torch.Tensor):
+            token_id = token_id.item()
         if verbose:
-            log.debug(f"token_id: {token_id}, token: {proxy_token}")
+            log.debug(f"token_id: {token_id}, token: {self.map2proxy_token(token_id)}")
 
-        return self.byte_proxy_mapping.map(proxy_token)
+        return self.token_bytes(token_id)
 
 
 class LLAMA1Token2ByteMapping(Token2ByteMapping):
@@ -116,6 +184,12 @@ class LLAMA1Token2ByteMapping(Token2ByteMapping):
         self.last_token_id = None
         self.byte_proxy_mapping = LLAMAByteProxyMapping()
 
+    def _token_bytes(self, token_id: int) -> bytes:
+        if token_id in self.special:
+            return b""
+        proxy_token = self.tokenizer.convert_ids_to_tokens(token_id)
+        return self.byte_proxy_mapping.map(proxy_token)
+
     def map(self, token_id: int, verbose=False) -> bytes:
         # we need to check if the token is at the beginning of the sentence to remove the space
         # specific to BPE
@@ -130,9 +204,7 @@ class LLAMA1Token2ByteMapping(Token2ByteMapping):
         # if token_id is tensor, convert it to int
         if isinstance(token_id, torch.Tensor):
             token_id = token_id.item()
-        proxy_token = self.tokenizer.convert_ids_to_tokens(token_id)
-
-        token_bytes = self.byte_proxy_mapping.map(proxy_token)
+        token_bytes = self.token_bytes(token_id)
 
         # check if the first byte is a space
         if token_bytes[0] == 32 and at_bos:
@@ -148,6 +220,12 @@ class T5Token2ByteMapping(Token2ByteMapping):
         self.at_bos = True
         self.byte_proxy_mapper = LLAMAByteProxyMapping()
 
+    def _token_bytes(self, token_id: int) -> bytes:
+        if token_id in self.special:
+            return b""
+        proxy_token = self.tokenizer.convert_ids_to_tokens(token_id)
+        return self.byte_proxy_mapper.map(proxy_token)
+
     def map(self, token_id: int, verbose=False) -> bytes:
         # we need to check if the token is at the beginning of the sentence to remove the space
         # specific to BPE
@@ -159,9 +237,7 @@ class T5Token2ByteMapping(Token2ByteMapping):
         # if token_id is tensor, convert it to int
         if isinstance(token_id, torch.Tensor):
             token_id = token_id.item()
-        proxy_token = self.tokenizer.convert_ids_to_tokens(token_id)
-
-        token_bytes = self.byte_proxy_mapper.map(proxy_token)
+        token_bytes = self.token_bytes(token_id)
 
         # check if the first byte is a space
         if token_bytes[0] == 32 and self.at_bos:
@@ -185,6 +261,9 @@ class ByT5Token2ByteMapping(Token2ByteMapping):
             token_id = token_id.item()
         if token_id in self.token_id_to_bytes:
             return self.token_id_to_bytes[token_id]
+        return self.token_bytes(token_id)
+
+    def _token_bytes(self, token_id: int) -> bytes:
         if 3 <= token_id <= 258:
             return ord(self.tokenizer.convert_ids_to_tokens(token_id)).to_bytes(
                 1, "big"
@@ -0,0 +1,192 @@
+"""
+On-disk cache of the artifacts derived from a tokenizer: the token id -> bytes table and the flattened `ByteTrie`.
+
+Building them calls `convert_ids_to_tokens` and a proxy-byte decode for every token of the vocabulary,
+which takes seconds for large vocabularies. The artifacts are stored once per tokenizer fingerprint as
+`.npy` files and loaded memory-mapped, so new processes share the pages instead of rebuilding them.
+
+The cache lives in `$TCFG_CACHE_DIR` (default `~/.cache/transformers_cfg`), set `TCFG_DISABLE_CACHE=1` to disable it.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import weakref
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import numpy as np
+
+from transformers_cfg import __version__
+from transformers_cfg.tokenization.byte_trie import ByteTrie
+from transformers_cfg.tokenization.mapping.token2byte import (
+    Token2ByteMapping,
+    TokenBytesTable,
+)
+from transformers_cfg.utils import get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+# bump when the layout or the content of the artifacts changes
+CACHE_FORMAT_VERSION = 1
+
+_META_FILE = "meta.json"
+
+# artifacts loaded in this process, by fingerprint
+_artifacts: Dict[str, "VocabArtifact"] = {}
+_fingerprints: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Hash of everything the artifacts depend on: vocabulary, special tokens, tokenizer class and name."""
+    hasher = hashlib.sha256()
+    header = [
+        CACHE_FORMAT_VERSION,
+        __version__,
+        f"{type(tokenizer).__module__}.{type(tokenizer).__qualname__}",
+        tokenizer.name_or_path,
+        tokenizer.bos_token_id,
+        tokenizer.eos_token_id,
+        sorted(tokenizer.all_special_ids),
+    ]
+    hasher.update(json.dumps(header).encode("utf-8"))
+    vocab = tokenizer.get_vocab()
+    for token, token_id in sorted(vocab.items(), key=lambda item: item[1]):
+        hasher.update(f"\n{token_id}\t{token}".encode("utf-8", "surrogatepass"))
+    return hasher.hexdigest()[:32]
+
+
+def _get_fingerprint(tokenizer) -> str:
+    try:
+        fingerprint = _fingerprints.get(tokenizer)
+    except TypeError:
+        # not weak-referenceable
+        return tokenizer_fingerprint(tokenizer)
+    if fingerprint is None:
+        fingerprint = tokenizer_fingerprint(tokenizer)
+        _fingerprints[tokenizer] = fingerprint
+    return fingerprint
+
+
+@dataclass
+class VocabArtifact:
+    fingerprint: str
+    token_bytes: TokenBytesTable
+    trie: ByteTrie
+
+    @classmethod
+    def build(cls, tokenizer, fingerprint: Optional[str] = None) -> "VocabArtifact":
+        mapping = Token2ByteMapping.from_hf_tokenizer(tokenizer, use_cache=False)
+        token_bytes = mapping.build_token_bytes_table()
+        # the trie is built from the table instead of converting every token again
+        mapping.token_bytes_table = token_bytes
+        trie = ByteTrie.from_token2byte_mapping(tokenizer, mapping)
+        if fingerprint is None:
+            fingerprint = tokenizer_fingerprint(tokenizer)
+        return cls(fingerprint, token_bytes, trie)
+
+    def save(self, directory: str, replace: bool = False) -> None:
+        """
+        Write the artifact to `directory`, atomically: concurrent writers leave a single complete copy.
+        With `replace`, an existing copy (e.g. a corrupted one) is replaced instead of kept.
+        """
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        tmp_directory = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+        # the copy being replaced is moved aside first, a directory can't be renamed over a non-empty one
+        old_directory = tmp_directory + "-old"
+        try:
+            arrays = {
+                "token_bytes_offsets": self.token_bytes.offsets,
+                "token_bytes_data": self.token_bytes.data,
+            }
+            arrays.update(
+                {f"trie_{name}": array for name, array in self.trie.to_arrays().items()}
+            )
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_directory, f"{name}.npy"), array)
+            meta = {
+                "format_version": CACHE_FORMAT_VERSION,
+                "fingerprint": self.fingerprint,
+                "vocab_size": self.trie.vocab_size,
+            }
+            with open(os.path.join(tmp_directory, _META_FILE), "w") as file:
+                json.dump(meta, file)
+            if replace:
+                try:
+                    os.rename(directory, old_directory)
+                except FileNotFoundError:
+                    pass
+            os.replace(tmp_directory, directory)
+        except OSError:
+            if os.path.exists(os.path.join(directory, _META_FILE)):
+                # another process was faster
+                logger.debug(f"vocabulary cache {directory} already written")
+            else:
+                raise
+        finally:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            shutil.rmtree(old_directory, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "VocabArtifact":
+        with open(os.path.join(directory, _META_FILE), "r") as file:
+            meta = json.load(file)
+        if meta["format_version"] != CACHE_FORMAT_VERSION:
+            raise ValueError(
+                f"unsupported vocabulary cache format {meta['format_version']}"
+            )
+        mmap_mode = "r" if mmap else None
+
+        def _load(name):
+            array = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+            # plain ndarray view of the memmap, cheaper to slice
+            return np.asarray(array)
+
+        token_bytes = TokenBytesTable(
+            _load("token_bytes_offsets"), _load("token_bytes_data")
+        )
+        trie = ByteTrie.from_arrays(
+            {name: _load(f"trie_{name}") for name in ByteTrie.ARRAY_NAMES},
+            vocab_size=meta["vocab_size"],
+        )
+        return cls(meta["fingerprint"], token_bytes, trie)
+
+
+def load_vocab_artifact(
+    tokenizer, cache_dir: Optional[str] = None
+) -> Optional[VocabArtifact]:
+    """
+    The artifact of a tokenizer, from this process, from the cache directory or built (and saved).
+    Returns None if the cache is disabled.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    fingerprint = _get_fingerprint(tokenizer)
+    artifact = _artifacts.get(fingerprint)
+    if artifact is not None:
+        return artifact
+
+    directory = os.path.join(cache_dir, "vocab", fingerprint)
+    corrupted = False
+    if os.path.exists(os.path.join(directory, _META_FILE)):
+        try:
+            artifact = VocabArtifact.load(directory)
+            logger.debug(f"loaded vocabulary cache from {directory}")
+        except (OSError, ValueError, KeyError, EOFError) as e:
+            logger.warning(f"ignoring corrupted vocabulary cache {directory}: {e}")
+            corrupted = True
+    if artifact is None:
+        artifact = VocabArtifact.build(tokenizer, fingerprint)
+        try:
+            artifact.save(directory, replace=corrupted)
+            logger.debug(f"saved vocabulary cache to {directory}")
+        except OSError as e:
+            logger.warning(f"could not save vocabulary cache to {directory}: {e}")
+    _artifacts[fingerprint] = artifact
+    return artifact
@@ -0,0 +1,106 @@
+import copy
+import logging
+import weakref
+from typing import Optional
+
+from transformers_cfg.tokenization.byte_trie import ByteTrie
+from transformers_cfg.tokenization.mapping.token2byte import (
+    Token2ByteMapping,
+    TokenBytesTable,
+)
+
+logger = logging.getLogger(__name__)
+
+# indexes built in this process, one per tokenizer. The indexes only hold their tokenizer weakly,
+# otherwise the keys would never be collected
+_indexes: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+class VocabularyIndex:
+    """
+    Grammar-independent view of a tokenizer's vocabulary: the byte trie, which leaves out the
+    special tokens that are never generated, the token bytes and the EOS id.
+
+    Building it costs a pass over the whole vocabulary, so there should be one index per tokenizer,
+    shared by any number of grammar constraints (`IncrementalTokenRecognizer(..., vocab_index=...)`).
+    What a grammar constraint owns on top of it only depends on the grammar.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        byte_trie: ByteTrie,
+        token2byte_mapping: Token2ByteMapping,
+    ):
+        try:
+            self._tokenizer_ref = weakref.ref(tokenizer)
+        except TypeError:
+            # not weak-referenceable, such an index isn't cached in `_indexes` either
+            self._tokenizer_ref = lambda: tokenizer
+        self.byte_trie = byte_trie.build()
+        self.eos_token_id = tokenizer.eos_token_id
+        self.vocab_size = len(token2byte_mapping)
+        if token2byte_mapping.token_bytes_table is None:
+            try:
+                token2byte_mapping.token_bytes_table = (
+                    token2byte_mapping.build_token_bytes_table()
+                )
+            except NotImplementedError:
+                # custom mapping without stateless token bytes, each constraint maps on its own
+                pass
+        # prototype of the per-constraint mappings, never used to map tokens itself. Its tokenizer
+        # is set on the copies, see `new_token2byte_mapping`
+        self._token2byte_mapping = copy.copy(token2byte_mapping)
+        self._token2byte_mapping.tokenizer = None
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, use_cache: bool = True) -> "VocabularyIndex":
+        """The index of a tokenizer, built once per tokenizer object and process."""
+        if use_cache:
+            try:
+                index = _indexes.get(tokenizer)
+            except TypeError:
+                # not weak-referenceable
+                index = None
+            if index is not None:
+                return index
+        mapping = Token2ByteMapping.from_hf_tokenizer(tokenizer, use_cache=use_cache)
+        if mapping.token_bytes_table is not None:
+            # both come from the same vocabulary cache artifact
+            byte_trie = ByteTrie.from_tokenizer(tokenizer)
+        else:
+            mapping.token_bytes_table = mapping.build_token_bytes_table()
+            # mapping tokens updates the BOS state, build the trie with a copy
+            byte_trie = ByteTrie.from_token2byte_mapping(tokenizer, copy.copy(mapping))
+        index = cls(tokenizer, byte_trie, mapping)
+        if use_cache:
+            try:
+                _indexes[tokenizer] = index
+            except TypeError:
+                pass
+        logger.debug(f"built vocabulary index for {tokenizer.name_or_path}")
+        return index
+
+    @property
+    def tokenizer(self):
+        """The tokenizer of the index, or None once it has been garbage collected."""
+        return self._tokenizer_ref()
+
+    @property
+    def token_bytes(self) -> Optional[TokenBytesTable]:
+        return self._token2byte_mapping.token_bytes_table
+
+    def new_token2byte_mapping(self) -> Token2ByteMapping:
+        """
+        A fresh token -> bytes mapping for a single constraint.
+        Mappings keep per-sequence state (e.g. BOS handling) and must not be shared, but the
+        token bytes table is shared with the index.
+        """
+        tokenizer = self.tokenizer
+        if tokenizer is None:
+            raise RuntimeError(
+                "the tokenizer of the vocabulary index was garbage collected"
+            )
+        mapping = copy.copy(self._token2byte_mapping)
+        mapping.tokenizer = tokenizer
+        return mapping
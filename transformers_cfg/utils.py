@@ -1,9 +1,20 @@
 import json
-from typing import List
+import os
+from typing import List, Optional
 
 from termcolor import colored
 
 
+def get_cache_dir() -> Optional[str]:
+    """Directory of the on-disk caches, None if caching is disabled with `TCFG_DISABLE_CACHE`."""
+    if os.getenv("TCFG_DISABLE_CACHE", "").lower() in ("1", "true", "yes"):
+        return None
+    return os.getenv(
+        "TCFG_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "transformers_cfg"),
+    )
+
+
 def ints2bytes(sequence: List[int]) -> bytes:
     # check in the range of 0-255
     for item in sequence:
@@ -0,0 +1,174 @@
+import logging
+from typing import Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# bits per packed word
+WORD_BITS = 64
+# masks are stored as little-endian words so that the uint8 view has the bit order expected by `np.unpackbits`
+WORD_DTYPE = np.dtype("<u8")
+
+
+def num_words(vocab_size: int) -> int:
+    return (vocab_size + WORD_BITS - 1) // WORD_BITS
+
+
+class VocabMask:
+    """
+    A set of token ids over a vocabulary, packed into uint64 words.
+
+    Token `i` is bit `i % 64` of word `i // 64`. A mask over a 150k vocabulary takes ~19 KB,
+    merging masks is a handful of word-wise ORs, and the mask is only expanded to a bool tensor
+    once it is applied to the logits (see `to_tensor` and `batch_to_tensor`).
+    """
+
+    __slots__ = ("words", "vocab_size")
+
+    def __init__(self, words: np.ndarray, vocab_size: int):
+        assert (
+            words.dtype == WORD_DTYPE
+        ), f"expected {WORD_DTYPE} words, got {words.dtype}"
+        assert len(words) == num_words(vocab_size)
+        self.words = words
+        self.vocab_size = vocab_size
+
+    #############################
+    #
+    # Construction
+    #
+    #############################
+
+    @classmethod
+    def zeros(cls, vocab_size: int) -> "VocabMask":
+        return cls(np.zeros(num_words(vocab_size), dtype=WORD_DTYPE), vocab_size)
+
+    @classmethod
+    def from_token_ids(
+        cls, vocab_size: int, token_ids: Union[np.ndarray, Iterable[int]]
+    ) -> "VocabMask":
+        mask = cls.zeros(vocab_size)
+        mask.set_token_ids(token_ids)
+        return mask
+
+    @classmethod
+    def from_bool(
+        cls, acceptance: Union[np.ndarray, torch.Tensor, List[bool]]
+    ) -> "VocabMask":
+        if isinstance(acceptance, torch.Tensor):
+            acceptance = acceptance.detach().cpu().numpy()
+        acceptance = np.asarray(acceptance, dtype=bool)
+        vocab_size = len(acceptance)
+        packed = np.packbits(acceptance, bitorder="little")
+        padded = np.zeros(num_words(vocab_size) * (WORD_BITS // 8), dtype=np.uint8)
+        padded[: len(packed)] = packed
+        return cls(padded.view(WORD_DTYPE), vocab_size)
+
+    def copy(self) -> "VocabMask":
+        return VocabMask(self.words.copy(), self.vocab_size)
+
+    #############################
+    #
+    # Element access
+    #
+    #############################
+
+    def __getitem__(self, token_id: int) -> bool:
+        return bool((int(self.words[token_id >> 6]) >> (token_id & 63)) & 1)
+
+    def __setitem__(self, token_id: int, value: bool) -> None:
+        bit = np.uint64(1 << (token_id & 63))
+        if value:
+            self.words[token_id >> 6] |= bit
+        else:
+            self.words[token_id >> 6] &= ~bit
+
+    def set_token_ids(self, token_ids: Union[np.ndarray, Iterable[int]]) -> None:
+        if isinstance(token_ids, np.ndarray):
+            token_ids = token_ids.astype(np.int64, copy=False)
+        else:
+            token_ids = np.fromiter(token_ids, dtype=np.int64)
+        if len(token_ids) == 0:
+            return
+        bits = np.left_shift(np.uint64(1), (token_ids & 63).astype(np.uint64))
+        np.bitwise_or.at(self.words, token_ids >> 6, bits)
+
+    def token_ids(self) -> np.ndarray:
+        return np.flatnonzero(self.to_bool_array())
+
+    def count(self) -> int:
+        return int(np.unpackbits(self.words.view(np.uint8)).sum())
+
+    def any(self) -> bool:
+        return bool(self.words.any())
+
+    def __len__(self):
+        return self.vocab_size
+
+    def __eq__(self, other):
+        if not isinstance(other, VocabMask):
+            return NotImplemented
+        return self.vocab_size == other.vocab_size and np.array_equal(
+            self.words, other.words
+        )
+
+    def __repr__(self):
+        return f"VocabMask(vocab_size={self.vocab_size}, count={self.count()})"
+
+    #############################
+    #
+    # Set operations
+    #
+    #############################
+
+    def __or__(self, other: "VocabMask") -> "VocabMask":
+        return VocabMask(np.bitwise_or(self.words, other.words), self.vocab_size)
+
+    def __ior__(self, other: "VocabMask") -> "VocabMask":
+        np.bitwise_or(self.words, other.words, out=self.words)
+        return self
+
+    def __and__(self, other: "VocabMask") -> "VocabMask":
+        return VocabMask(np.bitwise_and(self.words, other.words), self.vocab_size)
+
+    def __iand__(self, other: "VocabMask") -> "VocabMask":
+        np.bitwise_and(self.words, other.words, out=self.words)
+        return self
+
+    @staticmethod
+    def union(masks: Sequence["VocabMask"]) -> "VocabMask":
+        """Merge masks, e.g. the masks of the stacks of a parsing state."""
+        if len(masks) == 1:
+            return masks[0].copy()
+        words = np.bitwise_or.reduce(np.stack([mask.words for mask in masks]), axis=0)
+        return VocabMask(words, masks[0].vocab_size)
+
+    #############################
+    #
+    # Expansion
+    #
+    #############################
+
+    def to_bool_array(self) -> np.ndarray:
+        return np.unpackbits(self.words.view(np.uint8), bitorder="little")[
+            : self.vocab_size
+        ].view(bool)
+
+    def to_tensor(self, device: Optional[torch.device] = None) -> torch.Tensor:
+        return torch.from_numpy(self.to_bool_array()).to(device)
+
+    @staticmethod
+    def stack_words(masks: Sequence["VocabMask"]) -> np.ndarray:
+        return np.stack([mask.words for mask in masks])
+
+    @staticmethod
+    def batch_to_tensor(
+        masks: Sequence["VocabMask"], device: Optional[torch.device] = None
+    ) -> torch.Tensor:
+        """Expand a batch of masks into a (batch_size, vocab_size) bool tensor in one go."""
+        vocab_size = masks[0].vocab_size
+        words = VocabMask.stack_words(masks)
+        acceptance = np.unpackbits(words.view(np.uint8), axis=1, bitorder="little")
+        return torch.from_numpy(acceptance[:, :vocab_size].view(bool)).to(device)